@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: stimulus apertures for pRF modelling
+
+Streams the stimulus aperture of a paradigm (where the checkerboard is drawn, inside the
+external ring) into a memory-mapped .npy, per frame or averaged per TR, at any grid
+resolution. Chunks are rendered by a process pool and written in place by the workers,
+so a whole run never has to fit in memory.
+
+    python aperture_export.py eccentricity_polar --size 200 200 --tr 2 --out ecc_polar_apertures.npy
+    python aperture_export.py moving_bars --size 100 100 --packbits --out bars_apertures.npy
+
+Frames are (height, width) images, first row at the top of the screen. Binary apertures
+can be bit-packed along the width (np.packbits), see unpackApertures().
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import argparse
+import multiprocessing
+import numpy as np
+
+from paradigms import Paradigms, loadParameters
+from frame_schedule import compileSchedule
+from soft_render import softRenderer, Block_frames
+
+
+################################################################################################################
+## Constants
+
+Chunk_frames = 512                              # frames per pool task (per-frame export)
+Chunk_trs = 4                                   # TRs per pool task (per-TR export)
+
+
+################################################################################################################
+## Functions
+
+
+def unpackApertures(packed, width):
+    return np.unpackbits(packed, axis=-1)[..., :width].astype(bool)
+
+
+# Schedule rows [first, last) sampled within every TR
+def trFrames(schedule, tr, refresh_rate):
+    n_trs = int(np.ceil(len(schedule) / (tr * refresh_rate) - 1e-6))
+    bounds = np.ceil(np.arange(n_trs + 1) * tr * refresh_rate - 1e-6).astype(np.int64)
+    return np.minimum(bounds, len(schedule))
+
+
+# Worker side: one renderer per process, apertures written straight into the output file
+_renderer = None
+
+def _initWorker(paradigm, params, size, supersampling):
+    global _renderer
+    _renderer = softRenderer(paradigm, params, size=size, web=False, fixation=False,
+                             supersampling=supersampling)
+
+
+def _exportChunk(task):
+    out, first, rows_blocks, per_tr, packbits = task
+    apertures = np.load(out, mmap_mode='r+')
+    for i_out, rows in enumerate(rows_blocks):
+        block = np.concatenate([_renderer.coverage(rows[i:i+Block_frames])
+                                for i in range(0, len(rows), Block_frames)])
+        if per_tr:
+            apertures[first + i_out] = block.mean(axis=0)
+        elif packbits:
+            apertures[first:first+len(block)] = np.packbits(block > 0, axis=-1)
+        elif apertures.dtype == bool:
+            apertures[first:first+len(block)] = block > 0
+        else:
+            apertures[first:first+len(block)] = block
+    apertures.flush()
+    del apertures
+    return sum(len(rows) for rows in rows_blocks)
+
+
+def exportApertures(paradigm, out, size=(200,200), refresh_rate=60., tr=None, supersampling=1,
+                    packbits=False, processes=None, params=None, progress=None):
+    params = loadParameters(paradigm) if params is None else params
+    if packbits and (supersampling > 1 or tr is not None):
+        raise ValueError('Only binary apertures can be bit-packed: use packbits without supersampling or tr')
+    schedule = compileSchedule(paradigm, params, refresh_rate)
+    width, height = int(size[0]), int(size[1])
+
+    # Output file, and one task per chunk of frames or of TRs (the frames of every TR)
+    tasks = []
+    if tr is None:
+        shape = (len(schedule), height, (width + 7) // 8 if packbits else width)
+        dtype = np.uint8 if packbits else (bool if supersampling == 1 else np.float32)
+        for first in range(0, len(schedule), Chunk_frames):
+            tasks.append((out, first, [schedule[first:first+Chunk_frames]], False, packbits))
+    else:
+        bounds = trFrames(schedule, tr, refresh_rate)
+        shape, dtype = (len(bounds) - 1, height, width), np.float32
+        for first in range(0, len(bounds) - 1, Chunk_trs):
+            last = min(first + Chunk_trs, len(bounds) - 1)
+            tasks.append((out, first, [schedule[bounds[i]:bounds[i+1]] for i in range(first, last)], True, packbits))
+    apertures = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+    del apertures
+
+    pool = multiprocessing.Pool(processes, _initWorker, (paradigm, params, (width, height), supersampling))
+    try:
+        n_done = 0
+        for n_frames in pool.imap_unordered(_exportChunk, tasks):
+            n_done += n_frames
+            if progress is not None:
+                progress(n_done, len(schedule))
+    finally:
+        pool.close()
+        pool.join()
+    return shape
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Export the stimulus apertures of a paradigm for pRF modelling.')
+    parser.add_argument('paradigm', choices=Paradigms)
+    parser.add_argument('--size', type=int, nargs=2, default=(200,200), metavar=('WIDTH','HEIGHT'))
+    parser.add_argument('--rate', type=float, default=60., help='refresh rate (Hz) the run is sampled at')
+    parser.add_argument('--tr', type=float, default=None, help='average the frames of every TR (sec)')
+    parser.add_argument('--supersampling', type=int, default=1, help='area-sampled anti-aliasing (n x n per pixel)')
+    parser.add_argument('--packbits', action='store_true', help='bit-pack binary apertures along the width')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--out', required=True, help='.npy file for the apertures')
+    args = parser.parse_args()
+
+    shape = exportApertures(args.paradigm, args.out, args.size, args.rate, args.tr, args.supersampling,
+                            args.packbits, args.processes)
+    print('%s apertures of %s saved in %s' % ('x'.join(str(n) for n in shape), args.paradigm, args.out))
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: asynchronous log file
+
+Drop-in replacement for psychopy's logging.LogFile. psychopy formats the records and hands
+them to the target at every logging.flush() (i.e. at win.flip()); this target only appends
+them, with a monotonic timestamp, to a deque, and a background thread writes them to the
+file in batches. Records per frame and the threads doing file writes are counted, to check
+that the flip path never waits for the disk.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import atexit
+import collections
+import io
+import threading
+
+from event_ring import monotonicNs
+
+
+################################################################################################################
+## Constants
+
+Flush_interval = 0.1                            # sec between two batches written by the thread
+
+
+################################################################################################################
+## Functions
+
+
+class asyncLogFile(object):
+    def __init__(self, f, level=None, filemode='a', encoding='utf8', flush_interval=Flush_interval):
+        from psychopy import logging
+
+        self.level = logging.WARNING if level is None else level
+        self.stream = self                      # psychopy may flush target.stream: nothing to do here
+        self.flush_interval = flush_interval
+        self._records = collections.deque()     # (monotonic ns, text); append/popleft need no lock
+        self._file = io.open(f, filemode, encoding=encoding)
+
+        # Volume and write statistics
+        self.n_records = 0
+        self.n_frames = 0
+        self.frames_logging = 0                 # frames that produced at least one record
+        self.max_per_frame = 0
+        self.n_batches = 0
+        self.max_delay = 0.                     # sec. from enqueue to write
+        self.writer_writes = 0
+        self.other_writes = 0                   # file writes outside the writer thread (close only)
+        self._frame_start = 0
+
+        self._stop = threading.Event()
+        self._writer = threading.Thread(target=self._run, name='log writer')
+        self._writer.daemon = True
+        self._writer.start()
+        logging.root.addTarget(self)
+        atexit.register(self.close)
+
+    def setLevel(self, level):
+        self.level = level
+
+    # Called by psychopy's logger, on the render thread
+    def write(self, text):
+        self._records.append((monotonicNs(), text))
+        self.n_records += 1
+
+    def flush(self):
+        pass
+
+    # Call once per flip to count the records of every frame
+    def frameDone(self):
+        n_frame_records = self.n_records - self._frame_start
+        self._frame_start = self.n_records
+        self.n_frames += 1
+        if n_frame_records > 0:
+            self.frames_logging += 1
+            if n_frame_records > self.max_per_frame:
+                self.max_per_frame = n_frame_records
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self._writeBatch()
+
+    def _writeBatch(self):
+        batch = []
+        records = self._records
+        while records:
+            batch.append(records.popleft())
+        if not batch:
+            return
+        self._file.write(u''.join(text for enqueued, text in batch))
+        self._file.flush()
+        self.n_batches += 1
+        self.max_delay = max(self.max_delay, (monotonicNs() - batch[0][0]) * 1e-9)
+        if threading.current_thread() is self._writer:
+            self.writer_writes += 1
+        else:
+            self.other_writes += 1
+
+    def summary(self):
+        return ('Log: %d records over %d frames (%d frames logged, max %d per frame), %d batches '
+                '(%d from the writer thread, %d elsewhere), longest delay to disk %.1f ms') % \
+            (self.n_records, self.n_frames, self.frames_logging, self.max_per_frame, self.n_batches,
+             self.writer_writes, self.other_writes, self.max_delay*1000.)
+
+    # Write what is left and detach from psychopy's logger
+    def close(self):
+        if self._file is None:
+            return
+        from psychopy import logging
+
+        logging.flush()
+        self._stop.set()
+        self._writer.join()
+        self._writeBatch()
+        if self in logging.root.targets:
+            logging.root.removeTarget(self)
+        self._file.close()
+        self._file = None
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping benchmarks: per-frame CPU cost
+
+Runs the real main() of every paradigm script against the recording psychopy backend
+(mock_psychopy), with no display, and reports per frame: CPU time, memory allocated and
+the attribute sets / draw and setter calls done on the stimuli, at several screen
+resolutions and Mask_positions_number values. Results are saved as JSON; --compare prints
+the CPU time ratio against an earlier result file.
+
+    python benchmarks/bench_frames.py --frames 600 --out bench_frames.json
+    python benchmarks/bench_frames.py --resolutions 1920x1080 --compare bench_frames.json
+    python benchmarks/bench_frames.py --set Mask_bank=False Cached_background=False --out bench_uncached.json
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import argparse
+import ast
+import importlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+
+Repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, Repo_dir)
+
+import mock_psychopy
+from paradigms import Paradigms, loadParameters
+
+
+################################################################################################################
+## Constants
+
+Resolutions = [(1280, 720), (1920, 1080), (2560, 1440)]
+Mask_positions = [1000, 10000, 50000]           # eccentricity paradigms only
+Frames = 600
+Warmup_frames = 30
+Percentiles = [50, 90, 99]
+
+# Module variables main() expects from __main__, and settings that keep the benchmark on the CPU path
+Script_variables = {'DEBUG_MODE': False, 'BUTTON_BOX': False, 'Frame_locked_timing': True, 'Async_log': False}
+
+
+################################################################################################################
+## Functions
+
+
+_cpu_time = getattr(time, 'process_time', time.time)
+
+
+def statistics(values, scale=1.):
+    values = np.asarray(values, dtype=np.float64) * scale
+    if len(values) == 0:
+        return {}
+    result = dict(('p%d' % p, float(v)) for p, v in zip(Percentiles, np.percentile(values, Percentiles)))
+    result.update(mean=float(values.mean()), max=float(values.max()))
+    return result
+
+
+class frameRecorder(object):
+    def __init__(self, warmup, n_frames, allocations=False):
+        self.warmup = warmup
+        self.last = warmup + n_frames
+        self.allocations = allocations
+        self.n_frames = 0
+        self.cpu, self.wall, self.peak, self.retained = [], [], [], []
+        self.counters_start = self.counters_end = None
+        if allocations:
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+
+    # End of a frame (event.getKeys() of the render loop)
+    def __call__(self):
+        cpu, wall = _cpu_time(), time.time()
+        self.n_frames += 1
+        if self.n_frames == self.warmup:
+            self.counters_start = mock_psychopy.counters.copy()
+            if self.allocations:
+                self.tracemalloc.start()
+        elif self.n_frames > self.warmup:
+            self.cpu.append(cpu - self._cpu)
+            self.wall.append(wall - self._wall)
+            if self.allocations:
+                current, peak = self.tracemalloc.get_traced_memory()
+                self.peak.append(max(peak - self._current, 0))
+                self.retained.append(current - self._current)
+            if self.n_frames == self.last:
+                self.counters_end = mock_psychopy.counters.copy()
+        if self.allocations and self.n_frames >= self.warmup:
+            self._current = self.tracemalloc.get_traced_memory()[0]
+            if hasattr(self.tracemalloc, 'reset_peak'):
+                self.tracemalloc.reset_peak()
+        self._cpu, self._wall = _cpu_time(), time.time()
+
+    def stop(self):
+        if self.allocations and self.tracemalloc.is_tracing():
+            self.tracemalloc.stop()
+
+
+def loadScript(paradigm, resolution, overrides, path_out):
+    module = importlib.import_module(paradigm)
+    for name, value in loadParameters(paradigm, **overrides).items():
+        setattr(module, name, value)
+    for name, value in Script_variables.items():
+        setattr(module, name, value)
+    module.resX, module.resY = resolution
+    module.path_out = path_out
+    return module
+
+
+# One run of main(): n_frames measured frames after the warmup, then 'escape'
+def measureFrames(keys, paradigm, resolution, n_frames, overrides={}, warmup=Warmup_frames, allocations=False):
+    path_out = tempfile.mkdtemp(prefix='bench_frames_') + '/'
+    try:
+        module = loadScript(paradigm, resolution, overrides, path_out)
+        win = mock_psychopy.Window(resolution)
+        recorder = frameRecorder(warmup, n_frames, allocations)
+        keys.n_calls, keys.escape_after, keys.frame_hooks = 0, warmup + n_frames, [recorder]
+        try:
+            module.main(win, mock_psychopy.Clock())
+        finally:
+            recorder.stop()
+    finally:
+        shutil.rmtree(path_out, ignore_errors=True)
+    return recorder
+
+
+def benchmark(keys, paradigm, resolution, n_frames, mask_positions=None, allocations=True, settings={}):
+    overrides = dict(settings)
+    if mask_positions is not None:
+        overrides['Mask_positions_number'] = mask_positions
+    timing = measureFrames(keys, paradigm, resolution, n_frames, overrides)
+    n_measured = max(len(timing.cpu), 1)
+
+    # Stimulus work per frame, from the recording backend
+    per_frame = {}
+    for (owner, name), count in timing.counters_end.items():
+        count -= timing.counters_start.get((owner, name), 0)
+        if count > 0:
+            per_frame['%s.%s' % (owner, name)] = count / n_measured
+    attribute_sets = sum(count for name, count in per_frame.items() if not name.endswith('()') and
+                         not name.startswith('logging.'))
+
+    result = {'paradigm': paradigm, 'resolution': list(resolution), 'mask_positions': mask_positions, 'settings': settings,
+              'frames': len(timing.cpu), 'cpu_ms': statistics(timing.cpu, 1000.),
+              'wall_ms': statistics(timing.wall, 1000.), 'attribute_sets_per_frame': attribute_sets,
+              'per_frame': per_frame}
+    if allocations:
+        memory = measureFrames(keys, paradigm, resolution, n_frames, overrides, allocations=True)
+        result['peak_alloc_bytes'] = statistics(memory.peak)
+        result['retained_bytes_per_frame'] = float(np.mean(memory.retained)) if memory.retained else 0.
+    return result
+
+
+def compare(results, previous):
+    def key(result):
+        return (result['paradigm'], tuple(result['resolution']), result['mask_positions'],
+                tuple(sorted(result.get('settings', {}).items())))
+    before = dict((key(result), result) for result in previous['results'])
+    lines = []
+    for result in results:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        ratio = result['cpu_ms']['mean'] / old['cpu_ms']['mean']
+        lines.append('%-20s %5dx%-5d masks %-6s CPU %.3f -> %.3f ms/frame (x%.2f)' %
+                     (result['paradigm'], result['resolution'][0], result['resolution'][1],
+                      result['mask_positions'], old['cpu_ms']['mean'], result['cpu_ms']['mean'], ratio))
+    return lines
+
+
+
+
+if __name__ == "__main__":
+
+    def resolution(text):
+        return tuple(int(n) for n in text.lower().split('x'))
+
+    def setting(text):
+        name, value = text.split('=', 1)
+        return name, ast.literal_eval(value)
+
+    parser = argparse.ArgumentParser(description='Per-frame CPU cost of every paradigm with a recording psychopy.')
+    parser.add_argument('--paradigms', nargs='+', choices=Paradigms, default=Paradigms)
+    parser.add_argument('--resolutions', nargs='+', type=resolution, default=Resolutions, metavar='WxH')
+    parser.add_argument('--mask-positions', nargs='+', type=int, default=Mask_positions)
+    parser.add_argument('--frames', type=int, default=Frames)
+    parser.add_argument('--set', nargs='+', type=setting, default=[], metavar='NAME=VALUE',
+                        help='script constants to override, e.g. Mask_bank=False')
+    parser.add_argument('--no-allocations', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--out', default='bench_frames.json')
+    parser.add_argument('--compare', default=None, help='earlier result file')
+    args = parser.parse_args()
+
+    keys = mock_psychopy.install()
+    results = []
+    for paradigm in args.paradigms:
+        with_masks = 'Mask_positions_number' in loadParameters(paradigm)
+        for res in args.resolutions:
+            for mask_positions in (args.mask_positions if with_masks else [None]):
+                result = benchmark(keys, paradigm, res, args.frames, mask_positions, not args.no_allocations,
+                                   dict(args.set))
+                results.append(result)
+                print('%-20s %5dx%-5d masks %-6s CPU %.3f ms/frame (p99 %.3f), %.1f attribute sets/frame%s' %
+                      (paradigm, res[0], res[1], mask_positions, result['cpu_ms']['mean'], result['cpu_ms']['p99'],
+                       result['attribute_sets_per_frame'],
+                       ', peak alloc %.1f kB' % (result['peak_alloc_bytes']['mean']/1024.)
+                       if 'peak_alloc_bytes' in result else ''))
+
+    output = {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+              'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'frames': args.frames, 'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=1, sort_keys=True)
+    print('Results saved in %s' % args.out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n'.join(compare(results, json.load(f))))
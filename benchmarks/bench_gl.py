@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping benchmarks: real OpenGL throughput
+
+Runs the real psychopy rendering path of every paradigm in a virtual framebuffer (Xvfb)
+with software OpenGL (Mesa llvmpipe), at several window sizes, for a fixed number of frames
+and with no operator input (key waits and fixation pauses are skipped, 'escape' is sent
+after the last frame). Every configuration runs in its own xvfb-run process; the parent
+collects frames per second, flip-interval jitter and frames longer than 1.5 refresh periods
+into a JSON file and a comparison table.
+
+    python benchmarks/bench_gl.py --sizes 1280x720 1920x1080 --frames 300 --out bench_gl.json
+
+Needs psychopy, xvfb-run and Mesa. Without vsync the intervals measure rendering cost (fill
+rate of the 1.3 x resY polar RadialStim, mask texture uploads), not a real display.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+Benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(Benchmarks_dir))
+sys.path.insert(0, Benchmarks_dir)
+
+from paradigms import Paradigms
+from bench_frames import loadScript, statistics, Warmup_frames
+
+
+################################################################################################################
+## Constants
+
+Sizes = [(1280, 720), (1920, 1080), (2560, 1440)]
+Frames = 300
+Target_rate = 60.                               # Hz, for counting long frames
+Long_frame = 1.5                                # x target period
+
+Script_variables = {'DEBUG_MODE': False, 'BUTTON_BOX': False, 'Frame_locked_timing': False, 'Async_log': False,
+                    'Frame_journal': False, 'Fullscreen': True}
+Gl_environment = {'LIBGL_ALWAYS_SOFTWARE': '1'}
+
+
+################################################################################################################
+## Functions
+
+
+# Inside Xvfb: one paradigm at one size
+def runWorker(paradigm, size, n_frames, out, warmup=Warmup_frames):
+    from psychopy import visual, event, core
+
+    # No operator: key waits return at once, fixation pauses are skipped, 'escape' ends the run
+    n_calls = [0]
+    loop_start = [None]
+    def waitKeys(*args, **kwargs):
+        return ['space']
+    def getKeys(*args, **kwargs):
+        n_calls[0] += 1
+        if n_calls[0] == warmup:
+            loop_start[0] = len(win.frameIntervals)
+        return ['escape'] if n_calls[0] >= warmup + n_frames else []
+    event.waitKeys, event.getKeys = waitKeys, getKeys
+    core.wait = lambda *args, **kwargs: None
+
+    path_out = tempfile.mkdtemp(prefix='bench_gl_') + '/'
+    win = visual.Window(list(size), screen=0, units="norm", fullscr=True, allowStencil=True, waitBlanking=False)
+    win.recordFrameIntervals = True
+    module = loadScript(paradigm, tuple(win.size), {}, path_out)
+    for name, value in Script_variables.items():
+        setattr(module, name, value)
+
+    start = time.time()
+    try:
+        module.main(win, core.Clock())
+    finally:
+        shutil.rmtree(path_out, ignore_errors=True)
+    elapsed = time.time() - start
+
+    intervals = np.asarray(win.frameIntervals[loop_start[0]:], dtype=np.float64)[:n_frames]
+    result = {'paradigm': paradigm, 'size': list(size), 'window': list(win.size), 'frames': len(intervals),
+              'fps': float(1. / intervals.mean()) if len(intervals) else 0.,
+              'interval_ms': statistics(intervals, 1000.),
+              'jitter_ms': float(intervals.std() * 1000.) if len(intervals) else 0.,
+              'long_frames': int(np.sum(intervals > Long_frame / Target_rate)),
+              'run_sec': elapsed, 'renderer': glRenderer()}
+    win.close()
+    with open(out, 'w') as f:
+        json.dump(result, f)
+
+
+def glRenderer():
+    try:
+        from pyglet import gl as GL
+        import ctypes
+        return ctypes.cast(GL.glGetString(GL.GL_RENDERER), ctypes.c_char_p).value.decode()
+    except Exception:
+        return 'unknown'
+
+
+# Parent: one xvfb-run process per configuration
+def runConfiguration(paradigm, size, n_frames, use_xvfb=True):
+    handle, out = tempfile.mkstemp(suffix='.json', prefix='bench_gl_')
+    os.close(handle)
+    command = [sys.executable, os.path.abspath(__file__), '--worker', paradigm, '%dx%d' % size,
+               '--frames', str(n_frames), '--out', out]
+    if use_xvfb:
+        command = ['xvfb-run', '-a', '-s', '-screen 0 %dx%dx24 +extension GLX' % size] + command
+    env = dict(os.environ, **Gl_environment)
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    if process.returncode != 0 or os.path.getsize(out) == 0:
+        os.remove(out)
+        return {'paradigm': paradigm, 'size': list(size), 'error': output.decode(errors='replace')[-2000:]}
+    with open(out) as f:
+        result = json.load(f)
+    os.remove(out)
+    return result
+
+
+def table(results):
+    lines = ['%-20s %-10s %8s %9s %9s %9s %6s' % ('paradigm', 'size', 'fps', 'mean ms', 'jitter ms', 'p99 ms', 'long'),
+             '-' * 77]
+    for result in results:
+        size = '%dx%d' % tuple(result['size'])
+        if 'error' in result:
+            lines.append('%-20s %-10s failed: %s' % (result['paradigm'], size, (result['error'].strip().splitlines() or [''])[-1]))
+            continue
+        lines.append('%-20s %-10s %8.1f %9.3f %9.3f %9.3f %6d' %
+                     (result['paradigm'], size, result['fps'], result['interval_ms']['mean'], result['jitter_ms'],
+                      result['interval_ms']['p99'], result['long_frames']))
+    return lines
+
+
+
+
+if __name__ == "__main__":
+
+    def size(text):
+        return tuple(int(n) for n in text.lower().split('x'))
+
+    parser = argparse.ArgumentParser(description='Real OpenGL throughput of every paradigm under Xvfb.')
+    parser.add_argument('--paradigms', nargs='+', choices=Paradigms, default=Paradigms)
+    parser.add_argument('--sizes', nargs='+', type=size, default=Sizes, metavar='WxH')
+    parser.add_argument('--frames', type=int, default=Frames)
+    parser.add_argument('--no-xvfb', action='store_true', help='use the current display')
+    parser.add_argument('--out', default='bench_gl.json')
+    parser.add_argument('--worker', nargs=2, metavar=('PARADIGM', 'WxH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        runWorker(args.worker[0], size(args.worker[1]), args.frames, args.out)
+        sys.exit(0)
+
+    if not args.no_xvfb and not any(os.access(os.path.join(directory, 'xvfb-run'), os.X_OK)
+                                    for directory in os.environ.get('PATH', '').split(os.pathsep)):
+        parser.error('xvfb-run not found (install Xvfb, or use --no-xvfb on a machine with a display)')
+
+    results = []
+    for paradigm in args.paradigms:
+        for window_size in args.sizes:
+            results.append(runConfiguration(paradigm, window_size, args.frames, not args.no_xvfb))
+            print(table(results[-1:])[-1])
+
+    with open(args.out, 'w') as f:
+        json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                   'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'frames': args.frames, 'results': results},
+                  f, indent=1, sort_keys=True)
+    print('\n'.join(table(results)))
+    print('Results saved in %s' % args.out)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping benchmarks: clock checks
+
+Runs the real main() of every paradigm against the recording psychopy backend, with a
+window whose flips are paced at the display rate and stamped on a clock with another zero
+than globalClock, as psychopy's logging.defaultClock is. Everything the run saves must be
+in run time all the same; every check prints its result and the script exits with an error
+if one fails.
+
+    python benchmarks/check_clocks.py
+    python benchmarks/check_clocks.py --paradigms polar_angle --frames 240
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+
+Repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, Repo_dir)
+
+import mock_psychopy
+from bench_frames import loadScript
+from paradigms import Paradigms
+
+
+################################################################################################################
+## Constants
+
+Clock_offset = 1000.25                          # sec, flip clock at globalClock 0 (not a whole number of TRs)
+Frames = 180
+Flip_tolerance = 3                              # frame periods between a frame's run time and its flip
+Run_settings = {'Frame_journal': True, 'Color_change_cross': True, 'Color_change_rate': 1}
+Tr = 0.5                                        # sec, between two trigger keys of the TR-locked run
+
+
+################################################################################################################
+## Functions
+
+
+# Flips paced at the display rate and stamped on a clock Clock_offset sec ahead of the one first read
+class offsetWindow(mock_psychopy.Window):
+    def __init__(self, size, offset=Clock_offset):
+        mock_psychopy.Window.__init__(self, size)
+        self.offset = offset - time.time()
+
+    def flip(self, clearBuffer=True):
+        period = 1. / mock_psychopy.Refresh_rate
+        time.sleep(max(period - (time.time() % period), 0.))
+        mock_psychopy.Window.flip(self, clearBuffer)
+        return time.time() + self.offset
+
+
+# One run of main() for n_frames flips, in a run folder named as session.py names them
+def runScript(keys, paradigm, n_frames, overrides={}, clock=None, hooks=()):
+    suffixes = {'eccentricity': '_ecc', 'polar_angle': '_polAng', 'moving_bars': '_bars',
+                'eccentricity_polar': '_ecc_pol'}
+    path_out = os.path.join(tempfile.mkdtemp(prefix='check_clocks_'), 'check' + suffixes[paradigm]) + '/'
+    os.makedirs(path_out)
+    module = loadScript(paradigm, (320, 240), dict(Run_settings, **overrides), path_out)
+    module.Frame_locked_timing = False
+    keys.n_calls, keys.escape_after, keys.frame_hooks = 0, n_frames, list(hooks)
+    module.main(offsetWindow((320, 240)), mock_psychopy.Clock() if clock is None else clock)
+    return module, path_out
+
+
+# Journal flips in run time: every flip within a few frames after the run time its frame was drawn for
+def checkJournal(module, path_out):
+    from frame_journal import loadJournal
+    journal = np.asarray(loadJournal(path_out + module.Frame_journal_name))
+    lag = (journal['flip_time'] - journal['t']) * mock_psychopy.Refresh_rate
+    return len(journal) > 0 and lag.min() > -1. and lag.max() < Flip_tolerance, \
+        'flip - frame run time %.2f to %.2f frames over %d flips' % (lag.min(), lag.max(), len(journal))
+
+
+# Reaction time of a press 0.3 sec after a fixation colour change of the schedule: measured from the flip that
+# showed it, a few frames later
+def checkReactionTimes(module, path_out):
+    from clock_sync import alignEvents, fixationOnsets
+    from event_ring import Button_event_dtype
+    from frame_journal import loadJournal
+    from frame_schedule import compileSchedule
+    from paradigms import loadParameters
+
+    class runTimeSync(object):
+        run_zero = 0.
+        def deviceToRun(self, device_times):
+            return np.asarray(device_times, dtype=np.float64)
+
+    schedule = compileSchedule(module.__name__, loadParameters(module.__name__, **Run_settings), module.Refresh_rate)
+    journal = np.asarray(loadJournal(path_out + module.Frame_journal_name))
+    changes = fixationOnsets(schedule)
+    changes = changes[changes + 0.3 < journal['flip_time'][-1]]
+    if len(changes) == 0:
+        return False, 'no fixation colour change in %d flips' % len(journal)
+    press = np.zeros((1,), dtype=Button_event_dtype)
+    press['button'], press['state'], press['hw_time'] = 0, 1, changes[0] + 0.3
+    rt = alignEvents(press, runTimeSync(), schedule, journal)['rt'][0]
+    return 0.3 - Flip_tolerance / mock_psychopy.Refresh_rate < rt <= 0.3, \
+        'reaction time %.6f sec for a press 0.3 sec after the change' % rt
+
+
+# Replayed flips in run time, also from a journal and state log whose flips are on the other clock (runs recorded
+# before they were rebased): the first TR of the grid starts Pre_post_stimuli_fixation_time before the first flip
+def checkReplay(module, path_out):
+    import frame_journal
+    from paradigms import loadParameters
+    from replay import loadRun, trGrid
+    journal_path = path_out + module.Frame_journal_name
+    shifts = []
+    for offset in (0., Clock_offset):
+        if offset != 0.:
+            journal = np.array(frame_journal.loadJournal(journal_path))
+            journal['flip_time'] += offset
+            with open(journal_path, 'wb') as f:
+                f.write(frame_journal._header(frame_journal.Journal_dtype, len(journal)) + journal.tobytes())
+            if os.path.exists(path_out + module.State_log_name):
+                states = np.load(path_out + module.State_log_name)
+                states['flip_time'] += offset
+                np.save(path_out + module.State_log_name, states)
+        run = loadRun(path_out, module.__name__, loadParameters(module.__name__, **Run_settings))
+        origin, n_trs = trGrid(run, Tr)
+        shifts.append((run['onsets'][0] - origin - module.Pre_post_stimuli_fixation_time) * mock_psychopy.Refresh_rate)
+    return all(-1. < shift < Flip_tolerance for shift in shifts), \
+        'first flip %s frames after the fixation period of the TR grid' % ' / '.join('%.2f' % s for s in shifts)
+
+
+Checks = [('journal', checkJournal), ('reaction times', checkReactionTimes), ('replay', checkReplay)]
+
+
+# TR-locked run with a trigger key at every TR of run time: every trigger within two frames of its place on the grid
+def checkTrLocked(keys, paradigm, n_frames):
+    import re
+    from psychopy import logging
+    clock = mock_psychopy.Clock()
+    next_trigger = [Tr]
+
+    def triggerKey():
+        if clock.getTime() >= next_trigger[0]:
+            keys.pending.append('5')
+            next_trigger[0] += Tr
+
+    records = []
+    data = logging.data
+    logging.data = lambda message, *args, **kwargs: records.append(str(message))
+    try:
+        module, path_out = runScript(keys, paradigm, n_frames, {'Tr_locked_timing': True, 'Tr': Tr}, clock,
+                                     [triggerKey])
+    finally:
+        logging.data = data
+    shutil.rmtree(os.path.dirname(os.path.dirname(path_out)), ignore_errors=True)
+    summary = [record for record in records if record.startswith('TR-locked timing')]
+    match = re.search(r'(\d+) triggers.*error at trigger mean ([-+0-9.]+) ms / max \|([0-9.]+)\| ms', summary[-1]) \
+        if summary else None
+    if match is None:
+        return False, summary[-1] if summary else 'no TR-locked summary in the log'
+    return int(match.group(1)) > 0 and float(match.group(3)) < 2000. / mock_psychopy.Refresh_rate, \
+        '%s triggers, error at trigger mean %s ms / max %s ms' % match.groups()
+
+
+def runChecks(keys, paradigms, n_frames):
+    failed = 0
+    for paradigm in paradigms:
+        results = []
+        module, path_out = runScript(keys, paradigm, n_frames)
+        try:
+            for name, check in Checks:
+                results.append((name,) + check(module, path_out))
+        finally:
+            shutil.rmtree(os.path.dirname(os.path.dirname(path_out)), ignore_errors=True)
+        results.append(('TR-locked clock',) + checkTrLocked(keys, paradigm, n_frames))
+        for name, ok, text in results:
+            failed += not ok
+            print('%-20s %-16s %s  %s' % (paradigm, name, 'ok  ' if ok else 'FAIL', text))
+    return failed
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Check that runs save their flips and events in run time.')
+    parser.add_argument('--paradigms', nargs='+', choices=Paradigms, default=Paradigms)
+    parser.add_argument('--frames', type=int, default=Frames)
+    args = parser.parse_args()
+
+    keys = mock_psychopy.install()
+    failed = runChecks(keys, args.paradigms, args.frames)
+    if failed > 0:
+        sys.exit('%d checks failed' % failed)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping benchmarks: recording psychopy backend
+
+Stand-ins for the parts of psychopy (and pyglet.gl) the stimulus scripts use, with no
+display or OpenGL. Stimuli only record what is done to them: every attribute set, draw and
+setter call is counted in `counters`, so a benchmark can report the work done per frame.
+install() must run before a paradigm script is imported.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import collections
+import ctypes
+import sys
+import time
+import types
+
+
+################################################################################################################
+## Constants
+
+Refresh_rate = 60.                              # Hz of the simulated display (win.flip() timestamps)
+
+counters = collections.Counter()                # ('RadialStim', 'ori') -> sets, ('RadialStim', 'draw()') -> calls
+
+
+################################################################################################################
+## Functions
+
+
+class recordingStim(object):
+    def __init__(self, win=None, *args, **kwargs):
+        object.__setattr__(self, 'win', win)
+        for name, value in kwargs.items():
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, '_maskID', None)
+        object.__setattr__(self, 'autoDraw', kwargs.get('autoDraw', False))
+
+    def __setattr__(self, name, value):
+        counters[(type(self).__name__, name)] += 1
+        object.__setattr__(self, name, value)
+
+    def _called(self, method):
+        counters[(type(self).__name__, method + '()')] += 1
+
+    def draw(self, win=None):
+        self._called('draw')
+
+    def setMask(self, mask, log=None):
+        self._called('setMask')
+        object.__setattr__(self, 'mask', mask)
+
+    def setSize(self, size, log=None):
+        self._called('setSize')
+        object.__setattr__(self, 'size', size)
+
+    def setOri(self, ori, log=None):
+        self._called('setOri')
+        object.__setattr__(self, 'ori', ori)
+
+
+class RadialStim(recordingStim):
+    pass
+
+class GratingStim(recordingStim):
+    pass
+
+class ShapeStim(recordingStim):
+    pass
+
+class Circle(recordingStim):
+    pass
+
+class Line(recordingStim):
+    pass
+
+class TextStim(recordingStim):
+    pass
+
+class BufferImageStim(recordingStim):
+    pass
+
+class Aperture(recordingStim):
+    pass
+
+
+class Window(object):
+    def __init__(self, size=(1920,1080), *args, **kwargs):
+        self.size = tuple(size)
+        self.frameIntervals = []
+        self.recordFrameIntervals = False
+        self.nDroppedFrames = 0
+        self.flip_hooks = []                    # called after every flip
+        self._flip_time = 0.
+        self._on_flip = []
+
+    def flip(self, clearBuffer=True):
+        counters[('Window', 'flip()')] += 1
+        self._flip_time += 1. / Refresh_rate
+        if self.recordFrameIntervals:
+            self.frameIntervals.append(1. / Refresh_rate)
+        for function, args, kwargs in self._on_flip:
+            function(*args, **kwargs)
+        self._on_flip = []
+        for hook in self.flip_hooks:
+            hook()
+        return self._flip_time
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._on_flip.append((function, args, kwargs))
+
+    def getActualFrameRate(self, *args, **kwargs):
+        return Refresh_rate
+
+    def fps(self):
+        return Refresh_rate
+
+    def clearBuffer(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Clock(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self, newT=0.):
+        self._start = time.time() - newT
+
+    def getTime(self):
+        return time.time() - self._start
+
+
+class CountdownTimer(Clock):
+    def __init__(self, start=0):
+        Clock.__init__(self)
+        self._countdown = start
+
+    def getTime(self):
+        return self._countdown - Clock.getTime(self)
+
+
+# Keys: event.getKeys() is only called once per frame by the render loops
+class keyboard(object):
+    def __init__(self):
+        self.escape_after = None                # getKeys() calls before 'escape' is returned
+        self.frame_hooks = []                   # called at every getKeys(), i.e. at the end of every frame
+        self.pending = []                       # keys returned by the next getKeys()
+        self.n_calls = 0
+
+    def getKeys(self, *args, **kwargs):
+        self.n_calls += 1
+        for hook in self.frame_hooks:
+            hook()
+        if self.escape_after is not None and self.n_calls >= self.escape_after:
+            return ['escape']
+        keys, self.pending = self.pending, []
+        return keys
+
+    def waitKeys(self, *args, **kwargs):
+        return ['space']
+
+
+class logTarget(object):
+    def __init__(self, *args, **kwargs):
+        self.level = kwargs.get('level', 0)
+
+    def setLevel(self, level):
+        self.level = level
+
+    def write(self, text):
+        pass
+
+
+class rootLogger(object):
+    def __init__(self):
+        self.targets = []
+
+    def addTarget(self, target):
+        self.targets.append(target)
+
+    def removeTarget(self, target):
+        self.targets.remove(target)
+
+
+def _log(*args, **kwargs):
+    counters[('logging', 'records')] += 1
+
+
+def _noop(*args, **kwargs):
+    pass
+
+
+# GL calls of the mask bank
+class GLuint(ctypes.c_uint):
+    pass
+
+_texture_ids = [0]
+
+def _glGenTextures(n, texture_ids):
+    counters[('gl', 'glGenTextures()')] += 1
+    _texture_ids[0] += 1
+    texture_ids._obj.value = _texture_ids[0]
+
+def _glCall(name):
+    def call(*args):
+        counters[('gl', name + '()')] += 1
+    return call
+
+
+def install():
+    keys = keyboard()
+
+    psychopy = types.ModuleType('psychopy')
+    visual = types.ModuleType('psychopy.visual')
+    for cls in (Window, RadialStim, GratingStim, ShapeStim, Circle, Line, TextStim, BufferImageStim, Aperture):
+        setattr(visual, cls.__name__, cls)
+    event = types.ModuleType('psychopy.event')
+    event.getKeys, event.waitKeys, event.keyboard = keys.getKeys, keys.waitKeys, keys
+    core = types.ModuleType('psychopy.core')
+    core.Clock, core.CountdownTimer, core.wait, core.quit = Clock, CountdownTimer, _noop, _noop
+    logging = types.ModuleType('psychopy.logging')
+    logging.DATA, logging.EXP, logging.INFO, logging.WARNING, logging.ERROR = 25, 22, 20, 30, 40
+    logging.data = logging.exp = logging.info = logging.warning = logging.error = logging.log = _log
+    logging.setDefaultClock, logging.flush = _noop, _noop
+    logging.LogFile, logging.console, logging.root = logTarget, logTarget(), rootLogger()
+    gui = types.ModuleType('psychopy.gui')
+    psychopy.visual, psychopy.event, psychopy.core, psychopy.logging, psychopy.gui = visual, event, core, logging, gui
+    psychopy.prefs = 'prefs'
+
+    pyglet = types.ModuleType('pyglet')
+    gl = types.ModuleType('pyglet.gl')
+    gl.GLuint, gl.glGenTextures = GLuint, _glGenTextures
+    for name in ('glDeleteTextures', 'glBindTexture', 'glPixelStorei', 'glTexImage1D', 'glTexParameteri'):
+        setattr(gl, name, _glCall(name))
+    for i_constant, name in enumerate(('GL_TEXTURE_1D', 'GL_UNPACK_ALIGNMENT', 'GL_ALPHA', 'GL_UNSIGNED_BYTE',
+                                       'GL_TEXTURE_WRAP_S', 'GL_CLAMP', 'GL_LINEAR', 'GL_NEAREST',
+                                       'GL_TEXTURE_MAG_FILTER', 'GL_TEXTURE_MIN_FILTER')):
+        setattr(gl, name, i_constant)
+    pyglet.gl = gl
+
+    sys.modules.update({'psychopy': psychopy, 'psychopy.visual': visual, 'psychopy.event': event,
+                        'psychopy.core': core, 'psychopy.logging': logging, 'psychopy.gui': gui,
+                        'pyglet': pyglet, 'pyglet.gl': gl})
+    return keys
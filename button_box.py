@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: button box
+
+Monitoring of the VPixx button box (PROPixx controller DIN log) shared by every paradigm.
+The polling thread sleeps between two reads of the log, and backs off further while the
+log is idle, so it does not pin a core or fight the render loop for the GIL. On Windows,
+time.sleep() lasts at least one system timer period (15.6 ms by default), so the thread
+asks for a Timer_resolution ms period while it polls; the poll rate achieved is logged
+when it exits.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import sys
+import threading
+import time
+import numpy as np
+
+from event_ring import eventRing, monotonicNs, Ring_capacity
+
+
+################################################################################################################
+## Constants
+
+Button_coding = [-1,-2,-3,-4,-5]            #red,yellow,green,blue,white(i.e. trigger)
+Trigger_button = 4                          # index of the scanner trigger in Button_coding
+Trigger_state = 0                           # value of the trigger bit when a pulse arrives
+Poll_interval = 0.001                       # sec between two reads of the DIN log
+Poll_interval_idle = 0.004                  # sec, longest interval once the log is idle
+Idle_backoff = 2.                           # interval growth at every idle read
+Trigger_history = 64                        # latest triggers kept for waitTrigger(after=...)
+Timer_resolution = 1                        # ms, Windows timer period requested while polling (sleep granularity)
+Simulated_dpx = False                       # Simulated DIN device (dpx_sim) instead of pypixxlib
+
+Din_event_dtype = np.dtype([
+    ('button', np.int8),                    # index in Button_coding
+    ('state', np.int8),                     # new value of the button {0,1}
+    ('hw_time', np.float64),                # DIN log timestamp (device clock, sec)
+])
+
+
+################################################################################################################
+## Functions
+
+
+def loadDpx():
+    if Simulated_dpx:
+        import dpx_sim
+        return dpx_sim
+    from pypixxlib import _libdpx
+    return _libdpx
+
+
+# (DIN log time, monotonic ns) of the first trigger after trigger number `after` (the oldest one kept if it is gone)
+def triggerAfter(hw_times, mono_ns, trigger_count, after):
+    i_trigger = max(after, trigger_count - Trigger_history) % Trigger_history
+    return (float(hw_times[i_trigger]), int(mono_ns[i_trigger]))
+
+
+# Decode a whole DPxReadDinLog result: masked words -> button bits -> transitions
+def decodeDinLog(data_list, mask, button_coding, previous_state):
+    din_log = np.asarray(data_list, dtype=np.float64).reshape((-1,2))
+    words = din_log[:,1].astype(np.int64) ^ mask
+    shifts = -np.asarray(button_coding, dtype=np.int64) - 1
+
+    # One row per log frame, starting from the state before this read
+    states = np.empty((len(words)+1, len(shifts)), dtype=np.int8)
+    states[0] = previous_state
+    states[1:] = (words[:,None] >> shifts[None,:]) & 1
+    changed = states[1:] != states[:-1]
+
+    i_frame, i_button = np.nonzero(changed)
+    events = np.empty((len(i_frame),), dtype=Din_event_dtype)
+    events['button'] = i_button
+    events['state'] = states[1:][i_frame, i_button]
+    events['hw_time'] = din_log[i_frame, 0]
+    return events, states[-1]
+
+
+def _thread_time():
+    return time.thread_time() if hasattr(time, 'thread_time') else time.process_time()
+
+
+# Windows: raise the system timer resolution (timeBeginPeriod), returns what endTimerResolution() needs
+def beginTimerResolution(period=Timer_resolution):
+    if sys.platform != 'win32':
+        return None
+    import ctypes
+    winmm = ctypes.WinDLL('winmm')
+    if winmm.timeBeginPeriod(period) != 0:          # TIMERR_NOERROR
+        return None
+    return winmm, period
+
+
+def endTimerResolution(timer):
+    if timer is not None:
+        winmm, period = timer
+        winmm.timeEndPeriod(period)
+
+
+class pollStatistics(object):
+    def __init__(self):
+        self.n_polls = 0
+        self.n_reads = 0
+        self.n_log_frames = 0
+        self.latencies = []                 # sec from the hardware timestamp to the read
+        self.wall_start = self.cpu_start = 0.
+        self.wall_time = self.cpu_time = 0.
+
+    def start(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = _thread_time()
+
+    def stop(self):
+        self.wall_time = time.perf_counter() - self.wall_start
+        self.cpu_time = _thread_time() - self.cpu_start
+
+    def report(self):
+        wall_time = max(self.wall_time, 1e-9)
+        text = 'Button box polling: %d polls in %.3f sec (%.1f Hz), CPU time %.3f sec (%.1f%% of a core), %d log frames' % \
+            (self.n_polls, self.wall_time, self.n_polls/wall_time, self.cpu_time, 100.*self.cpu_time/wall_time,
+             self.n_log_frames)
+        if len(self.latencies) > 0:
+            latencies = np.asarray(self.latencies) * 1000.
+            text += ', detection latency median %.3f ms / 95th %.3f ms / max %.3f ms' % \
+                (np.median(latencies), np.percentile(latencies, 95), latencies.max())
+        return text
+
+
+class buttonBoxThread(threading.Thread):
+    def __init__(self, thread_id, name, is_mri=0, button_coding=Button_coding, poll_interval=Poll_interval,
+                 poll_interval_idle=Poll_interval_idle, measure=False, ring_capacity=Ring_capacity, dpx=None, log=None,
+                 sync_interval=None):
+        threading.Thread.__init__(self)
+
+        self.dpx = loadDpx() if dpx is None else dpx
+        if log is None:
+            from psychopy import logging
+            log = logging.data
+        self.log = log
+
+        self.stimulus_onset_time = 0
+        self.local_status = 0
+        self.mask = 0x0000 if is_mri == 0  else 0x001f
+        self.button_coding = button_coding
+
+        # Polling engine
+        self.poll_interval = poll_interval
+        self.poll_interval_idle = max(poll_interval_idle, poll_interval)
+        self.measure = measure
+        self.statistics = pollStatistics()
+
+        # Device clock samples, to put the DIN log timestamps in run time (None: no sync)
+        self.clock_sync = None
+        if sync_interval is not None:
+            from clock_sync import clockSync
+            self.clock_sync = clockSync(self.dpx, interval=sync_interval)
+
+        # Open comunication with Vpixx
+        self.dpx.DPxOpen()
+
+        #Select the correct device
+        self.dpx.DPxSelectDevice('PROPixxCtrl')
+        self.dpx.DPxSetMarker()
+        self.stimulus_onset_time = self.dpx.DPxGetMarker()
+        self.dpx.DPxEnableDinDebounce()              # Filter out button bounce
+        self.local_status = self.dpx.DPxSetDinLog()        # Configure logging with default values
+        self.dpx.DPxStartDinLog()
+        self.dpx.DPxUpdateRegCache()
+
+        # Thread infos
+        self.thread_id = thread_id
+        self.name = name
+
+        # Every button has: its value {0,1} and time when it changed (DIN log timestamp, sec)
+        self.button_state = {'time': np.zeros((5,)), 'state': np.zeros((5,),dtype=np.int8)}
+        self.button_state['state'][-1] = 1
+
+        # Every transition, in order (written by this thread only)
+        self.events = eventRing(ring_capacity)
+
+        # Scanner triggers: count, and (DIN log time, monotonic ns) of the last one and of the latest ones
+        self.trigger_count = 0
+        self.last_trigger = None
+        self.trigger_hw_times = np.zeros((Trigger_history,))
+        self.trigger_mono_ns = np.zeros((Trigger_history,), dtype=np.int64)
+        self._trigger = threading.Condition()
+
+        self._stop_event = threading.Event()
+
+    def run(self):
+        dpx = self.dpx
+        self.log("Starting " + self.name)
+
+        initial_values = dpx.DPxGetDinValue()
+        self.log('Initial button box digital input states = ' + "{0:016b}".format(initial_values) + " (int=%d)" % initial_values)
+
+        interval = self.poll_interval
+        statistics = self.statistics
+        clock_sync = self.clock_sync
+        timer = beginTimerResolution()
+        statistics.start()
+        try:
+            while(not self.stopped()):
+                dpx.DPxUpdateRegCache()
+                dpx.DPxGetDinStatus(self.local_status)
+                statistics.n_polls += 1
+
+                if self.local_status['newLogFrames'] > 0 :           #Something happened
+                    data_list = dpx.DPxReadDinLog(self.local_status)
+                    statistics.n_log_frames += len(data_list)
+                    if self.measure:
+                        self._measureLatency(data_list)
+                    self.button_state = self.updateStateButton(self.button_state,data_list)
+                    interval = self.poll_interval
+                else:
+                    interval = min(interval * Idle_backoff, self.poll_interval_idle)
+
+                if clock_sync is not None and clock_sync.due():
+                    clock_sync.sample()
+                time.sleep(interval)
+        finally:
+            statistics.stop()
+            endTimerResolution(timer)
+
+        self.log(statistics.report())
+        self.log("Exiting " + self.name)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    # Block until a trigger newer than trigger number `after` arrives (None after timeout).
+    # Returns (DIN log time, monotonic ns) of the first trigger after it, even if more came meanwhile.
+    def waitTrigger(self, timeout=None, after=None):
+        with self._trigger:
+            if after is None:
+                after = self.trigger_count
+            if not self._trigger.wait_for(lambda: self.trigger_count > after, timeout):
+                return None
+            return triggerAfter(self.trigger_hw_times, self.trigger_mono_ns, self.trigger_count, after)
+
+    # Seconds elapsed since a trigger returned by waitTrigger()
+    def sinceTrigger(self, trigger):
+        return (monotonicNs() - trigger[1]) / 1e9
+
+    def _pushEvents(self, events, mono_ns):
+        ring_events = np.empty((len(events),), dtype=self.events.events.dtype)
+        ring_events['button'] = events['button']
+        ring_events['state'] = events['state']
+        ring_events['hw_time'] = events['hw_time']
+        ring_events['mono_ns'] = mono_ns
+        self.events.push(ring_events)
+
+    def _measureLatency(self, data_list):
+        dpx = self.dpx
+        dpx.DPxUpdateRegCache()
+        now = dpx.DPxGetTime()
+        self.statistics.n_reads += 1
+        self.statistics.latencies.extend(now - entry[0] for entry in data_list)
+
+    # Take in input a state and check what is changed
+    def updateStateButton(self,button_state,data_list):
+        events, last_state = decodeDinLog(data_list, self.mask, self.button_coding, button_state['state'])
+        if len(events) == 0:
+            return button_state
+        mono_ns = monotonicNs()
+        self._pushEvents(events, mono_ns)
+
+        triggers = events[(events['button'] == Trigger_button) & (events['state'] == Trigger_state)]
+        if len(triggers) > 0:
+            with self._trigger:
+                for hw_time in triggers['hw_time']:
+                    self.trigger_hw_times[self.trigger_count % Trigger_history] = hw_time
+                    self.trigger_mono_ns[self.trigger_count % Trigger_history] = mono_ns
+                    self.trigger_count += 1
+                self.last_trigger = (float(triggers['hw_time'][-1]), mono_ns)
+                self._trigger.notify_all()
+
+        # Time of the last transition of every button that changed
+        latest = events[::-1]
+        _, i_latest = np.unique(latest['button'], return_index=True)
+        button_state['time'][latest['button'][i_latest]] = latest['hw_time'][i_latest]
+        button_state['state'][:] = last_state
+
+        return button_state
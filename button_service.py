@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: button box service
+
+The button box polling of button_box.buttonBoxThread, run in a separate process (pinned to
+its own core) so it never holds the render loop's GIL. The process publishes the button
+state and the scanner triggers in shared memory under a seqlock, and the button events in
+a shared event ring: the render loop reads them in O(1) with no system call and no lock.
+buttonBoxService has the interface of buttonBoxThread (start, stop, join, waitTrigger,
+sinceTrigger, trigger_count, button_state, events) and is a drop-in replacement for it.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import importlib
+import multiprocessing
+import os
+import queue
+import time
+import types
+import numpy as np
+from multiprocessing import shared_memory
+
+from button_box import Button_coding, Poll_interval, Poll_interval_idle, Trigger_history, buttonBoxThread
+from button_box import triggerAfter
+from clock_sync import clockSync, Sync_capacity, Sync_sample_dtype
+from event_ring import eventRing, monotonicNs, Ring_capacity, Button_event_dtype
+
+
+################################################################################################################
+## Constants
+
+Service_cpu = -1                                # core of the polling process, index in the usable cores (None: not pinned)
+Start_timeout = 10.                             # sec for the process to open the device
+
+Service_state_dtype = np.dtype([
+    ('sequence', np.int64),                     # seqlock: odd while the process writes
+    ('written', np.int64),                      # events ever written in the ring
+    ('reserved', np.int64),                     # events ever written or being written (eventRing.reserved)
+    ('sync_written', np.int64),                 # device clock samples ever written
+    ('sync_reserved', np.int64),
+    ('trigger_count', np.int64),
+    ('trigger_hw_time', np.float64),            # DIN log time of the last trigger
+    ('trigger_mono_ns', np.int64),              # host monotonic clock when it was decoded
+    ('trigger_hw_times', np.float64, (Trigger_history,)),   # latest triggers, trigger number % Trigger_history
+    ('trigger_mono_ns_history', np.int64, (Trigger_history,)),
+    ('button_time', np.float64, (len(Button_coding),)),
+    ('button_state', np.int8, (len(Button_coding),)),
+    ('stop', np.int8),
+])
+Ring_offset = 64 * ((Service_state_dtype.itemsize + 63) // 64)
+
+
+################################################################################################################
+## Functions
+
+
+def _sharedSize(capacity):
+    return Ring_offset + capacity*Button_event_dtype.itemsize + Sync_capacity*Sync_sample_dtype.itemsize
+
+
+def _sharedViews(buffer, capacity):
+    state = np.ndarray((), dtype=Service_state_dtype, buffer=buffer)
+    events = np.ndarray((capacity,), dtype=Button_event_dtype, buffer=buffer, offset=Ring_offset)
+    sync_samples = np.ndarray((Sync_capacity,), dtype=Sync_sample_dtype, buffer=buffer,
+                              offset=Ring_offset + capacity*Button_event_dtype.itemsize)
+    return state, events, sync_samples
+
+
+# Event ring whose rows and write counts live in shared memory (single writer: the service process)
+class sharedEventRing(eventRing):
+    def __init__(self, state, events, counter='written'):
+        self.capacity = len(events)
+        self.events = events
+        self._state = state
+        self._counter = counter
+        self._reserve_counter = counter.replace('written', 'reserved')
+
+    @property
+    def written(self):
+        return int(self._state[self._counter])
+
+    @written.setter
+    def written(self, value):
+        self._state[self._counter] = value
+
+    @property
+    def reserved(self):
+        return int(self._state[self._reserve_counter])
+
+    @reserved.setter
+    def reserved(self, value):
+        self._state[self._reserve_counter] = value
+
+
+# Runs in the service process: the polling thread, publishing to shared memory
+class _publishingThread(buttonBoxThread):
+    def __init__(self, state, events, sync_samples, trigger_signal, **options):
+        buttonBoxThread.__init__(self, **options)
+        self._state = state
+        self._trigger_signal = trigger_signal
+        self.events = sharedEventRing(state, events)
+        if self.clock_sync is not None:
+            self.clock_sync.samples = sharedEventRing(state, sync_samples, 'sync_written')
+        self._publish()
+
+    def stopped(self):
+        return self._state['stop'] != 0
+
+    def updateStateButton(self, button_state, data_list):
+        button_state = buttonBoxThread.updateStateButton(self, button_state, data_list)
+        self._publish()
+        return button_state
+
+    # Seqlock write: readers retry while the sequence is odd or changed under them
+    def _publish(self):
+        state = self._state
+        new_trigger = state['trigger_count'] != self.trigger_count
+        state['sequence'] += 1
+        state['trigger_count'] = self.trigger_count
+        if self.last_trigger is not None:
+            state['trigger_hw_time'], state['trigger_mono_ns'] = self.last_trigger
+        if new_trigger:
+            state['trigger_hw_times'] = self.trigger_hw_times
+            state['trigger_mono_ns_history'] = self.trigger_mono_ns
+        state['button_time'] = self.button_state['time']
+        state['button_state'] = self.button_state['state']
+        state['sequence'] += 1
+        if new_trigger:
+            with self._trigger_signal:
+                self._trigger_signal.notify_all()
+
+
+def _serve(shm_name, capacity, options, messages, trigger_signal, cpu):
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cores[cpu]})
+    shm = shared_memory.SharedMemory(name=shm_name)
+    state, events, sync_samples = _sharedViews(shm.buf, capacity)
+    try:
+        if isinstance(options['dpx'], str):
+            options['dpx'] = importlib.import_module(options['dpx'])
+        thread = _publishingThread(state, events, sync_samples, trigger_signal,
+                                   log=lambda text: messages.put(('log', text)), **options)
+    except Exception as e:
+        messages.put(('error', '%s: %s' % (type(e).__name__, e)))
+        return
+    messages.put(('ready', os.getpid()))
+    try:
+        thread.run()
+    finally:
+        del thread, state, events, sync_samples
+        shm.close()
+
+
+class buttonBoxService(object):
+    def __init__(self, thread_id, name, is_mri=0, button_coding=Button_coding, poll_interval=Poll_interval,
+                 poll_interval_idle=Poll_interval_idle, measure=False, ring_capacity=Ring_capacity, dpx=None, log=None,
+                 sync_interval=None, cpu=Service_cpu):
+        if log is None:
+            from psychopy import logging
+            log = logging.data
+        self.log = log
+        self.thread_id = thread_id
+        self.name = name
+        self.cpu = cpu
+        self.pid = None
+
+        self._shm = shared_memory.SharedMemory(create=True, size=_sharedSize(ring_capacity))
+        self._state, events, sync_samples = _sharedViews(self._shm.buf, ring_capacity)
+        self._state[()] = 0
+        self.events = sharedEventRing(self._state, events)
+        self.clock_sync = None
+        if sync_interval is not None:
+            self.clock_sync = clockSync(samples=sharedEventRing(self._state, sync_samples, 'sync_written'))
+
+        # The device is opened in the service process (spawned: no GL or psychopy state is inherited).
+        # A dpx module (pypixxlib._libdpx, dpx_sim) cannot be pickled: the process imports it by name
+        if isinstance(dpx, types.ModuleType):
+            dpx = dpx.__name__
+        options = dict(thread_id=thread_id, name=name, is_mri=is_mri, button_coding=button_coding,
+                       poll_interval=poll_interval, poll_interval_idle=poll_interval_idle, measure=measure,
+                       ring_capacity=1, dpx=dpx, sync_interval=sync_interval)
+        context = multiprocessing.get_context('spawn')
+        self._messages = context.Queue()
+        self._trigger_signal = context.Condition()          # notified by the process at every new trigger
+        self._process = context.Process(target=_serve, name=name, args=(self._shm.name, ring_capacity, options,
+                                                                        self._messages, self._trigger_signal, cpu))
+        self._process.daemon = True
+
+    # Returns once the process has opened the device and started polling
+    def start(self):
+        self._process.start()
+        deadline = time.time() + Start_timeout
+        kind, value = 'error', 'no answer from the process'
+        while self._process.is_alive() and time.time() < deadline:
+            try:
+                kind, value = self._messages.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        if kind == 'error':
+            self.stop()
+            self._process.join()
+            self._release()
+            raise RuntimeError('Button box service could not start: ' + value)
+        self.pid = value
+
+    def stop(self):
+        self._state['stop'] = 1
+
+    def stopped(self):
+        return self._state['stop'] != 0
+
+    def is_alive(self):
+        return self._process.is_alive()
+
+    # Wait for the process, forward its log records and keep a private copy of the state and events
+    def join(self, timeout=None):
+        self._process.join(timeout)
+        if self._process.is_alive():
+            return
+        while not self._messages.empty():
+            kind, value = self._messages.get()
+            if kind == 'log':
+                self.log(value)
+        self._release()
+
+    def _release(self):
+        if self._shm is None:
+            return
+        self._state = self._state.copy()
+        self.events.events = self.events.events.copy()
+        self.events._state = self._state
+        if self.clock_sync is not None:
+            self.clock_sync.samples.events = self.clock_sync.samples.events.copy()
+            self.clock_sync.samples._state = self._state
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    # Consistent copy of the shared state (seqlock read)
+    def snapshot(self):
+        state = self._state
+        while True:
+            sequence = int(state['sequence'])
+            if sequence & 1:
+                continue
+            copy = state.copy()
+            if int(state['sequence']) == sequence:
+                return copy
+
+    @property
+    def trigger_count(self):
+        return int(self._state['trigger_count'])
+
+    @property
+    def last_trigger(self):
+        state = self.snapshot()
+        if state['trigger_count'] == 0:
+            return None
+        return (float(state['trigger_hw_time']), int(state['trigger_mono_ns']))
+
+    @property
+    def button_state(self):
+        state = self.snapshot()
+        return {'time': state['button_time'], 'state': state['button_state']}
+
+    # Block until a trigger newer than trigger number `after` arrives (None after timeout).
+    # Returns (DIN log time, monotonic ns) of the first trigger after it, even if more came meanwhile.
+    def waitTrigger(self, timeout=None, after=None):
+        with self._trigger_signal:
+            if after is None:
+                after = self.trigger_count
+            if not self._trigger_signal.wait_for(lambda: self.trigger_count > after, timeout):
+                return None
+        state = self.snapshot()
+        return triggerAfter(state['trigger_hw_times'], state['trigger_mono_ns_history'], state['trigger_count'], after)
+
+    # Seconds elapsed since a trigger returned by waitTrigger()
+    def sinceTrigger(self, trigger):
+        return (monotonicNs() - trigger[1]) / 1e9
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: device clock synchronisation
+
+Maps the DIN log timestamps of the VPixx device clock into run time (the globalClock the
+flips are stamped with). The button box thread samples the device clock at regular
+intervals, bracketed by two reads of the host monotonic clock; the samples with the
+shortest round trip give the offset and drift of the device against the host, and an
+anchor taken right after globalClock.reset() gives the host time of run time 0. Button
+presses and scanner triggers then get their run time from the hardware timestamp, not from
+when the poll decoded them, and reaction times are measured from the flip that changed the
+fixation colour.
+
+    python clock_sync.py --drift-ppm 50 --seconds 5     # check against a simulated drifting device clock
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import argparse
+import numpy as np
+
+from button_box import Trigger_button, Trigger_state
+from event_ring import eventRing, monotonicNs
+
+
+################################################################################################################
+## Constants
+
+Sync_interval = 1.                              # sec between two device clock samples
+Sync_reads = 5                                  # reads per sample, the shortest round trip is kept
+Sync_capacity = 4096                            # samples kept (over an hour at 1 Hz)
+Fit_samples = 120                               # latest samples used by the fit
+Press_state = 1                                 # value of a response button bit when pressed (released: 0)
+
+Sync_sample_dtype = np.dtype([
+    ('host', np.float64),                       # host monotonic clock, middle of the read (sec)
+    ('device', np.float64),                     # device clock (sec)
+    ('round_trip', np.float64),                 # host time spent reading (sec)
+])
+
+Aligned_event_dtype = np.dtype([
+    ('button', np.int8),                        # index in Button_coding
+    ('state', np.int8),                         # new value of the button {0,1}
+    ('hw_time', np.float64),                    # DIN log timestamp (device clock, sec)
+    ('run_time', np.float64),                   # hw_time in run time (globalClock, sec)
+    ('decode_time', np.float64),                # when the poll decoded it, in run time (sec)
+    ('rt', np.float64),                         # presses: sec since the last fixation colour change (nan otherwise)
+])
+
+
+################################################################################################################
+## Functions
+
+
+class clockSync(object):
+    def __init__(self, dpx=None, interval=Sync_interval, reads=Sync_reads, capacity=Sync_capacity, samples=None):
+        self.dpx = dpx
+        self.interval_ns = int(interval * 1e9)
+        self.reads = reads
+        self.samples = eventRing(capacity, Sync_sample_dtype) if samples is None else samples
+        self.anchors = []                       # (host time of run time 0, round trip)
+        self.run_zero = 0.
+        self._next_ns = 0
+
+    # Device side, on the thread that owns the device
+    def due(self):
+        return monotonicNs() >= self._next_ns
+
+    def sample(self):
+        dpx = self.dpx
+        best = None
+        for i_read in range(self.reads):
+            before = monotonicNs()
+            dpx.DPxUpdateRegCache()
+            after = monotonicNs()
+            if best is None or after - before < best[2]:
+                best = (before, after, after - before, dpx.DPxGetTime())
+        before, after, round_trip, device = best
+        sample = np.empty((1,), dtype=Sync_sample_dtype)
+        sample['host'] = (before + after) * 0.5e-9
+        sample['device'] = device
+        sample['round_trip'] = round_trip * 1e-9
+        self.samples.push(sample)
+        self._next_ns = after + self.interval_ns
+        return sample[0]
+
+    # Host side: run time 0 of `clock` on the host monotonic clock (call right after clock.reset())
+    def anchor(self, clock):
+        best = None
+        for i_read in range(self.reads):
+            before = monotonicNs()
+            clock_time = clock.getTime()
+            after = monotonicNs()
+            if best is None or after - before < best[1]:
+                best = ((before + after) * 0.5e-9 - clock_time, after - before)
+        self.run_zero = best[0]
+        self.anchors.append((best[0], best[1] * 1e-9))
+        return self.run_zero
+
+    # host = offset + slope * (device - device_0), from the samples with the shortest round trips
+    def fit(self, n_samples=Fit_samples):
+        samples = self.samples.snapshot()[-n_samples:]
+        if len(samples) == 0:
+            raise ValueError('No device clock sample yet')
+        samples = samples[samples['round_trip'] <= 2. * np.median(samples['round_trip'])]
+        device_0 = samples['device'][0]
+        if len(samples) < 2:
+            return device_0, samples['host'][0], 1.
+        slope, offset = np.polyfit(samples['device'] - device_0, samples['host'], 1)
+        return device_0, offset, slope
+
+    def deviceToHost(self, device_times):
+        device_0, offset, slope = self.fit()
+        return offset + slope * (np.asarray(device_times, dtype=np.float64) - device_0)
+
+    def deviceToRun(self, device_times):
+        return self.deviceToHost(device_times) - self.run_zero
+
+    def summary(self):
+        samples = self.samples.snapshot()[-Fit_samples:]
+        if len(samples) == 0:
+            return 'Clock sync: no device clock sample'
+        device_0, offset, slope = self.fit()
+        residuals = samples['host'] - (offset + slope * (samples['device'] - device_0))
+        text = ('Clock sync: %d samples, device clock %+.6f sec from the host, drift %+.2f ppm, residuals %.1f us rms, '
+                'round trip median %.1f us') % \
+            (len(samples), device_0 - offset, (1. / slope - 1.) * 1e6, np.sqrt(np.mean(residuals**2)) * 1e6,
+             np.median(samples['round_trip']) * 1e6)
+        if len(self.anchors) >= 2:
+            text += ', run clock moved %.1f us between the last two anchors' % \
+                ((self.anchors[-1][0] - self.anchors[-2][0]) * 1e6)
+        return text
+
+
+# Run time of the flips that changed the fixation colour (journal flips, or nominal schedule times)
+def fixationOnsets(schedule, journal=None):
+    if journal is not None and len(journal) > 1:
+        colors = schedule['fixation_color'][journal['i_frame']]
+        return np.asarray(journal['flip_time'][1:][colors[1:] != colors[:-1]], dtype=np.float64)
+    colors = schedule['fixation_color']
+    return schedule['time'][1:][colors[1:] != colors[:-1]]
+
+
+# Button events (event_ring rows) of a run, in run time, with the reaction time of every press
+def alignEvents(events, sync, schedule, journal=None):
+    aligned = np.zeros((len(events),), dtype=Aligned_event_dtype)
+    aligned['rt'] = np.nan
+    if len(events) == 0:
+        return aligned
+    aligned['button'] = events['button']
+    aligned['state'] = events['state']
+    aligned['hw_time'] = events['hw_time']
+    aligned['run_time'] = sync.deviceToRun(events['hw_time'])
+    aligned['decode_time'] = events['mono_ns'] * 1e-9 - sync.run_zero
+
+    presses = np.nonzero((aligned['button'] != Trigger_button) & (aligned['state'] == Press_state))[0]
+    onsets = fixationOnsets(schedule, journal)
+    i_onset = np.searchsorted(onsets, aligned['run_time'][presses], side='right') - 1
+    presses, i_onset = presses[i_onset >= 0], i_onset[i_onset >= 0]
+    aligned['rt'][presses] = aligned['run_time'][presses] - onsets[i_onset]
+    return aligned
+
+
+def isTrigger(aligned):
+    return (aligned['button'] == Trigger_button) & (aligned['state'] == Trigger_state)
+
+
+# Device clock running at (1 + drift) the host rate, with a read latency, for checks without the device
+class simulatedDeviceClock(object):
+    def __init__(self, offset=0., drift_ppm=0., read_latency=20e-6, seed=0):
+        self.offset = offset
+        self.drift = drift_ppm * 1e-6
+        self.read_latency = read_latency
+        self.origin = monotonicNs() * 1e-9
+        self.random = np.random.RandomState(seed)
+        self._cached = 0.
+
+    def deviceTime(self, host):
+        return self.offset + (host - self.origin) * (1. + self.drift)
+
+    def DPxUpdateRegCache(self):
+        start = monotonicNs() * 1e-9
+        latch = start + self.random.uniform(0., self.read_latency)
+        while monotonicNs() * 1e-9 < start + self.read_latency:
+            pass
+        self._cached = self.deviceTime(latch)
+
+    def DPxGetTime(self):
+        return self._cached
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Check the clock sync against a simulated drifting device clock.')
+    parser.add_argument('--drift-ppm', type=float, default=50.)
+    parser.add_argument('--offset', type=float, default=1234.5, help='device clock at start (sec)')
+    parser.add_argument('--seconds', type=float, default=5.)
+    parser.add_argument('--interval', type=float, default=0.05, help='sec between two samples')
+    args = parser.parse_args()
+
+    import time
+    device = simulatedDeviceClock(args.offset, args.drift_ppm)
+    sync = clockSync(device, interval=args.interval)
+    end = time.time() + args.seconds
+    while time.time() < end:
+        if sync.due():
+            sync.sample()
+        time.sleep(args.interval / 10.)
+    print(sync.summary())
+
+    host = monotonicNs() * 1e-9 - np.random.uniform(0., args.seconds, 1000)
+    errors = (sync.deviceToHost(device.deviceTime(host)) - host) * 1e6
+    print('Mapping error over the last %.1f sec: mean %.1f us, max |%.1f| us' %
+          (args.seconds, errors.mean(), np.abs(errors).max()))
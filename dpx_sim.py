@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: simulated VPixx DIN device
+
+Stand-in for the pypixxlib._libdpx functions the button box uses (DPxOpen, DPxSetDinLog,
+DPxGetDinStatus, DPxReadDinLog, DPxGetMarker, ...), so buttonBoxThread can run and be
+measured without the PROPixx controller. The device clock is simulatedDeviceClock (offset,
+drift, read latency); its DIN log is filled with scanner trigger trains at a given TR,
+bursts of button presses, contact bounce and, for IsMRI, inverted bit polarities. The log
+buffer has a fixed size: frames not read in time are overwritten and counted.
+
+The module can replace _libdpx as is (set Simulated_dpx in button_box.py), or a configured
+simulatedDpx can be passed to buttonBoxThread(dpx=...). The load test runs the polling
+thread at increasing press rates and reports the decoder throughput, the events lost and
+the detection latency:
+
+    python dpx_sim.py --rates 10 100 1000 10000 --duration 5 --out dpx_load.json
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import argparse
+import json
+import time
+import numpy as np
+
+from button_box import buttonBoxThread, decodeDinLog, Button_coding, Trigger_button
+from clock_sync import simulatedDeviceClock, Press_state
+
+
+################################################################################################################
+## Constants
+
+Tr = 2.                                         # sec between two scanner triggers (None: no trigger)
+First_trigger = 0.5                             # sec from the start of the log to the first trigger
+Trigger_pulse = 0.005                           # sec the trigger bit stays active
+Response_rate = 0.5                             # presses per sec (Poisson), over the response buttons
+Burst_size = 1                                  # presses per burst
+Burst_spacing = 0.2                             # sec between two presses of a burst
+Press_duration = 0.12                           # sec a button stays pressed
+Bounce_probability = 0.                         # chance that a transition bounces
+Bounce_count = 3                                # extra toggle pairs of a bounce
+Bounce_spacing = 0.0005                         # sec between two bounce toggles
+Debounce_time = 0.03                            # sec a bit is held after a transition, once DPxEnableDinDebounce()
+Duration = 1800.                                # sec of generated traffic
+Log_capacity = 2**16                            # DIN log frames the device keeps
+Is_mri = 0                                      # invert the raw bit polarities (decode with IsMRI = 1)
+
+Load_rates = [10, 100, 1000, 10000]             # presses per sec of the load test
+Load_duration = 5.                              # sec per rate
+Reader_rate = 60.                               # Hz, drains of the event ring (render loop)
+
+Dpx_functions = ['DPxSelectDevice', 'DPxSetMarker', 'DPxGetMarker', 'DPxEnableDinDebounce', 'DPxDisableDinDebounce',
+                 'DPxSetDinLog', 'DPxStartDinLog', 'DPxStopDinLog', 'DPxUpdateRegCache', 'DPxGetDinValue',
+                 'DPxGetDinStatus', 'DPxReadDinLog', 'DPxGetTime', 'DPxClose']
+
+
+################################################################################################################
+## Functions
+
+
+# Transitions a device with debounce reports: after a change the bit is held for `window`,
+# then the actual level is reported if it differs
+def _debounce(times, values, initial, window):
+    kept_times, kept_values = [], []
+    reported = actual = initial
+    held_until = -np.inf
+    for t, value in zip(times, values):
+        if t >= held_until and actual != reported:
+            kept_times.append(held_until)
+            kept_values.append(actual)
+            reported = actual
+            held_until += window
+        actual = value
+        if t >= held_until and actual != reported:
+            kept_times.append(t)
+            kept_values.append(actual)
+            reported = actual
+            held_until = t + window
+    if actual != reported:
+        kept_times.append(held_until)
+        kept_values.append(actual)
+    return np.asarray(kept_times, dtype=np.float64), np.asarray(kept_values, dtype=np.int8)
+
+
+class simulatedDpx(object):
+    def __init__(self, tr=Tr, first_trigger=First_trigger, trigger_pulse=Trigger_pulse, response_rate=Response_rate,
+                 burst_size=Burst_size, burst_spacing=Burst_spacing, press_duration=Press_duration,
+                 bounce_probability=Bounce_probability, bounce_count=Bounce_count, bounce_spacing=Bounce_spacing,
+                 debounce_time=Debounce_time, duration=Duration, log_capacity=Log_capacity, is_mri=Is_mri,
+                 button_coding=Button_coding, offset=0., drift_ppm=0., read_latency=20e-6, seed=0):
+        self.tr = tr
+        self.first_trigger = first_trigger
+        self.trigger_pulse = trigger_pulse
+        self.response_rate = response_rate
+        self.burst_size = burst_size
+        self.burst_spacing = burst_spacing
+        self.press_duration = press_duration
+        self.bounce_probability = bounce_probability
+        self.bounce_count = bounce_count
+        self.bounce_spacing = bounce_spacing
+        self.debounce_time = debounce_time
+        self.duration = duration
+        self.log_capacity = log_capacity
+        self.raw_mask = 0x001f if is_mri else 0x0000
+        self.bits = -np.asarray(button_coding, dtype=np.int64) - 1
+        self.clock = simulatedDeviceClock(offset, drift_ppm, read_latency, seed)
+        self.random = np.random.RandomState(seed)
+
+        self.debounce = False
+        self.marker = 0.
+        self.log_times = np.zeros((0,))         # the generated DIN log
+        self.log_words = np.zeros((0,), dtype=np.int64)
+        self.idle_word = 1 << int(self.bits[Trigger_button])
+        self.n_read = 0                         # log frames read (or overwritten)
+        self.overwritten = 0
+        self.n_status = 0
+
+    def _generate(self, start):
+        random = self.random
+        transitions = []                        # (times, bit, values) per button
+
+        # Scanner triggers: the trigger bit drops for trigger_pulse at every TR
+        if self.tr:
+            onsets = start + self.first_trigger + np.arange(0., self.duration - self.first_trigger, self.tr)
+            times = np.stack([onsets, onsets + self.trigger_pulse], axis=1).ravel()
+            values = np.tile(np.array([0, 1], dtype=np.int8), len(onsets))
+            transitions.append((times, Trigger_button, values))
+
+        # Responses: Poisson bursts of presses, on random response buttons
+        response_buttons = [i for i in range(len(self.bits)) if i != Trigger_button]
+        if self.response_rate > 0:
+            n_bursts = random.poisson(self.response_rate / self.burst_size * self.duration)
+            bursts = np.sort(random.uniform(start, start + self.duration, n_bursts))
+            presses = (bursts[:, None] + self.burst_spacing * np.arange(self.burst_size)[None, :]).ravel()
+            buttons = random.choice(response_buttons, len(presses))
+            for button in response_buttons:
+                onsets = np.sort(presses[buttons == button])
+                if len(onsets) == 0:
+                    continue
+                # A button is released before it is pressed again
+                releases = np.minimum(onsets + self.press_duration, np.append(onsets[1:], np.inf) - 1e-4)
+                releases = np.maximum(releases, onsets)
+                times = np.stack([onsets, releases], axis=1).ravel()
+                values = np.tile(np.array([Press_state, 1 - Press_state], dtype=np.int8), len(onsets))
+                transitions.append((times, button, values))
+
+        log_times, log_bits, log_values = [], [], []
+        for times, button, values in transitions:
+            # Contact bounce: toggle pairs right after some transitions
+            bouncing = random.uniform(size=len(times)) < self.bounce_probability
+            if np.any(bouncing) and self.bounce_count > 0:
+                offsets = self.bounce_spacing * np.arange(1, 2*self.bounce_count + 1)
+                bounce_times = (times[bouncing][:, None] + offsets[None, :]).ravel()
+                bounce_values = np.where((np.arange(2*self.bounce_count) % 2 == 0)[None, :],
+                                         1 - values[bouncing][:, None], values[bouncing][:, None])
+                times = np.append(times, bounce_times)
+                values = np.append(values, bounce_values.ravel().astype(np.int8))
+                order = np.argsort(times, kind='mergesort')
+                times, values = times[order], values[order]
+            if self.debounce:
+                initial = (self.idle_word >> int(self.bits[button])) & 1
+                times, values = _debounce(times, values, initial, self.debounce_time)
+            log_times.append(times)
+            log_bits.append(np.full(len(times), self.bits[button], dtype=np.int64))
+            log_values.append(values.astype(np.int64))
+
+        if not log_times:
+            return
+        times, bits, values = np.concatenate(log_times), np.concatenate(log_bits), np.concatenate(log_values)
+        order = np.argsort(times, kind='mergesort')
+        times, bits, values = times[order], bits[order], values[order]
+
+        # Word after every transition: latest value of every bit so far
+        words = np.zeros((len(times),), dtype=np.int64)
+        for bit in np.unique(self.bits):
+            i_bit = np.nonzero(bits == bit)[0]
+            if len(i_bit) == 0:
+                words |= ((self.idle_word >> bit) & 1) << bit
+                continue
+            latest = np.searchsorted(i_bit, np.arange(len(times)), side='right') - 1
+            level = np.where(latest >= 0, values[i_bit[np.maximum(latest, 0)]], (self.idle_word >> bit) & 1)
+            words |= level << bit
+        self.log_times, self.log_words = times, words ^ self.raw_mask
+
+    # Transitions the decoder should report from the frames read so far
+    def expectedEvents(self):
+        words = np.append(self.idle_word ^ self.raw_mask, self.log_words[:self.n_read])
+        changed = (words[1:] ^ words[:-1])[:, None] >> self.bits[None, :] & 1
+        return int(changed.sum())
+
+    # pypixxlib._libdpx
+    def DPxOpen(self):
+        pass
+
+    def DPxClose(self):
+        pass
+
+    def DPxSelectDevice(self, name):
+        return 1
+
+    def DPxUpdateRegCache(self):
+        self.clock.DPxUpdateRegCache()
+
+    def DPxGetTime(self):
+        return self.clock.DPxGetTime()
+
+    def DPxSetMarker(self):
+        self.clock.DPxUpdateRegCache()
+        self.marker = self.clock.DPxGetTime()
+
+    def DPxGetMarker(self):
+        return self.marker
+
+    def DPxEnableDinDebounce(self):
+        self.debounce = True
+
+    def DPxDisableDinDebounce(self):
+        self.debounce = False
+
+    def DPxSetDinLog(self, *args, **kwargs):
+        return {'newLogFrames': 0, 'numLogFrames': 0}
+
+    def DPxStartDinLog(self):
+        self.clock.DPxUpdateRegCache()
+        self._generate(self.clock.DPxGetTime())
+
+    def DPxStopDinLog(self):
+        pass
+
+    def DPxGetDinValue(self):
+        i_frame = np.searchsorted(self.log_times, self.clock.DPxGetTime(), side='right') - 1
+        return int(self.log_words[i_frame]) if i_frame >= 0 else self.idle_word ^ self.raw_mask
+
+    # Frames logged up to the last register read; the oldest are lost beyond log_capacity
+    def DPxGetDinStatus(self, status):
+        self.n_status += 1
+        logged = np.searchsorted(self.log_times, self.clock.DPxGetTime(), side='right')
+        if logged - self.n_read > self.log_capacity:
+            self.overwritten += logged - self.n_read - self.log_capacity
+            self.n_read = logged - self.log_capacity
+        status['numLogFrames'] = logged
+        status['newLogFrames'] = logged - self.n_read
+
+    def DPxReadDinLog(self, status, n_frames=0):
+        n_frames = status['newLogFrames'] if n_frames <= 0 else min(n_frames, status['newLogFrames'])
+        first, self.n_read = self.n_read, self.n_read + n_frames
+        status['newLogFrames'] -= n_frames
+        return np.stack([self.log_times[first:self.n_read], self.log_words[first:self.n_read]], axis=1).tolist()
+
+
+# Module-level functions, like _libdpx, on a device built with the defaults above at DPxOpen()
+_device = None
+
+
+def DPxOpen():
+    global _device
+    _device = simulatedDpx(is_mri=Is_mri)
+    _device.DPxOpen()
+
+
+def _deviceFunction(name):
+    def call(*args, **kwargs):
+        return getattr(_device, name)(*args, **kwargs)
+    call.__name__ = name
+    return call
+
+
+for _name in Dpx_functions:
+    globals()[_name] = _deviceFunction(_name)
+
+
+# Decoder alone: events per sec of decodeDinLog on a log with a transition in every frame
+def decoderThroughput(n_frames=100000, repeats=5):
+    words = np.arange(n_frames, dtype=np.int64) & 0x1f
+    data_list = np.stack([np.arange(n_frames) * 1e-4, words], axis=1).tolist()
+    best = np.inf
+    for i_repeat in range(repeats):
+        start = time.perf_counter()
+        events, last_state = decodeDinLog(data_list, 0, Button_coding, np.zeros((len(Button_coding),), dtype=np.int8))
+        best = min(best, time.perf_counter() - start)
+    return len(events) / best
+
+
+# buttonBoxThread on simulated traffic at press rate `rate`, drained like the render loop does
+# (hardware debounce off by default, so every generated transition reaches the decoder)
+def loadTest(rate, duration=Load_duration, tr=Tr, bounce_probability=0.1, is_mri=0, debounce_time=0., **options):
+    device = simulatedDpx(tr=tr, response_rate=rate, burst_size=1, press_duration=min(Press_duration, 2./rate),
+                          bounce_probability=bounce_probability, debounce_time=debounce_time, duration=duration + 5.,
+                          is_mri=is_mri)
+    messages = []
+    thread = buttonBoxThread(1, 'load test', is_mri=is_mri, measure=True, dpx=device, log=messages.append, **options)
+    reader = thread.events.reader()
+    thread.start()
+    end = time.time() + duration
+    n_drained = 0
+    while time.time() < end:
+        n_drained += len(reader.drain())
+        time.sleep(1. / Reader_rate)
+    thread.stop()
+    thread.join()
+    n_drained += len(reader.drain())
+
+    statistics = thread.statistics
+    latencies = np.asarray(statistics.latencies) * 1000. if statistics.latencies else np.zeros((1,))
+    expected = device.expectedEvents()
+    return {'rate': rate, 'duration': statistics.wall_time, 'log_frames': device.n_read,
+            'expected_events': expected, 'decoded_events': thread.events.written,
+            'missed_events': expected - thread.events.written, 'log_overwritten_frames': device.overwritten,
+            'ring_overwritten_events': thread.events.overwritten(), 'reader_lost_events': reader.lost,
+            'drained_events': n_drained, 'triggers': thread.trigger_count, 'polls': statistics.n_polls,
+            'events_per_sec': thread.events.written / max(statistics.wall_time, 1e-9),
+            'cpu_percent': 100. * statistics.cpu_time / max(statistics.wall_time, 1e-9),
+            'latency_ms': {'median': float(np.median(latencies)), 'p95': float(np.percentile(latencies, 95)),
+                           'max': float(latencies.max())}}
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Load test of the button box polling on a simulated DIN device.')
+    parser.add_argument('--rates', nargs='+', type=float, default=Load_rates, help='presses per sec')
+    parser.add_argument('--duration', type=float, default=Load_duration, help='sec per rate')
+    parser.add_argument('--tr', type=float, default=Tr, help='sec between two triggers (0: none)')
+    parser.add_argument('--bounce', type=float, default=0.1, help='probability that a transition bounces')
+    parser.add_argument('--mri', action='store_true', help='inverted polarities (IsMRI = 1)')
+    parser.add_argument('--debounce', type=float, default=0., help='sec of hardware debounce (0: off)')
+    parser.add_argument('--ring-capacity', type=int, default=None, help='events kept by the event ring')
+    parser.add_argument('--out', default=None, help='JSON file for the results')
+    args = parser.parse_args()
+
+    print('decodeDinLog alone: %.0f events/sec' % decoderThroughput())
+    options = {} if args.ring_capacity is None else {'ring_capacity': args.ring_capacity}
+    results = []
+    for rate in args.rates:
+        result = loadTest(rate, args.duration, args.tr or None, args.bounce, int(args.mri), args.debounce, **options)
+        results.append(result)
+        print(('%8.0f presses/s: %7d/%-7d events decoded (%d missed), %d log frames overwritten, %d ring overwritten, '
+               '%d lost by the reader, %d triggers, CPU %.1f%%, latency median %.3f / p95 %.3f / max %.3f ms') %
+              (rate, result['decoded_events'], result['expected_events'], result['missed_events'],
+               result['log_overwritten_frames'], result['ring_overwritten_events'], result['reader_lost_events'],
+               result['triggers'], result['cpu_percent'], result['latency_ms']['median'], result['latency_ms']['p95'],
+               result['latency_ms']['max']))
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'decoder_events_per_sec': decoderThroughput(), 'results': results}, f, indent=1, sort_keys=True)
+        print('Results saved in %s' % args.out)
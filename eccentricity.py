@@ -25,7 +25,18 @@ import os
 #import matplotlib.pyplot as plt
 from datetime import datetime as dt
 from time import gmtime, strftime
-import threading
+
+from mask_bank import annulusMaskBank, crownMaskLimits
+from frame_schedule import compileSchedule, scheduleIndex, displayRate
+from frame_clock import frameLockedClock
+from frame_profiler import framePhaseTimer
+from frame_journal import frameJournal, loadJournal
+from state_log import frameStateLog
+from async_log import asyncLogFile
+from run_archive import archiveRun
+from clock_sync import alignEvents, isTrigger
+from tr_clock import trLockedClock, triggerTimes
+from web_background import webBackground
 
 
 ################################################################################################################
@@ -39,14 +50,37 @@ sans = ['Gill Sans MT', 'Arial', 'Helvetica', 'Verdana']
 Initial_code = 16777200
 Button_coding = [-1,-2,-3,-4,-5]            #red,yellow,green,blue,white(i.e. trigger)
 IsMRI = 0                                   #MRI inverses the bit polarities
+Poll_interval = 0.001                       # sec between two reads of the DIN log
+Poll_interval_idle = 0.004                  # sec, longest interval once the log is idle
+Poll_measure = False                        # Log poll rate, CPU time and detection latency
+Button_service = False                      # Poll in a separate process, state in shared memory (button_service)
+Sync_interval = 1.                          # sec between two device clock samples (clock_sync), None: no sync
 scanner_message = "Waiting for the scanner..."
+Trigger_wait_timeout = 0.5                  # sec, longest single block while waiting for the trigger
 
 # Experiment details
 Fullscreen = True
 Dir_save = 'D:/Mucklis_lab/Retinotopic_mapping/out/'
 Log_name = 'LogFile.log'
 Frames_durations_name = 'frames_durations.npy'
+Phase_timing_name = 'frames_phases.npy'
+Frame_journal_name = 'frames_journal.npy'
+State_log_name = 'frames_state.npy'
+Button_events_name = 'button_events.npy'
+Button_times_name = 'button_times.npy'
+Trigger_times_name = 'trigger_times.npy'
+Run_archive_name = 'run_archive.rma'
 Fps_update_rate = 1                             # sec
+Refresh_rate = 60.                              # Hz, rate of the precompiled frame schedule
+Frame_locked_timing = False                     # Count flips (and skip missed ones) instead of reading globalClock
+Tr_locked_timing = False                        # Keep the stimulus time on the TR grid of the scanner triggers
+Tr = 2.                                         # sec, repetition time of the scanner
+Trigger_keys = ['5', 't']                       # keys of the scanner triggers without the button box
+Phase_timing = False                            # Time every phase of every frame of the loop (Phase_timing_name)
+Frame_journal = True                            # Stream every flip (time, interval, stimulus state) to disk during the run
+State_log = True                                # Record the stimulus state shown at every flip (State_log_name)
+Async_log = True                                # Write the log file from a background thread
+Run_archive = True                              # Pack the run folder in one indexed file at the end (Run_archive_name)
 
 # Eccentricity, i.e. circular_crown
 Flash_period = 0.2                              # seconds for one B-W cycle (ie 1/Hz)
@@ -56,6 +90,8 @@ Cycles_number = 8                               # How many cicles
 Thickness_circular_crown = 10                   # Pixels
 Thickness_multiplication_factor = np.linspace(1.,30.,num=Mask_positions_number)
 Eccentricity_size = 1.25                         # x resY
+Mask_bank = True                                # Upload every ring mask once and swap textures
+Mask_bank_budget = 32 * 2**20                   # bytes of texture memory for the mask bank
 
 # Fixation
 Rotating_cross = False
@@ -67,6 +103,8 @@ Rotation_cross_rate = 0.05                      # revs per sec
 Spyder_grid = True
 Spyder_rings = 4
 Web_size = (1.,1.)
+Cached_background = True                        # Draw the web once into a texture and blit it every frame
+Background_fixation = False                     # Bake the fixation cross in it too (it is then drawn under the stimuli)
 
 # External cover
 External_ring_size = Eccentricity_size * 2
@@ -119,88 +157,15 @@ def createOutFolder(path_out):
     return path_out
 
 
-class buttonBoxThread(threading.Thread):
-    def __init__(self, thread_id, name):           
-        threading.Thread.__init__(self)
-        
-        self.stimulus_onset_time = 0
-        self.local_status = 0
-        self.mask = 0x0000 if IsMRI == 0  else 0x001f
-        
-        # Open comunication with Vpixx
-        DPxOpen()
-        
-        #Select the correct device
-        DPxSelectDevice('PROPixxCtrl')
-        DPxSetMarker()
-        self.stimulus_onset_time = DPxGetMarker()
-        DPxEnableDinDebounce()              # Filter out button bounce
-        self.local_status = DPxSetDinLog()        # Configure logging with default values
-        DPxStartDinLog()
-        DPxUpdateRegCache()
-
-        # Thread infos        
-        self.thread_id = thread_id
-        self.name = name
-        
-        # Every button has: its value {0,1} and time when it changed (as datetime)
-        self.button_state = {'time': np.array([dt.now()]*5), 'state': np.zeros((5,),dtype=np.int8)}
-        self.button_state['state'][-1] = 1
-        self._stop_event = threading.Event()
-        
-    def run(self):
-        logging.data("Starting " + self.name)
-        
-        initial_values = DPxGetDinValue()
-        logging.data('Initial button box digital input states = ' + "{0:016b}".format(initial_values) + " (int=%d)".format(initial_values))
-
-        while(True):
-            DPxUpdateRegCache()
-            DPxGetDinStatus(self.local_status)
-            
-            if self.local_status['newLogFrames'] > 0 :           #Something happened
-                data_list = DPxReadDinLog(self.local_status)
-                self.button_state = self.updateStateButton(self.button_state,data_list)
-                
-            if(self.stopped()):
-                break
-                
-        logging.data("Exiting " + self.name)
-        
-    def stop(self):        
-        self._stop_event.set()
-
-    def stopped(self):
-        return self._stop_event.is_set()
-
-    # Take in input a state and check what is changed
-    def updateStateButton(self,button_state,data_list):   
-        
-        for j in range(len(data_list)):
-            j_value = bin(data_list[j][1] ^ self.mask)
-            
-            # Check every button
-            for i_button in range(len(button_state['state'])):
-                i_button_detected_value = int(j_value[Button_coding[i_button]])
-                if(i_button_detected_value != button_state['state'][i_button]):
-                    button_state['state'][i_button] = i_button_detected_value
-                    button_state['time'][i_button] = dt.now()
-
-        return button_state
-
 
+################################################################################################################
+## Stimuli
 
+# Build every stimulus of the run (before the run, and once per window in a session)
+def prepareStimuli(win, measured_rate=None):
 
-################################################################################################################
-## Main function
-    
-def main(win, globalClock):
-    
-    all_changes = []
     size_ecc_pxl = resY * Eccentricity_size
-    
-    ################################ Stimuli prepation ################################
-    
+
     # Make two wedges (in opposite contrast) and alternate them for flashing
     grating_texture = np.tile([[1,-1],[-1,1]], (8,8))#(4,64))
     wedge1 = visual.RadialStim(win, tex=grating_texture, color=1, units='pix', size=size_ecc_pxl,
@@ -208,37 +173,110 @@ def main(win, globalClock):
                                autoLog=False)       #, mask=radius)
     wedge2 = copy.copy(wedge1)
     wedge2.color = -1
-    
-    position_from_center = np.linspace(0,size_ecc_pxl,Mask_positions_number).reshape((-1,1))
-    
+
+    # Stimulus state of every frame, compiled before the run
+    if measured_rate is None:
+        measured_rate = win.getActualFrameRate()            # a session measures it once for all its runs
+    frame_rate = displayRate(measured_rate, Refresh_rate)
+    if frame_rate != Refresh_rate:
+        logging.warning('Display measured at %.3f Hz, not %.3f Hz: frame schedule compiled at %.3f Hz' %
+                        (measured_rate, Refresh_rate, frame_rate))
+    schedule = compileSchedule('eccentricity', globals(), frame_rate)
+
+    # Ring masks, built and uploaded once before the run (only the crown positions the schedule shows)
+    if Mask_bank:
+        mask_bank = annulusMaskBank(size_ecc_pxl, Mask_positions_number, Thickness_circular_crown,
+                                    Thickness_multiplication_factor, budget_bytes=Mask_bank_budget)
+        mask_index = schedule['mask_index']
+        n_preloaded = mask_bank.preload(mask_index[mask_index >= 0])
+        logging.data('Mask bank: %d distinct masks, %d preloaded' % (len(mask_bank), n_preloaded))
 
     # fixation cross
     fixation = visual.ShapeStim(win,vertices=((0,-1),(0,1),(0,0),(-1,0),(1,0)),lineWidth=4, units="pix",
-        size=(20,20),closeShape=False,lineColor='red',autoDraw=True)
+        size=(20,20),closeShape=False,lineColor='red',autoDraw=False,autoLog=False)
     
     # Spyder network
     web_circle = visual.Circle(win=win,radius=1,edges=200,units='norm',pos=[0, 0],lineWidth=1,opacity=1,interpolate=True,
-                            lineColor=[1.0, 1.0, 1.0],lineColorSpace='rgb',fillColor=None,fillColorSpace='rgb')
+                            lineColor=[1.0, 1.0, 1.0],lineColorSpace='rgb',fillColor=None,fillColorSpace='rgb',
+                            autoLog=False)
     web_dimension = (screenCorrection(win,Web_size[0]),Web_size[1])
     web_line = visual.Line(win,name='Line',start=(-1.4, 0),end=(1.4, 0),pos=[0, 0],lineWidth=1,
-                           lineColor=[1.0, 1.0, 1.0],lineColorSpace='rgb',opacity=1,interpolate=True)
+                           lineColor=[1.0, 1.0, 1.0],lineColorSpace='rgb',opacity=1,interpolate=True,autoLog=False)
+    baked_fixation = Background_fixation and not (Rotating_cross or Color_change_cross)
+    if Spyder_grid and Cached_background:
+        web_layer = webBackground(win, web_circle, web_line, web_dimension, Spyder_rings,
+                                  fixation=fixation if baked_fixation else None)
+        web_layer.build()
     
     # DEBUG stimuli
     if DEBUG_MODE:
         fps_text = visual.TextStim(win, units='norm', height=0.05,pos=(-0.98, +0.93), text='starting...',
                                   font=sans, alignHoriz='left', alignVert='bottom', color='yellow')    
-        fps_text.autoDraw = True
         
         orientation_details_string = visual.TextStim(win, text = u"eccentricity..", units='norm', height=0.05,
                                              pos=(0.95, +0.93), alignHoriz='right', alignVert='bottom', 
                                              font=sans, color='yellow')
-        orientation_details_string.autoDraw = True        
 
     # External Aperture (black ring)
     external_aperture_size = tuple([screenCorrection(win,External_ring_size),External_ring_size])
     external_aperture = visual.Aperture(win, size=external_aperture_size, shape='circle')
     external_aperture.enabled = False
 
+    stimuli = dict(wedge1=wedge1, wedge2=wedge2, schedule=schedule, fixation=fixation, web_circle=web_circle,
+                   web_line=web_line, web_dimension=web_dimension, external_aperture=external_aperture,
+                   frame_rate=frame_rate)
+    if Mask_bank:
+        stimuli['mask_bank'] = mask_bank
+    if Spyder_grid and Cached_background:
+        stimuli['web_layer'] = web_layer
+    if DEBUG_MODE:
+        stimuli['fps_text'] = fps_text
+        stimuli['orientation_details_string'] = orientation_details_string
+    return stimuli
+
+
+
+################################################################################################################
+## Main function
+    
+def main(win, globalClock, stimuli=None, wait_ready=True):
+    
+    all_changes = []
+    size_ecc_pxl = resY * Eccentricity_size
+    
+    ################################ Stimuli prepation ################################
+    
+    if stimuli is None:
+        stimuli = prepareStimuli(win)
+    wedge1, wedge2 = stimuli['wedge1'], stimuli['wedge2']
+    fixation = stimuli['fixation']
+    web_circle, web_line, web_dimension = stimuli['web_circle'], stimuli['web_line'], stimuli['web_dimension']
+    external_aperture = stimuli['external_aperture']
+    if Mask_bank:
+        mask_bank = stimuli['mask_bank']
+    else:
+        position_from_center = np.linspace(0,size_ecc_pxl,Mask_positions_number).reshape((-1,1))
+    if Spyder_grid and Cached_background:
+        web_layer = stimuli['web_layer']
+    baked_fixation = Background_fixation and not (Rotating_cross or Color_change_cross)
+
+    # Stimulus state of every frame
+    schedule = stimuli['schedule']
+    frame_rate = stimuli['frame_rate']
+    schedule_polarity = schedule['polarity']
+    schedule_mask_index = schedule['mask_index']
+    schedule_cycle = schedule['cycle']
+    schedule_fixation_color = schedule['fixation_color']
+    schedule_fixation_ori = schedule['fixation_ori']
+    fixation_colors = ['red', 'green']
+
+    # Stimuli drawn on every flip of this run
+    fixation.autoDraw = True
+    if DEBUG_MODE:
+        fps_text, orientation_details_string = stimuli['fps_text'], stimuli['orientation_details_string']
+        fps_text.autoDraw = True
+        orientation_details_string.autoDraw = True
+
 
     ################################ Definitions/Functions ################################    
     
@@ -247,97 +285,158 @@ def main(win, globalClock):
         for key in event.getKeys():
             if key in ['escape', 'q']:
                 return False
+            if Tr_locked_timing and not BUTTON_BOX and key in Trigger_keys:
+                run_clock.trigger(globalClock.getTime())
         return True
 
+    ## Spyder network of the fixation periods
+    def drawWeb():
+        if Spyder_grid and Cached_background:
+            web_layer.draw()
+        elif Spyder_grid:
+            for i_dim in range(Spyder_rings):
+                web_circle.setSize(tuple([x*(i_dim+1) * 1./Spyder_rings for x in web_dimension]))
+                web_circle.draw()
+            for i_dim in range(2):
+                web_line.setOri(i_dim * 90)
+                web_line.draw()
+
+    ## Leave the window clean for the next run
+    def clearWindow():
+        fixation.autoDraw = False
+        if DEBUG_MODE:
+            fps_text.autoDraw = False
+            orientation_details_string.autoDraw = False
+
     
     ################################ Animation starts ################################    
     # display instructions and wait
-    message1 = visual.TextStim(win, pos=[0,0.5],text='Hit a key when ready.')
-    message1.draw()
-    fixation.draw()
-    win.flip()#to show our newly drawn 'stimuli'
-    event.waitKeys()                #pause until there's a keypress
+    if wait_ready:
+        message1 = visual.TextStim(win, pos=[0,0.5],text='Hit a key when ready.')
+        message1.draw()
+        fixation.draw()
+        win.flip()#to show our newly drawn 'stimuli'
+        event.waitKeys()                #pause until there's a keypress
 
     # Scanner trigger wait
+    if BUTTON_BOX:
+        n_triggers = button_thread.trigger_count
+        sync_events = button_thread.events.reader(from_start=False)
     message3 = visual.TextStim(win,pos=[0,0.25],text=scanner_message,font=serif,alignVert='center',
                                wrapWidth=1.5)
     message3.size = .5
     message3.draw()
     win.flip()
 
+    trigger = None
     if BUTTON_BOX:
-        button_state = button_thread.button_state
-        while 1:
-            if(button_state['state'][-1]==0):
-                break
+        while trigger is None:
+            trigger = button_thread.waitTrigger(timeout=Trigger_wait_timeout, after=n_triggers)
+            if trigger is None and len(event.getKeys(['escape', 'q'])) > 0:
+                logging.warning('Run aborted while waiting for the scanner trigger')
+                clearWindow()
+                return
+        logging.data('Scanner trigger at %.6f (DIN log time)' % trigger[0])
     else:
         event.waitKeys()    #pause until there's a keypress
 
     
     # Wait Pre_post_stimuli_fixation_time before stimuli
-    # Spyder network
-    if Spyder_grid:
-        for i_dim in range(Spyder_rings):
-            web_circle.setSize(tuple([x*(i_dim+1) * 1./Spyder_rings for x in web_dimension]))
-            web_circle.draw()
-        for i_dim in range(2):
-            web_line.setOri(i_dim * 90)
-            web_line.draw()
+    if Spyder_grid and Cached_background and baked_fixation:
+        fixation.autoDraw = False
+    drawWeb()
     win.flip()
-    core.wait(Pre_post_stimuli_fixation_time)
+    if trigger is not None:
+        # Align the start of the stimuli to the trigger, not to this flip
+        trigger_delay = button_thread.sinceTrigger(trigger)
+        logging.data('Trigger decode to fixation flip: %.3f ms' % (trigger_delay*1000.))
+        core.wait(max(0., Pre_post_stimuli_fixation_time - trigger_delay))
+    else:
+        core.wait(Pre_post_stimuli_fixation_time)
 
 
     t = last_fps_update = i_cycle = new_record = 0
     break_flag = True
-    globalClock.reset()
+    # Run time 0 on a flip: every frame is then drawn just after a whole number of frame periods
+    drawWeb()
+    win.callOnFlip(globalClock.reset)
+    flip_zero = win.flip()                  # win.flip() stamps on logging's default clock: flips are kept in run time
+    if BUTTON_BOX and Sync_interval is not None:
+        button_thread.clock_sync.anchor(globalClock)
     inizio = globalClock.getTime()
+    if Frame_locked_timing:
+        run_clock = frameLockedClock(frame_rate)
+    else:
+        run_clock = globalClock
+    if Tr_locked_timing:
+        run_clock = trLockedClock(run_clock, Tr, first_trigger=-Pre_post_stimuli_fixation_time)
+    if BUTTON_BOX:
+        button_events = button_thread.events.reader(from_start=False)
+    if Phase_timing:
+        phase_timer = framePhaseTimer(capacity=2*len(schedule))
+    if Frame_journal:
+        journal = frameJournal(path_out+Frame_journal_name, schedule)
+        win.recordFrameIntervals = False       # the journal has them
+    if State_log:
+        mask_limits = crownMaskLimits(size_ecc_pxl, Mask_positions_number, Thickness_circular_crown,
+                                      Thickness_multiplication_factor)
+        state_log = frameStateLog(schedule, mask_limits=mask_limits)
+    logging.data('Frame schedule at %.3f Hz, %d frames' % (frame_rate,len(schedule)))
     logging.data('First cycle. Number %d/%d at %f (sec.)' % (i_cycle+1,Cycles_number,inizio))
     
-    while (globalClock.getTime() < Total_time and break_flag==True):
-        t = globalClock.getTime()
+    if Phase_timing:
+        phase_timer.start()
+    while (run_clock.getTime() < Total_time and break_flag==True):
+        t = run_clock.getTime()
+        i_frame = scheduleIndex(schedule, t, frame_rate)
+        if Phase_timing:
+            phase_timer.lap('schedule')
         
         # Spyder network
-        if Spyder_grid:
-            for i_dim in range(Spyder_rings):
-                web_circle.setSize(tuple([x*(i_dim+1) * 1./Spyder_rings for x in web_dimension]))
-                web_circle.draw()
-            for i_dim in range(2):
-                web_line.setOri(i_dim * 90)
-                web_line.draw()
+        if Spyder_grid and Cached_background:
+            web_layer.draw()
+        elif Spyder_grid:
+            drawWeb()
+        if Phase_timing:
+            phase_timer.lap('web')
 
         # External ring
         external_aperture.enabled = True
                 
-        if t % Flash_period < Flash_period / 2.0:  # more accurate to count frames
+        if schedule_polarity[i_frame] == 0:
             stim = wedge1
         else:
             stim = wedge2
 
         # Prepare moving mask
-        if (t >= ((i_cycle+1)*Cycle_duration)):
+        if (schedule_cycle[i_frame] > i_cycle):
             logging.data('Change orientation. Number %d/%d at %f (sec.)' % (i_cycle+1,Cycles_number,t))
             new_record = globalClock.getTime() - sum(all_changes)
             all_changes.append(new_record)        
-        i_cycle = int(t/Cycle_duration)
-        crown_pos_indx = int((Mask_positions_number / Cycle_duration/2) * (t % Cycle_duration))
-        ## Try to understand when it changes and save it
-        mask_begin = int(position_from_center[crown_pos_indx,0])
-        mask_end = int(position_from_center[crown_pos_indx,0] + Thickness_multiplication_factor[crown_pos_indx] * Thickness_circular_crown)
+        i_cycle = schedule_cycle[i_frame]
+        crown_pos_indx = schedule_mask_index[i_frame]
+        if Mask_bank:
+            mask_bank.activate((wedge1, wedge2), crown_pos_indx)
+        else:
+            ## Try to understand when it changes and save it
+            mask_begin = int(position_from_center[crown_pos_indx,0])
+            mask_end = int(position_from_center[crown_pos_indx,0] + Thickness_multiplication_factor[crown_pos_indx] * Thickness_circular_crown)
                                       
-        annulus_mask = np.zeros((int(size_ecc_pxl/2),1))
-        annulus_mask[mask_begin : mask_end] += 1        #int(mask_end if mask_end <= size_ecc_pxl else size_ecc_pxl)] += 1      
-        stim.setMask(annulus_mask)    
+            annulus_mask = np.zeros((int(size_ecc_pxl/2),1))
+            annulus_mask[mask_begin : mask_end] += 1        #int(mask_end if mask_end <= size_ecc_pxl else size_ecc_pxl)] += 1      
+            stim.setMask(annulus_mask)    
+        if Phase_timing:
+            phase_timer.lap('update')
         stim.draw()
+        if Phase_timing:
+            phase_timer.lap('draw')
 
 
         # Fixation
         if Rotating_cross:
-            fixation.ori = t * Rotation_cross_rate * 360.0  # set new rotation
+            fixation.ori = schedule_fixation_ori[i_frame]  # set new rotation
         if Color_change_cross:
-            if t % Color_change_rate < Color_change_rate / 2.0:  # more accurate to count frames
-                fixation.lineColor = 'red'
-            else:
-                fixation.lineColor = 'green'        
+            fixation.lineColor = fixation_colors[schedule_fixation_color[i_frame]]
 
         external_aperture.enabled = False
         
@@ -347,22 +446,89 @@ def main(win, globalClock):
                 last_fps_update += 1
             orientation_details_string.text = 'Pass: %d/%d at %.3f (sec.)' % (i_cycle+1,Cycles_number,np.sum(all_changes))
 
-        win.flip()
+        if Phase_timing:
+            phase_timer.lap('fixation')
+
+        # Button responses since the last frame
+        if BUTTON_BOX:
+            new_events = button_events.drain()
+            for button_event in new_events:
+                logging.data('Button %d -> %d at %.6f (DIN log time)' % (button_event['button'],button_event['state'],button_event['hw_time']))
+            if Tr_locked_timing and len(new_events) > 0:
+                for trigger_time in triggerTimes(new_events, globalClock.getTime(), button_thread.clock_sync):
+                    run_clock.trigger(trigger_time)
+        if Phase_timing:
+            phase_timer.lap('buttons')
+
+        flip_time = win.flip() - flip_zero
+        if Frame_locked_timing or Tr_locked_timing:
+            run_clock.flipped(flip_time)
+        if Frame_journal:
+            journal.append(flip_time, t, i_frame)
+        if State_log:
+            state_log.record(flip_time, t, i_frame)
+        if Async_log:
+            lastLog.frameDone()
+        if Phase_timing:
+            phase_timer.lap('flip')
         break_flag = escapeCondition()
+        if Phase_timing:
+            phase_timer.lap('keys')
+            phase_timer.next()
         if break_flag == False: break
 
 
+    if Spyder_grid and Cached_background and baked_fixation:
+        fixation.autoDraw = True
+    if Tr_locked_timing:
+        logging.data(run_clock.summary())
+        run_clock = run_clock.base
+    if Frame_locked_timing:
+        logging.data('Frame-locked timing: ' + run_clock.summary())
+    if Frame_journal:
+        journal.close()
+        win.recordFrameIntervals = True
+        win.nDroppedFrames += journal.droppedFrames(frame_rate)      # psychopy does not count them meanwhile
+        logging.data(journal.summary(frame_rate))
+    if State_log:
+        state_log.save(path_out+State_log_name)
+        logging.data(state_log.summary() + ', saved in ' + path_out+State_log_name)
+    if Async_log:
+        logging.data(lastLog.summary())
+    if Phase_timing:
+        phase_timer.save(path_out+Phase_timing_name)
+        for line in phase_timer.summary():
+            logging.data(line)
+    if BUTTON_BOX and button_events.lost > 0:
+        logging.warning('%d button events were overwritten before being read' % button_events.lost)
+    if BUTTON_BOX and Sync_interval is not None:
+        # Button events and triggers in run time, from their DIN log timestamps
+        clock_sync = button_thread.clock_sync
+        clock_sync.anchor(globalClock)
+        button_times = alignEvents(sync_events.drain(), clock_sync, schedule,
+                                   loadJournal(path_out+Frame_journal_name) if Frame_journal else None)
+        np.save(path_out+Button_times_name, button_times)
+        np.save(path_out+Trigger_times_name, button_times['run_time'][isTrigger(button_times)])
+        logging.data(clock_sync.summary())
+        logging.data('Button events in run time saved in %s, triggers in %s' % (path_out+Button_times_name,path_out+Trigger_times_name))
     logging.data('Total time spent: %.6f' % (globalClock.getTime() - inizio))
     logging.data('Every frame duration saved in %s' % (path_out+Frames_durations_name))
     logging.data('All durations: ' + str(all_changes))
     logging.data('Mean: ' + str(sum(all_changes)/(len(all_changes)+EPSILON)))
 
+    if Mask_bank:
+        logging.data('Mask bank: %d uploads, %d evictions, %d swaps' % (mask_bank.uploads,mask_bank.evictions,mask_bank.swaps))
+        mask_bank.release()
+
     if DEBUG_MODE:
         orientation_details_string.text = 'Ended at %.3f (sec.)' % (globalClock.getTime())
 
     win.flip()
     # Wait Pre_post_stimuli_fixation_time after stimuli
     core.wait(Pre_post_stimuli_fixation_time)
+
+    # Leave the window clean for the next run
+    clearWindow()
     return
 
 
@@ -390,7 +556,10 @@ if __name__ == "__main__":
     # Set the log module to report warnings to the standard output window
     logging.setDefaultClock(globalClock)
     logging.console.setLevel(logging.WARNING)
-    lastLog=logging.LogFile(path_out+Log_name,level=logging.DATA,filemode='w',encoding='utf8')
+    if Async_log:
+        lastLog=asyncLogFile(path_out+Log_name,level=logging.DATA,filemode='w',encoding='utf8')
+    else:
+        lastLog=logging.LogFile(path_out+Log_name,level=logging.DATA,filemode='w',encoding='utf8')
     logging.data("------------- " + strftime("%Y-%m-%d %H:%M:%S", gmtime()) + " -------------")
     logging.data(pyschopy_prefs)
     logging.data("Saving in folder: " + path_out)
@@ -400,11 +569,14 @@ if __name__ == "__main__":
 
     # Create and start buttonBox thread
     if BUTTON_BOX:
-        from pypixxlib._libdpx import DPxOpen, DPxSelectDevice, DPxSetMarker, \
-            DPxUpdateRegCache, DPxGetMarker, DPxEnableDinDebounce, DPxGetDinValue, \
-            DPxSetDinLog, DPxStartDinLog, DPxGetDinStatus, DPxReadDinLog
+        if Button_service:
+            from button_service import buttonBoxService as buttonBoxThread
+        else:
+            from button_box import buttonBoxThread
 
-        button_thread = buttonBoxThread(1, "button box check")
+        button_thread = buttonBoxThread(1, "button box check", is_mri=IsMRI, button_coding=Button_coding,
+                                        poll_interval=Poll_interval, poll_interval_idle=Poll_interval_idle,
+                                        measure=Poll_measure, sync_interval=Sync_interval)
         button_thread.start()
 
     # Start window
@@ -422,11 +594,23 @@ if __name__ == "__main__":
     # Stop buttonBox thread
     if BUTTON_BOX:
         button_thread.stop()
+        button_thread.join()
+        n_events, n_overwritten = button_thread.events.dump(path_out+Button_events_name)
+        logging.data('%d button events saved in %s (%d overwritten)' % (n_events,path_out+Button_events_name,n_overwritten))
 
     logging.data('Overall, %i frames were dropped.' % win.nDroppedFrames)
-    np.save(path_out+Frames_durations_name,win.frameIntervals[1:])
+    if Frame_journal and os.path.exists(path_out+Frame_journal_name):
+        np.save(path_out+Frames_durations_name,loadJournal(path_out+Frame_journal_name)['interval'][1:])
+    else:
+        np.save(path_out+Frames_durations_name,win.frameIntervals[1:])
         
     logging.data('***** End *****')
+    if Async_log:
+        lastLog.close()
+    else:
+        logging.flush()
+    if Run_archive:
+        archiveRun(path_out, path_out+Run_archive_name, paradigm='eccentricity')
     
     win.close()
     core.quit()
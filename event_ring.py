@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: button event ring
+
+Fixed-size, preallocated ring of timestamped button events. One writer (the button box
+thread) announces the rows it is about to store (reserved), stores them and then publishes
+the new write count; any number of readers keep their own cursor and drain the new events
+in O(new events) without locks. After copying, a reader drops the rows a store in progress
+may have overwritten. Events a slow reader missed are counted, never silently lost.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import time
+import numpy as np
+
+
+################################################################################################################
+## Constants
+
+Ring_capacity = 2**16                           # events kept (a full run fits several times)
+
+Button_event_dtype = np.dtype([
+    ('button', np.int8),                        # index in Button_coding
+    ('state', np.int8),                         # new value of the button {0,1}
+    ('mono_ns', np.int64),                      # host monotonic clock when decoded (ns)
+    ('hw_time', np.float64),                    # DIN log timestamp (device clock, sec)
+])
+
+
+################################################################################################################
+## Functions
+
+
+# Host monotonic clock (ns): the performance counter, as time.monotonic() ticks every ~15.6 ms on Windows
+# before Python 3.13. It is system-wide, so times taken in the button service process compare with ours.
+def monotonicNs():
+    if hasattr(time, 'perf_counter_ns'):
+        return time.perf_counter_ns()
+    return int(time.perf_counter() * 1e9)
+
+
+class eventRing(object):
+    def __init__(self, capacity=Ring_capacity, dtype=Button_event_dtype):
+        self.capacity = int(capacity)
+        self.events = np.zeros((self.capacity,), dtype=dtype)
+        self.reserved = 0                       # events ever written or being written, published first
+        self.written = 0                        # events ever written, published last
+
+    # Writer side (single thread)
+    def push(self, events):
+        n_events = len(events)
+        if n_events == 0:
+            return
+        start = self.written
+        if n_events > self.capacity:
+            events = events[-self.capacity:]
+            start += n_events - self.capacity
+        i_slot = (start + np.arange(len(events))) % self.capacity
+        self.reserved = self.written + n_events
+        self.events[i_slot] = events
+        self.written = self.reserved
+
+    def reader(self, from_start=True):
+        return ringReader(self, 0 if from_start else self.written)
+
+    # Every event still in the ring, oldest first
+    def snapshot(self):
+        written = self.written
+        first = max(written - self.capacity, 0)
+        events = self.events[np.arange(first, written) % self.capacity]
+        return events[max(self.reserved - self.capacity - first, 0):]
+
+    def overwritten(self):
+        return max(self.written - self.capacity, 0)
+
+    def dump(self, path):
+        events = self.snapshot()
+        np.save(path, events)
+        return len(events), self.overwritten()
+
+
+class ringReader(object):
+    def __init__(self, ring, position=0):
+        self.ring = ring
+        self.position = position
+        self.lost = 0                           # events overwritten before this reader got them
+        self._empty = np.zeros((0,), dtype=ring.events.dtype)
+
+    def pending(self):
+        return self.ring.written - self.position
+
+    def drain(self):
+        ring = self.ring
+        written = ring.written
+        if written == self.position:
+            return self._empty
+
+        first = max(self.position, written - ring.capacity)
+        events = ring.events[np.arange(first, written) % ring.capacity]
+
+        # The writer may have lapped us while we were copying: rows below reserved - capacity
+        # were (or are being) overwritten
+        overrun = min(ring.reserved - ring.capacity - first, written - first)
+        if overrun > 0:
+            events = events[overrun:]
+            first += overrun
+
+        self.lost += first - self.position
+        self.position = written
+        return events
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: frame-locked clock
+
+Drop-in replacement for globalClock in the render loop: the stimulus time is the number of
+flips times the frame period, so checkerboard reversals and sweep speed stay exact. When a
+flip misses its deadline the clock skips ahead by the whole frames that were lost. Build it
+with the measured display rate (frame_schedule.displayRate): a wrong rate scales the whole
+run, so the rate measured from the flips is reported in the summary.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+
+################################################################################################################
+## Functions
+
+
+class frameLockedClock(object):
+    def __init__(self, refresh_rate, tolerance=1.5):
+        self.refresh_rate = float(refresh_rate)
+        self.frame_period = 1. / self.refresh_rate
+        self.tolerance = tolerance              # frame periods before a flip counts as missed
+        self.reset()
+
+    def reset(self):
+        self.n_frame = 0                        # index of the frame being drawn
+        self.last_flip = None
+        self.compensations = 0                  # missed deadlines
+        self.skipped_frames = 0                 # frames skipped to catch up
+        self.on_time_sum = 0.                   # sum of the intervals of the flips on time
+        self.on_time_flips = 0
+
+    def getFrame(self):
+        return self.n_frame
+
+    def getTime(self):
+        return self.n_frame * self.frame_period
+
+    # Call with the timestamp returned by win.flip()
+    def flipped(self, flip_time):
+        n_periods = 1
+        if self.last_flip is not None:
+            interval = flip_time - self.last_flip
+            if interval > self.tolerance * self.frame_period:
+                n_periods = max(int(round(interval / self.frame_period)), 2)
+                self.compensations += 1
+                self.skipped_frames += n_periods - 1
+            else:
+                self.on_time_sum += interval
+                self.on_time_flips += 1
+        self.n_frame += n_periods
+        self.last_flip = flip_time
+        return self.n_frame
+
+    def measuredRate(self):
+        if self.on_time_flips == 0:
+            return float('nan')
+        return self.on_time_flips / self.on_time_sum
+
+    def summary(self):
+        return '%d frames at %.3f Hz (flips at %.3f Hz), %d missed deadlines compensated (%d frames skipped)' % \
+            (self.n_frame, self.refresh_rate, self.measuredRate(), self.compensations, self.skipped_frames)
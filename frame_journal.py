@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: frame journal
+
+Crash-safe record of every flip of the run: flip time, interval, run time and the stimulus
+state shown (schedule row, polarity, ring mask, orientation, bar position). Rows go into
+fixed-size preallocated chunks; full chunks are appended to a .npy file by a background
+thread, so the render loop never touches the disk and memory stays constant. If the run
+dies, everything up to the last written chunk is on disk and loadJournal() reads it back.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import os
+import threading
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+################################################################################################################
+## Constants
+
+Journal_dtype = np.dtype([
+    ('flip_time', np.float64),                  # run time of the flip: win.flip() timestamp since the reset flip (sec.)
+    ('interval', np.float64),                   # since the previous flip (sec., nan for the first one)
+    ('t', np.float64),                          # run time the frame was drawn for (sec.)
+    ('i_frame', np.int32),                      # schedule row
+    ('polarity', np.int8),
+    ('mask_index', np.int32),
+    ('orientation', np.float32),
+    ('bar_pos', np.float32, (2,)),
+])
+Chunk_rows = 1024                               # ~17 sec. at 60 Hz
+Spare_chunks = 4
+Header_size = 256                               # bytes, room to rewrite the row count in place
+Dropped_threshold = 1.5                         # frame periods, longer intervals count as dropped frames
+
+
+################################################################################################################
+## Functions
+
+
+def _header(dtype, n_rows):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.lib.format.dtype_to_descr(dtype), n_rows)
+    header = header.ljust(Header_size - 10 - 1) + '\n'
+    if len(header) + 10 != Header_size:
+        raise ValueError('Journal dtype too large for the header')
+    return b'\x93NUMPY\x01\x00' + np.array(len(header), dtype='<u2').tobytes() + header.encode('latin1')
+
+
+# Rows of a journal, also one left behind by a crash (mmap, nothing read until used)
+def loadJournal(path, mmap_mode='r'):
+    n_rows = (os.path.getsize(path) - Header_size) // Journal_dtype.itemsize
+    if n_rows <= 0:
+        return np.zeros((0,), dtype=Journal_dtype)
+    return np.memmap(path, dtype=Journal_dtype, mode=mmap_mode, offset=Header_size, shape=(n_rows,))
+
+
+# Intervals longer than Dropped_threshold frames (win.nDroppedFrames is not counted while the journal records)
+def droppedFrames(intervals, refresh_rate):
+    return int(np.sum(np.asarray(intervals) > Dropped_threshold / refresh_rate))
+
+
+class frameJournal(object):
+    def __init__(self, path, schedule, chunk_rows=Chunk_rows, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.n_rows = 0                         # rows appended by the render loop
+        self.n_written = 0                      # rows on disk
+        self.extra_chunks = 0                   # allocated because the writer fell behind
+        self.last_flip = np.nan
+
+        # Stimulus state columns of the schedule
+        self._polarity = schedule['polarity']
+        self._mask_index = schedule['mask_index']
+        self._orientation = schedule['orientation']
+        self._bar_pos = schedule['bar_pos']
+
+        self._file = open(path, 'wb')
+        self._file.write(_header(Journal_dtype, 0))
+        self._file.flush()
+
+        self.chunk_rows = int(chunk_rows)
+        self._free = queue.Queue()
+        for i_chunk in range(Spare_chunks):
+            self._free.put(np.zeros((self.chunk_rows,), dtype=Journal_dtype))
+        self._full = queue.Queue()
+        self._chunk = self._free.get()
+        self._n_chunk = 0
+        self._writer = threading.Thread(target=self._write, name='frame journal')
+        self._writer.daemon = True
+        self._writer.start()
+
+    # Render thread: one call per flip
+    def append(self, flip_time, t, i_frame):
+        self._chunk[self._n_chunk] = (flip_time, flip_time - self.last_flip, t, i_frame, self._polarity[i_frame],
+                                      self._mask_index[i_frame], self._orientation[i_frame], self._bar_pos[i_frame])
+        self.last_flip = flip_time
+        self.n_rows += 1
+        self._n_chunk += 1
+        if self._n_chunk == self.chunk_rows:
+            self._handOver()
+
+    def _handOver(self):
+        self._full.put((self._chunk, self._n_chunk))
+        try:
+            self._chunk = self._free.get_nowait()
+        except queue.Empty:
+            self._chunk = np.zeros((self.chunk_rows,), dtype=Journal_dtype)
+            self.extra_chunks += 1
+        self._n_chunk = 0
+
+    # Writer thread
+    def _write(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                return
+            chunk, n_rows = item
+            self._file.write(chunk[:n_rows].tobytes())
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.n_written += n_rows
+            self._free.put(chunk)
+
+    # Write what is left and the final row count (the file then loads with np.load too)
+    def close(self):
+        if self._file is None:
+            return
+        if self._n_chunk > 0:
+            self._handOver()
+        self._full.put(None)
+        self._writer.join()
+        self._file.seek(0)
+        self._file.write(_header(Journal_dtype, self.n_written))
+        self._file.close()
+        self._file = None
+
+    def droppedFrames(self, refresh_rate):
+        return droppedFrames(loadJournal(self.path)['interval'][1:], refresh_rate)
+
+    def summary(self, refresh_rate):
+        return '%d frames journaled in %s, %d intervals longer than %g frames, %d extra chunks' % \
+            (self.n_written, self.path, self.droppedFrames(refresh_rate), Dropped_threshold, self.extra_chunks)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: per-frame phase timing
+
+Splits every frame of the render loop into phases (schedule lookup, web, stimulus update,
+draw, fixation, buttons, flip, keys) and stores their durations in a preallocated array,
+so dropped frames can be traced to their cause. Nothing is allocated per frame; the
+durations are saved as a structured array next to frames_durations.npy.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import time
+import numpy as np
+
+
+################################################################################################################
+## Constants
+
+Loop_phases = ['schedule',                      # run clock and schedule lookup
+               'web',                           # spider web (cached layer or redraw)
+               'update',                        # stimulus state: setMask/mask bank, ori, pos, cycle bookkeeping
+               'draw',                          # stim.draw()
+               'fixation',                      # fixation cross, debug texts
+               'buttons',                       # button events drained and logged
+               'flip',                          # win.flip()
+               'keys']                          # event.getKeys()
+Percentiles = [50, 90, 99]
+
+
+################################################################################################################
+## Functions
+
+
+_now = getattr(time, 'perf_counter', time.time)
+
+
+class framePhaseTimer(object):
+    def __init__(self, phases=Loop_phases, capacity=2**16):
+        self.phases = list(phases)
+        self.index = dict((name, i_phase) for i_phase, name in enumerate(self.phases))
+        self.dtype = np.dtype([(name, np.float64) for name in self.phases + ['total']])
+        self.durations = np.zeros((int(capacity), len(self.phases) + 1))      # sec., one row per frame
+        self.n_frames = 0
+        self.overflow = 0                       # frames after the array was full (not recorded)
+        self._frame_start = self._last = _now()
+
+    def start(self):
+        self._frame_start = self._last = _now()
+
+    # End of a phase of the current frame
+    def lap(self, phase):
+        now = _now()
+        if self.n_frames < len(self.durations):
+            self.durations[self.n_frames, self.index[phase]] += now - self._last
+        self._last = now
+
+    # End of the frame (after the last phase)
+    def next(self):
+        if self.n_frames < len(self.durations):
+            self.durations[self.n_frames, -1] = self._last - self._frame_start
+            self.n_frames += 1
+        else:
+            self.overflow += 1
+        self._frame_start = self._last
+
+    def records(self):
+        return self.durations[:self.n_frames].copy().view(self.dtype).reshape(-1)
+
+    def save(self, path):
+        np.save(path, self.records())
+
+    def summary(self):
+        records = self.records()
+        lines = ['Phase timing over %d frames (ms, percentiles %s and max):' %
+                 (len(records), '/'.join(str(p) for p in Percentiles))]
+        if len(records) == 0:
+            return lines
+        for name in self.dtype.names:
+            values = records[name] * 1000.
+            lines.append('  %-9s ' % name + ' '.join('%7.3f' % v for v in np.percentile(values, Percentiles)) +
+                         ' %7.3f' % values.max())
+        if self.overflow:
+            lines.append('  %d frames beyond the capacity were not recorded' % self.overflow)
+        return lines
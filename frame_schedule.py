@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: frame schedule
+
+Compiles the module constants of a paradigm and a refresh rate into one row per frame
+(polarity, mask index, orientation, bar position, cycle), so the render loop only indexes
+an array instead of working the stimulus state out of globalClock every frame.
+
+    python frame_schedule.py eccentricity --rate 120 --out ecc_120Hz.npy
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import argparse
+import numpy as np
+
+from paradigms import Paradigms, loadParameters
+
+
+################################################################################################################
+## Constants
+
+Schedule_dtype = np.dtype([
+    ('time', np.float64),                       # sec. from the start of the stimulation
+    ('polarity', np.int8),                      # 0: first checkerboard, 1: reversed one
+    ('mask_index', np.int32),                   # crown_pos_indx of the ring (-1: no ring)
+    ('orientation', np.float32),                # polar.ori (wedge) or stim.ori (bar), degrees
+    ('bar_pos', np.float32, (2,)),              # bar centre, in units of resY/2
+    ('cycle', np.int16),                        # cycle (or bar orientation) number
+    ('cycle_polar', np.int16),                  # wedge cycle in eccentricity_polar (-1 elsewhere)
+    ('fixation_color', np.int8),                # 0: red, 1: green
+    ('fixation_ori', np.float32),               # fixation cross rotation, degrees
+])
+Rate_tolerance = 0.05                           # measured/nominal refresh rate still taken as nominal
+
+
+################################################################################################################
+## Functions
+
+
+def scheduleLength(params, refresh_rate):
+    return int(np.ceil(params['Total_time'] * refresh_rate))
+
+
+def compileSchedule(paradigm, params, refresh_rate, n_frames=None):
+    if n_frames is None:
+        n_frames = scheduleLength(params, refresh_rate)
+
+    schedule = np.zeros((n_frames,), dtype=Schedule_dtype)
+    t = np.arange(n_frames) / float(refresh_rate)
+    schedule['time'] = t
+    schedule['mask_index'] = -1
+    schedule['cycle_polar'] = -1
+
+    # Checkerboard reversal
+    flash_period = params['Flash_period']
+    schedule['polarity'] = (t % flash_period) >= flash_period / 2.0
+
+    # Eccentricity ring
+    if paradigm in ('eccentricity', 'eccentricity_polar'):
+        cycle_duration = params['Cycle_duration'] if paradigm == 'eccentricity' else params['Cycle_duration_ecc']
+        mask_positions_number = params['Mask_positions_number']
+        crown_pos_indx = ((mask_positions_number / cycle_duration/2) * (t % cycle_duration)).astype(np.int64)
+        schedule['mask_index'] = np.minimum(crown_pos_indx, mask_positions_number-1)
+        schedule['cycle'] = (t / cycle_duration).astype(np.int64)
+
+    # Rotating wedge
+    if paradigm in ('polar_angle', 'eccentricity_polar'):
+        rotation_rate = params['Rotation_rate']
+        schedule['orientation'] = np.mod(-t * rotation_rate * 360.0, 360.0)
+        polar_cycle = (t / (1/rotation_rate)).astype(np.int64)
+        if paradigm == 'polar_angle':
+            schedule['cycle'] = polar_cycle
+        else:
+            schedule['cycle_polar'] = polar_cycle
+
+    # Moving bar
+    if paradigm == 'moving_bars':
+        cycle_duration = params['Cycle_duration']
+        bar_orientations = np.asarray(params['Bar_orientations'])
+        bar_positions_number = params['Bar_positions_number']
+        bar_paths = np.asarray(params['Bar_paths'], dtype=float)
+
+        i_bar_ori = np.minimum((t / (cycle_duration*params['Passagges_per_orientation'])).astype(np.int64),
+                               len(bar_orientations)-1)
+        i_orientation_ordered = np.asarray(params['Bar_orientation_order'])[i_bar_ori]
+        bar_pos_indx = ((bar_positions_number / cycle_duration) * (t % cycle_duration)).astype(np.int64)
+        bar_pos_indx = np.minimum(bar_pos_indx, bar_positions_number-1)
+
+        # Same points as np.linspace(path_start, path_end, Bar_positions_number)
+        path_start = bar_paths[i_orientation_ordered, 0]
+        path_end = bar_paths[i_orientation_ordered, 1]
+        step = (bar_pos_indx / max(bar_positions_number-1, 1)).reshape((-1,1))
+        schedule['bar_pos'] = path_start + (path_end - path_start) * step
+        schedule['orientation'] = bar_orientations[i_orientation_ordered]
+        schedule['cycle'] = i_bar_ori
+
+    # Fixation
+    if params['Color_change_cross']:
+        color_change_rate = params['Color_change_rate']
+        schedule['fixation_color'] = (t % color_change_rate) >= color_change_rate / 2.0
+    if params['Rotating_cross']:
+        schedule['fixation_ori'] = t * params['Rotation_cross_rate'] * 360.0
+
+    return schedule
+
+
+# Index of the scheduled frame for a given time (clamped to the last frame). Run time 0 is a
+# flip and the loop draws right after every flip, so frame n is drawn a little after n frame
+# periods: rounding keeps it on its own row, where truncating jitters at the row edges
+def scheduleIndex(schedule, t, refresh_rate):
+    return min(int(round(t * refresh_rate)), len(schedule)-1)
+
+
+# Refresh rate to compile the schedule at: the nominal one when the display runs at it
+# (within tolerance), else the measured one (win.getActualFrameRate(), None: failed), to the Hz
+def displayRate(measured, nominal, tolerance=Rate_tolerance):
+    if measured is None or abs(measured / nominal - 1.) <= tolerance:
+        return float(nominal)
+    return float(round(measured))
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compile the per-frame schedule of a paradigm.')
+    parser.add_argument('paradigm', choices=Paradigms)
+    parser.add_argument('--rate', type=float, default=60., help='refresh rate (Hz)')
+    parser.add_argument('--out', default=None, help='.npy file to save the schedule')
+    args = parser.parse_args()
+
+    schedule = compileSchedule(args.paradigm, loadParameters(args.paradigm), args.rate)
+    print('%s at %.2f Hz: %d frames, %.1f kB' % (args.paradigm, args.rate, len(schedule), schedule.nbytes/1024.))
+    if args.out is not None:
+        np.save(args.out, schedule)
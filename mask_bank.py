@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: annulus mask bank
+
+The eccentricity ring only takes Mask_positions_number distinct (mask_begin, mask_end)
+states, so the masks are built once, uploaded as 1D alpha textures before the run,
+and the RadialStim only swaps the bound texture when the ring position changes.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+from collections import OrderedDict
+import ctypes
+import numpy as np
+
+
+################################################################################################################
+## Constants
+
+Default_budget = 32 * 2**20                     # bytes of texture memory for the ring masks
+
+
+################################################################################################################
+## Functions
+
+
+# (mask_begin, mask_end) in pixels for every crown position, as computed in main()
+def crownMaskLimits(size_ecc_pxl, positions_number, thickness, thickness_factor):
+    position_from_center = np.linspace(0, size_ecc_pxl, positions_number)
+    mask_begin = position_from_center.astype(int)
+    mask_end = (position_from_center + np.asarray(thickness_factor) * thickness).astype(int)
+    return mask_begin, mask_end
+
+
+def annulusMask(mask_length, mask_begin, mask_end):
+    annulus_mask = np.zeros((mask_length, 1))
+    annulus_mask[mask_begin : mask_end] += 1
+    return annulus_mask
+
+
+class annulusMaskBank(object):
+    def __init__(self, size_ecc_pxl, positions_number, thickness, thickness_factor,
+                 budget_bytes=Default_budget, interpolate=False):
+
+        mask_begin, mask_end = crownMaskLimits(size_ecc_pxl, positions_number, thickness, thickness_factor)
+        limits = np.stack((mask_begin, mask_end), axis=1)
+
+        # Distinct masks, and for every crown position the mask it uses
+        self.keys, self.key_index = np.unique(limits, axis=0, return_inverse=True)
+        self.key_index = self.key_index.reshape(-1)
+        self.mask_length = int(size_ecc_pxl/2)
+        self.interpolate = interpolate
+
+        # Texture budget (one byte per texel, GL_ALPHA/GL_UNSIGNED_BYTE)
+        self.texture_bytes = max(self.mask_length, 1)
+        self.capacity = max(int(budget_bytes // self.texture_bytes), 1)
+
+        self._textures = OrderedDict()          # key -> GLuint, least recently used first
+        self._original_ids = {}
+        self.active = -1
+        self.uploads = 0
+        self.evictions = 0
+        self.swaps = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def limits(self, crown_pos_indx):
+        return tuple(int(x) for x in self.keys[self.key_index[crown_pos_indx]])
+
+    def mask(self, key):
+        mask_begin, mask_end = self.keys[key]
+        return annulusMask(self.mask_length, mask_begin, mask_end)
+
+    # Upload the masks in order of first use, until the budget is full
+    def preload(self, crown_indices=None):
+        if crown_indices is None:
+            crown_indices = np.arange(len(self.key_index))
+        used = self.key_index[np.asarray(crown_indices)]
+        _, first = np.unique(used, return_index=True)
+        for key in used[np.sort(first)][:self.capacity]:
+            self._texture(int(key))
+        return len(self._textures)
+
+    # Bind the mask of crown_pos_indx to the stimuli; returns True when the texture changed
+    def activate(self, stims, crown_pos_indx):
+        key = int(self.key_index[crown_pos_indx])
+        if key == self.active:
+            return False
+
+        texture_id = self._texture(key)
+        for stim in stims:
+            if id(stim) not in self._original_ids:
+                self._original_ids[id(stim)] = (stim, stim._maskID)
+            stim._maskID = texture_id
+            stim._needUpdate = True
+        self.active = key
+        self.swaps += 1
+        return True
+
+    # Give the stimuli their own mask texture back and free the bank
+    def release(self):
+        from pyglet import gl as GL
+
+        for stim, mask_id in self._original_ids.values():
+            stim._maskID = mask_id
+            stim._needUpdate = True
+        self._original_ids = {}
+        for texture_id in self._textures.values():
+            GL.glDeleteTextures(1, ctypes.byref(texture_id))
+        self._textures.clear()
+        self.active = -1
+
+    def _texture(self, key):
+        texture_id = self._textures.get(key)
+        if texture_id is not None:
+            self._textures[key] = self._textures.pop(key)
+            return texture_id
+
+        # Evict the least recently used mask
+        if len(self._textures) >= self.capacity:
+            self._deleteTexture(next(iter(self._textures)))
+            self.evictions += 1
+
+        texture_id = self._upload(self.mask(key))
+        self._textures[key] = texture_id
+        self.uploads += 1
+        return texture_id
+
+    def _deleteTexture(self, key):
+        from pyglet import gl as GL
+
+        texture_id = self._textures.pop(key)
+        GL.glDeleteTextures(1, ctypes.byref(texture_id))
+
+    # Same upload RadialStim.mask does for a numpy mask
+    def _upload(self, mask):
+        from pyglet import gl as GL
+
+        intensity = np.ascontiguousarray(255 * mask.astype(float), dtype=np.uint8).reshape(-1)
+        texture_id = GL.GLuint()
+        GL.glGenTextures(1, ctypes.byref(texture_id))
+        GL.glBindTexture(GL.GL_TEXTURE_1D, texture_id)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        GL.glTexImage1D(GL.GL_TEXTURE_1D, 0, GL.GL_ALPHA, len(intensity), 0,
+                        GL.GL_ALPHA, GL.GL_UNSIGNED_BYTE, intensity.ctypes)
+        GL.glTexParameteri(GL.GL_TEXTURE_1D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP)
+        gl_filter = GL.GL_LINEAR if self.interpolate else GL.GL_NEAREST
+        GL.glTexParameteri(GL.GL_TEXTURE_1D, GL.GL_TEXTURE_MAG_FILTER, gl_filter)
+        GL.glTexParameteri(GL.GL_TEXTURE_1D, GL.GL_TEXTURE_MIN_FILTER, gl_filter)
+        GL.glBindTexture(GL.GL_TEXTURE_1D, 0)
+        return texture_id
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: stimulus movies
+
+Renders every frame of a run with the soft renderer and encodes it as a GIF or MP4 (e.g.
+the examples/*.gif previews, or full-length movies at scanner resolution). The run is split
+into time segments rendered by a process pool into temporary files; the segments are read
+back in order and streamed to the encoder, with only a few segments in flight at a time.
+
+    python movie_export.py polar_angle --size 200 200 --fps 10 --duration 60 --out examples/polar_angle.gif
+    python movie_export.py eccentricity --size 1920 1080 --fps 30 --out eccentricity.mp4
+
+Encoding needs imageio (and imageio-ffmpeg for MP4).
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import argparse
+import collections
+import multiprocessing
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from paradigms import Paradigms, loadParameters
+from frame_schedule import compileSchedule
+from soft_render import softRenderer, Block_frames
+
+
+################################################################################################################
+## Constants
+
+Segment_frames = 128                            # movie frames per pool task
+Segments_in_flight = 2                          # x processes, bounds the temporary files on disk
+
+
+################################################################################################################
+## Functions
+
+
+# Worker side: one renderer per process, every segment saved to its own .npy
+_renderer = None
+
+def _initWorker(paradigm, params, size, supersampling):
+    global _renderer
+    _renderer = softRenderer(paradigm, params, size=size, supersampling=supersampling)
+
+
+def _renderSegment(task):
+    path, rows = task
+    width, height = _renderer.size
+    frames = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(len(rows), height, width, 3))
+    for i_frame in range(0, len(rows), Block_frames):
+        frames[i_frame:i_frame+Block_frames] = _renderer.render(rows[i_frame:i_frame+Block_frames])
+    frames.flush()
+    del frames
+    return path
+
+
+# Frames of the movie, in order, as (height, width, 3) uint8 arrays
+def movieFrames(paradigm, size=(200,200), fps=30., refresh_rate=60., start=0., duration=None,
+                supersampling=1, processes=None, params=None):
+    params = loadParameters(paradigm) if params is None else params
+    schedule = compileSchedule(paradigm, params, refresh_rate)
+    stop = len(schedule) if duration is None else min(int(round((start + duration) * refresh_rate)), len(schedule))
+    i_frames = np.round(np.arange(start * refresh_rate, stop, refresh_rate / fps)).astype(np.int64)
+    rows = schedule[i_frames[i_frames < len(schedule)]]
+
+    processes = processes or multiprocessing.cpu_count()
+    tmp_dir = tempfile.mkdtemp(prefix='retinotopy_movie_')
+    pool = multiprocessing.Pool(processes, _initWorker, (paradigm, params, tuple(size), supersampling))
+    try:
+        segments = iter(range(0, len(rows), Segment_frames))
+        in_flight = collections.deque()
+        while True:
+            while len(in_flight) < Segments_in_flight * processes:
+                first = next(segments, None)
+                if first is None:
+                    break
+                path = os.path.join(tmp_dir, 'segment_%08d.npy' % first)
+                in_flight.append(pool.apply_async(_renderSegment, ((path, rows[first:first+Segment_frames]),)))
+            if not in_flight:
+                break
+            # Read into memory and removed before the first frame is handed out: frames (views) kept by the caller
+            # would hold a memory map open, and Windows refuses to remove a mapped file
+            path = in_flight.popleft().get()
+            frames = np.load(path)
+            os.remove(path)
+            for frame in frames:
+                yield frame
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def exportMovie(paradigm, out, size=(200,200), fps=30., progress=None, **kwargs):
+    try:
+        import imageio
+    except ImportError:
+        raise ImportError('Encoding a movie needs imageio (pip install imageio imageio-ffmpeg)')
+
+    options = {'fps': fps}
+    if os.path.splitext(out)[1].lower() == '.gif':
+        options = {'duration': 1. / fps, 'loop': 0}
+    writer = imageio.get_writer(out, **options)
+    n_frames = 0
+    try:
+        for frame in movieFrames(paradigm, size, fps, **kwargs):
+            writer.append_data(np.ascontiguousarray(frame))
+            n_frames += 1
+            if progress is not None:
+                progress(n_frames)
+    finally:
+        writer.close()
+    return n_frames
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Export a stimulus movie (GIF or MP4) of a paradigm.')
+    parser.add_argument('paradigm', choices=Paradigms)
+    parser.add_argument('--size', type=int, nargs=2, default=(200,200), metavar=('WIDTH','HEIGHT'))
+    parser.add_argument('--fps', type=float, default=30.)
+    parser.add_argument('--rate', type=float, default=60., help='refresh rate (Hz) of the frame schedule')
+    parser.add_argument('--start', type=float, default=0., help='sec')
+    parser.add_argument('--duration', type=float, default=None, help='sec (default: until the end of the run)')
+    parser.add_argument('--supersampling', type=int, default=1, help='anti-aliasing (n x n samples per pixel)')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--out', required=True, help='.gif or .mp4 file')
+    args = parser.parse_args()
+
+    n_frames = exportMovie(args.paradigm, args.out, args.size, args.fps, refresh_rate=args.rate, start=args.start,
+                           duration=args.duration, supersampling=args.supersampling, processes=args.processes)
+    print('%d frames of %s saved in %s' % (n_frames, args.paradigm, args.out))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: paradigm parameters
+
+Reads the module constants (Cycle_duration, Mask_positions_number, Bar_paths, ...) of every
+stimulus script without importing it, so offline tools never pull in psychopy, and the
+paradigm and frame rate of a run folder from its name and log.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import ast
+import os
+import re
+import numpy as np
+
+
+################################################################################################################
+## Constants
+
+Paradigms = ['eccentricity', 'polar_angle', 'moving_bars', 'eccentricity_polar']
+Scripts_dir = os.path.dirname(os.path.abspath(__file__))
+Log_name = 'LogFile.log'
+Folder_suffixes = {'_ecc': 'eccentricity', '_polAng': 'polar_angle', '_bars': 'moving_bars',
+                   '_ecc_pol': 'eccentricity_polar'}                    # as in session.py
+
+
+################################################################################################################
+## Functions
+
+
+def paradigmScript(paradigm):
+    if paradigm not in Paradigms:
+        raise ValueError('Unknown paradigm "%s", choose one of: %s' % (paradigm, ', '.join(Paradigms)))
+    return os.path.join(Scripts_dir, paradigm + '.py')
+
+
+# Evaluate the top-level constant assignments (capitalised names) of a paradigm script
+def loadParameters(paradigm, **overrides):
+    with open(paradigmScript(paradigm)) as f:
+        tree = ast.parse(f.read())
+
+    params = {'np': np}
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        names = [target.id for target in node.targets if isinstance(target, ast.Name)]
+        if not names or not all(name[0].isupper() for name in names):
+            continue
+        if any(name in overrides for name in names):
+            params.update((name, overrides[name]) for name in names if name in overrides)
+            continue
+        statement = ast.Module(body=[node], type_ignores=[]) if hasattr(ast, 'TypeIgnore') else ast.Module(body=[node])
+        exec(compile(statement, paradigmScript(paradigm), 'exec'), params)
+
+    params.update(overrides)
+    del params['np']
+    params.pop('__builtins__', None)
+    params['Paradigm'] = paradigm
+    return params
+
+
+# Paradigm of a run folder, from its name (session.Folder_suffixes, plus createOutFolder's _N)
+def runParadigm(path):
+    name = os.path.basename(os.path.normpath(path))
+    suffixes = '|'.join(sorted(Folder_suffixes, key=len, reverse=True))
+    match = re.search('(%s)(_[0-9]+)?$' % suffixes, name)
+    if match is None:
+        raise ValueError('No paradigm suffix (%s) in the folder name %s' % (', '.join(Folder_suffixes), name))
+    return Folder_suffixes[match.group(1)]
+
+
+# Rate the schedule of a run was compiled at (the display rate), from its log
+def runFrameRate(path, default):
+    if not os.path.exists(os.path.join(path, Log_name)):
+        return default
+    with open(os.path.join(path, Log_name)) as f:
+        match = re.search(r'Frame schedule at ([0-9.]+) Hz', f.read())
+    return float(match.group(1)) if match else default
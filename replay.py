@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: replay of recorded runs
+
+Regenerates what the participant actually saw in a run folder, from the flips recorded in
+frames_state.npy (or frames_journal.npy): every flip is rendered from the schedule row it
+showed and lasts until the next flip, so dropped frames, late starts and TR-locked
+corrections are all in the output, unlike the nominal schedule of aperture_export.py.
+Per-TR apertures are the stimulus coverage weighted by how long every flip stayed on screen
+within the TR, on the TR grid of the recorded scanner triggers (trigger_times.npy) or, without
+them, of the run start. Runs are split in chunks rendered by one process pool, and a whole
+directory of sessions (default Dir_save) is replayed at once.
+
+    python replay.py D:/Mucklis_lab/Retinotopic_mapping/out/ --size 200 200 --tr 2
+    python replay.py 2024-03-12_NIA14_bars_2 --size 320 180 --images
+
+The paradigm is read from the folder name (session.Folder_suffixes, plus createOutFolder's
+_N), its parameters from the script and the frame rate from the log; the replay stops if they
+do not match the recorded state.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import argparse
+import multiprocessing
+import os
+import numpy as np
+
+from paradigms import Paradigms, loadParameters, runParadigm, runFrameRate
+from frame_schedule import compileSchedule
+from frame_journal import loadJournal
+from soft_render import softRenderer, Block_frames, Display_size
+
+
+################################################################################################################
+## Constants
+
+State_log_name = 'frames_state.npy'
+Frame_journal_name = 'frames_journal.npy'
+Trigger_times_name = 'trigger_times.npy'
+Replay_frames_name = 'replay_apertures.npy'     # per-flip apertures
+Replay_trs_name = 'replay_apertures_tr.npy'     # per-TR apertures
+Replay_images_name = 'replay_frames.npy'        # per-flip rgb images
+
+Chunk_flips = 512                               # flips per pool task (per-flip output)
+Chunk_trs = 4                                   # TRs per pool task (per-TR output)
+Flip_clock_tolerance = 1.                       # sec, first flip to its run time beyond which it is on another clock
+
+
+################################################################################################################
+## Functions
+
+
+def findRuns(directory):
+    runs = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        if State_log_name in files or Frame_journal_name in files:
+            try:
+                runParadigm(root)
+            except ValueError:
+                continue
+            runs.append(root)
+    return runs
+
+
+# Flips of a run folder: what was shown (schedule rows) from when to when, in run time
+def loadRun(path, paradigm=None, params=None):
+    paradigm = runParadigm(path) if paradigm is None else paradigm
+    params = loadParameters(paradigm) if params is None else params
+    frame_rate = runFrameRate(path, params['Refresh_rate'])
+    schedule = compileSchedule(paradigm, params, frame_rate)
+
+    if os.path.exists(os.path.join(path, State_log_name)):
+        flips = np.load(os.path.join(path, State_log_name))
+    elif os.path.exists(os.path.join(path, Frame_journal_name)):
+        flips = np.asarray(loadJournal(os.path.join(path, Frame_journal_name)))
+    else:
+        raise ValueError('No %s or %s in %s' % (State_log_name, Frame_journal_name, path))
+    if len(flips) == 0:
+        raise ValueError('No flip recorded in %s' % path)
+    if flips['i_frame'].max() >= len(schedule):
+        raise ValueError('%s: frame %d beyond the %d frames of the %s schedule, parameters changed since the run' %
+                         (path, flips['i_frame'].max(), len(schedule), paradigm))
+    rows = schedule[flips['i_frame']]
+    for name in ('polarity', 'cycle', 'fixation_color'):
+        if name in flips.dtype.names:
+            mismatch = np.count_nonzero(rows[name] != flips[name])
+            if mismatch > 0:
+                raise ValueError('%s: %s differs from the %s schedule in %d flips, parameters changed since the run' %
+                                 (path, name, paradigm, mismatch))
+
+    # Flips in run time, the TR grid's clock: runs whose flips were stamped on psychopy's logging clock are rebased on
+    # the run time their first frame was drawn for
+    onsets = np.asarray(flips['flip_time'], dtype=np.float64)
+    offset = onsets[0] - flips['t'][0]
+    if abs(offset) > Flip_clock_tolerance:
+        onsets = onsets - offset
+
+    # Every flip stays on screen until the next one, the last one for a typical frame
+    intervals = np.diff(onsets)
+    last = np.median(intervals) if len(intervals) > 0 else 1. / frame_rate
+    offsets = np.append(onsets[1:], onsets[-1] + last)
+
+    trigger_path = os.path.join(path, Trigger_times_name)
+    triggers = np.load(trigger_path) if os.path.exists(trigger_path) else np.zeros((0,))
+    return {'paradigm': paradigm, 'params': params, 'rows': rows, 'onsets': onsets, 'offsets': offsets,
+            'triggers': triggers}
+
+
+# Per TR, the flips on screen [first, last) and the fraction of the TR each of them lasted
+def trWeights(onsets, offsets, tr, origin, n_trs):
+    starts = origin + np.arange(n_trs) * tr
+    firsts = np.searchsorted(offsets, starts, side='right')
+    lasts = np.searchsorted(onsets, starts + tr, side='left')
+    weights = []
+    for start, first, last in zip(starts, firsts, lasts):
+        overlap = np.minimum(offsets[first:last], start + tr) - np.maximum(onsets[first:last], start)
+        weights.append(np.maximum(overlap, 0.) / tr)
+    return firsts, lasts, weights
+
+
+# Start of TR 0 (first recorded trigger, else the trigger the run waited for) and number of TRs
+def trGrid(run, tr, n_trs=None):
+    fixation_time = run['params']['Pre_post_stimuli_fixation_time']
+    origin = run['triggers'][0] if len(run['triggers']) > 0 else -fixation_time
+    if n_trs is None:
+        n_trs = int(np.ceil((run['offsets'][-1] + fixation_time - origin) / tr - 1e-6))
+    return origin, n_trs
+
+
+# Worker side: one renderer per paradigm and process, output written straight into the run's file
+_renderers = {}
+
+def _renderer(paradigm, size, display_size, supersampling, images):
+    key = (paradigm, size, display_size, supersampling, images)
+    if key not in _renderers:
+        _renderers[key] = softRenderer(paradigm, size=size, display_size=display_size, web=images, fixation=images,
+                                       supersampling=supersampling)
+    return _renderers[key]
+
+
+def _replayChunk(task):
+    out, first, paradigm, rows_blocks, weights_blocks, settings = task
+    renderer = _renderer(paradigm, *settings)
+    images = settings[-1]
+    output = np.load(out, mmap_mode='r+')
+    for i_out, rows in enumerate(rows_blocks):
+        blocks = [(renderer.render if images else renderer.coverage)(rows[i:i+Block_frames])
+                  for i in range(0, len(rows), Block_frames)]
+        if weights_blocks is not None:
+            weights = weights_blocks[i_out]
+            aperture = np.zeros(output.shape[1:], dtype=np.float32)
+            for i_block, block in enumerate(blocks):
+                aperture += np.tensordot(weights[i_block*Block_frames:(i_block+1)*Block_frames], block, axes=1)
+            output[first + i_out] = aperture
+        else:
+            block = np.concatenate(blocks)
+            output[first:first+len(block)] = block > 0 if output.dtype == bool else block
+    output.flush()
+    del output
+    return sum(len(rows) for rows in rows_blocks)
+
+
+# Output file and pool tasks of one run
+def _runTasks(run, out, size, display_size, tr, n_trs, supersampling, images):
+    width, height = size
+    settings = (size, display_size, supersampling, images)
+    rows = run['rows']
+    tasks = []
+    if tr is None:
+        if images:
+            shape, dtype = (len(rows), height, width, 3), np.uint8
+        else:
+            shape, dtype = (len(rows), height, width), (bool if supersampling == 1 else np.float32)
+        for first in range(0, len(rows), Chunk_flips):
+            tasks.append((out, first, run['paradigm'], [rows[first:first+Chunk_flips]], None, settings))
+    else:
+        origin, n_trs = trGrid(run, tr, n_trs)
+        firsts, lasts, weights = trWeights(run['onsets'], run['offsets'], tr, origin, n_trs)
+        shape, dtype = (n_trs, height, width), np.float32
+        for first in range(0, n_trs, Chunk_trs):
+            last = min(first + Chunk_trs, n_trs)
+            tasks.append((out, first, run['paradigm'], [rows[firsts[i]:lasts[i]] for i in range(first, last)],
+                          weights[first:last], settings))
+    output = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+    del output
+    return tasks, shape
+
+
+def replayRuns(paths, size=(200,200), display_size=Display_size, tr=None, n_trs=None, supersampling=1, images=False,
+               out_name=None, processes=None, progress=None):
+    if images and tr is not None:
+        raise ValueError('Images are per flip: use images without tr')
+    if out_name is None:
+        out_name = Replay_images_name if images else (Replay_frames_name if tr is None else Replay_trs_name)
+    size, display_size = (int(size[0]), int(size[1])), (int(display_size[0]), int(display_size[1]))
+
+    # Tasks of every run in one pool, so short runs do not leave cores idle
+    tasks, outputs = [], []
+    for path in paths:
+        run = loadRun(path)
+        out = os.path.join(path, out_name)
+        run_tasks, shape = _runTasks(run, out, size, display_size, tr, n_trs, supersampling, images)
+        tasks += run_tasks
+        outputs.append((out, run['paradigm'], len(run['rows']), shape))
+    n_flips = sum(len(rows) for task in tasks for rows in task[3])
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        n_done = 0
+        for n_rows in pool.imap_unordered(_replayChunk, tasks):
+            n_done += n_rows
+            if progress is not None:
+                progress(n_done, n_flips)
+    finally:
+        pool.close()
+        pool.join()
+    return outputs
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Replay the flips recorded in run folders, at any resolution.')
+    parser.add_argument('path', nargs='?', default=loadParameters(Paradigms[0])['Dir_save'],
+                        help='run folder, or directory of sessions searched for run folders (default Dir_save)')
+    parser.add_argument('--size', type=int, nargs=2, default=(200,200), metavar=('WIDTH','HEIGHT'))
+    parser.add_argument('--display-size', type=int, nargs=2, default=Display_size, metavar=('RESX','RESY'),
+                        help='screen resolution of the runs')
+    parser.add_argument('--tr', type=float, default=None, help='apertures per TR (sec), weighted by time on screen')
+    parser.add_argument('--n-trs', type=int, default=None, help='TRs acquired (default: until the end of the run)')
+    parser.add_argument('--supersampling', type=int, default=1, help='area-sampled anti-aliasing (n x n per pixel)')
+    parser.add_argument('--images', action='store_true', help='rgb images of every flip instead of apertures')
+    parser.add_argument('--out-name', default=None, help='.npy file written in every run folder')
+    parser.add_argument('--processes', type=int, default=None, help='default: all cores')
+    args = parser.parse_args()
+
+    paths = findRuns(args.path)
+    if len(paths) == 0:
+        parser.error('No run folder with %s or %s under %s' % (State_log_name, Frame_journal_name, args.path))
+    outputs = replayRuns(paths, args.size, args.display_size, args.tr, args.n_trs, args.supersampling, args.images,
+                         args.out_name, args.processes)
+    for out, paradigm, n_flips, shape in outputs:
+        print('%s: %d flips of %s replayed, %s saved in %s' % (os.path.dirname(out), n_flips, paradigm,
+                                                                'x'.join(str(n) for n in shape), out))
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: entry point
+
+Imports only what the chosen mode needs: psychopy (and pypixxlib with the button box) is
+loaded for 'run' only, while the offline modes never touch the GL stack.
+
+    python retinotopy.py run polar_angle eccentricity moving_bars --profile
+    python retinotopy.py dry-run eccentricity_polar
+    python retinotopy.py schedule eccentricity --rate 120 --out ecc_120Hz.npy
+    python retinotopy.py apertures moving_bars --size 100 100 --out bars_apertures.npy
+    python retinotopy.py movie polar_angle --duration 60 --out polar_angle.gif
+    python retinotopy.py render eccentricity --out ecc_frames.npy
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import runpy
+import sys
+
+from startup_profile import startupProfile
+
+profile = startupProfile()
+
+
+################################################################################################################
+## Constants
+
+Psychopy_modules = ['psychopy.core', 'psychopy.logging', 'psychopy.visual', 'psychopy.event', 'psychopy.gui']
+Offline_modes = {'schedule': 'frame_schedule', 'apertures': 'aperture_export', 'movie': 'movie_export',
+                 'render': 'soft_render'}
+Usage = 'usage: retinotopy.py {run,dry-run,%s} ...' % ','.join(sorted(Offline_modes))
+
+
+################################################################################################################
+## Functions
+
+
+def run(argv):
+    import argparse
+    from paradigms import Paradigms
+
+    parser = argparse.ArgumentParser(prog='retinotopy.py run', description='Run a session of paradigms.')
+    parser.add_argument('paradigms', nargs='*', metavar='paradigm', help='default: session.Session')
+    parser.add_argument('--profile', action='store_true', help='print the startup profile')
+    args = parser.parse_args(argv)
+    for paradigm in args.paradigms:
+        if paradigm not in Paradigms:
+            parser.error('unknown paradigm "%s", choose among: %s' % (paradigm, ', '.join(Paradigms)))
+
+    for name in Psychopy_modules:
+        profile.importModule(name)
+    session = profile.importModule('session')
+    session.runSession(args.paradigms or session.Session, profile)
+    if args.profile:
+        print('\n'.join(profile.report()))
+
+    from psychopy import core
+    core.quit()
+
+
+# Check the parameters and timing of paradigms without a window
+def dryRun(argv):
+    import argparse
+    from paradigms import Paradigms, loadParameters
+    from frame_schedule import compileSchedule
+
+    parser = argparse.ArgumentParser(prog='retinotopy.py dry-run', description='Check paradigms without a window.')
+    parser.add_argument('paradigms', nargs='+', choices=Paradigms, metavar='paradigm')
+    parser.add_argument('--rate', type=float, default=None, help='refresh rate (Hz), default: Refresh_rate')
+    args = parser.parse_args(argv)
+
+    for paradigm in args.paradigms:
+        params = loadParameters(paradigm)
+        rate = args.rate or params['Refresh_rate']
+        schedule = compileSchedule(paradigm, params, rate)
+        print('%s: %.3f sec. of stimuli (+ 2 x %.1f sec. of fixation), %d frames at %.2f Hz, %d cycles' %
+              (paradigm, params['Total_time'], params['Pre_post_stimuli_fixation_time'], len(schedule), rate,
+               schedule['cycle'].max() + 1))
+    if any(name.split('.')[0] == 'psychopy' for name in sys.modules):
+        print('Warning: psychopy was imported')
+
+
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        sys.exit(Usage)
+    mode, argv = sys.argv[1], sys.argv[2:]
+
+    if mode == 'run':
+        run(argv)
+    elif mode == 'dry-run':
+        dryRun(argv)
+    elif mode in Offline_modes:
+        sys.argv = ['retinotopy.py ' + mode] + argv
+        runpy.run_module(Offline_modes[mode], run_name='__main__', alter_sys=True)
+    else:
+        sys.exit(Usage)
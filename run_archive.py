@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: run archive
+
+Packs a run folder in one file: metadata (subject, operator, start, paradigm parameters,
+parsed once from LogFile.log), the log text, frame intervals, cycle changes, button events,
+trigger times and the per-flip state. Every array is cut in chunks of rows, compressed with
+zlib (chunks that do not compress are stored as they are), and a JSON index at the end of the
+file gives dtype, shape and where every chunk is. The reader memory-maps the file and only
+decompresses the chunks of the rows asked for; arrays written uncompressed (raw) come back as
+views of the memory map, with no copy.
+
+    python run_archive.py D:/Mucklis_lab/Retinotopic_mapping/out/       # archive every run folder below
+    python run_archive.py 2024-03-12_NIA14_ecc --raw frames_state            # state log memory-mappable as is
+
+    archive = runArchive('2024-03-12_NIA14_ecc/run_archive.rma')
+    archive.metadata['subject_code'], archive['frames_state'][1000:2000]['flip_time']
+
+Layout: magic, chunks (64-byte aligned), JSON index, trailer (index offset, index size, magic).
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import argparse
+import ast
+import json
+import os
+import re
+import struct
+import zlib
+import numpy as np
+
+from paradigms import loadParameters, runParadigm, runFrameRate
+from frame_journal import loadJournal, droppedFrames
+
+
+################################################################################################################
+## Constants
+
+Run_archive_name = 'run_archive.rma'
+Log_name = 'LogFile.log'
+Run_files = ['Frames_durations_name', 'Frame_journal_name', 'State_log_name', 'Phase_timing_name',
+             'Button_events_name', 'Button_times_name', 'Trigger_times_name']    # script constants, as archived
+
+Magic = b'RMARCH01'
+Trailer = struct.Struct('<QQ8s')                # index offset, index size, magic
+Alignment = 64                                  # bytes, chunk offsets
+Chunk_bytes = 1 << 20                           # uncompressed bytes per chunk
+Compression_level = 6
+Min_ratio = 0.9                                 # compressed chunks larger than this x raw are stored raw
+
+Cycle_change_dtype = np.dtype([
+    ('time', np.float64),                       # run time of the change (sec.), from the log
+    ('cycle', np.int16),                        # cycle (or bar orientation) started, from 0
+    ('polar', np.int8),                         # 1: wedge cycle of eccentricity_polar
+])
+
+
+################################################################################################################
+## Functions
+
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return dict((str(key), _jsonable(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def writeArchive(path, arrays, metadata=None, raw=()):
+    index = {'metadata': _jsonable(metadata or {}), 'arrays': {}}
+    with open(path + '.tmp', 'wb') as f:
+        f.write(Magic)
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(np.atleast_1d(array))
+            row_bytes = max(array[:1].nbytes, 1)
+            chunk_rows = max(len(array) if name in raw else Chunk_bytes // row_bytes, 1)
+            chunks = []
+            for first in range(0, len(array), chunk_rows):
+                data = array[first:first+chunk_rows].tobytes()
+                compressed = False
+                if name not in raw:
+                    packed = zlib.compress(data, Compression_level)
+                    if len(packed) < Min_ratio * len(data):
+                        data, compressed = packed, True
+                f.write(b'\0' * (-f.tell() % Alignment))
+                chunks.append([f.tell(), len(data), compressed])
+                f.write(data)
+            index['arrays'][name] = {'descr': repr(np.lib.format.dtype_to_descr(array.dtype)),
+                                     'shape': list(array.shape), 'chunk_rows': chunk_rows, 'chunks': chunks}
+        index_offset = f.tell()
+        encoded = json.dumps(index).encode('utf8')
+        f.write(encoded)
+        f.write(Trailer.pack(index_offset, len(encoded), Magic))
+    os.replace(path + '.tmp', path)
+    return os.path.getsize(path)
+
+
+class archivedArray(object):
+    def __init__(self, buffer, entry):
+        self.buffer = buffer
+        self.dtype = np.lib.format.descr_to_dtype(ast.literal_eval(entry['descr']))
+        self.shape = tuple(entry['shape'])
+        self.chunk_rows = entry['chunk_rows']
+        self.chunks = entry['chunks']
+        self._cached = (None, None)             # last chunk decompressed
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _chunk(self, i_chunk):
+        if self._cached[0] == i_chunk:
+            return self._cached[1]
+        offset, size, compressed = self.chunks[i_chunk]
+        data = self.buffer[offset:offset+size]
+        if compressed:
+            data = zlib.decompress(data)
+        n_rows = min(self.chunk_rows, self.shape[0] - i_chunk * self.chunk_rows)
+        rows = np.frombuffer(data, dtype=self.dtype, count=n_rows * int(np.prod(self.shape[1:]))).reshape(
+            (n_rows,) + self.shape[1:])
+        self._cached = (i_chunk, rows)
+        return rows
+
+    # Rows [first, last), only their chunks read
+    def rows(self, first, last):
+        first, last = max(first, 0), min(last, self.shape[0])
+        if last <= first:
+            return np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+        i_chunks = range(first // self.chunk_rows, (last - 1) // self.chunk_rows + 1)
+        block = np.concatenate([self._chunk(i_chunk) for i_chunk in i_chunks])
+        offset = i_chunks[0] * self.chunk_rows
+        return block[first-offset:last-offset]
+
+    def read(self):
+        return self.rows(0, self.shape[0])
+
+    def __array__(self, dtype=None, copy=None):
+        return self.read() if dtype is None else self.read().astype(dtype)
+
+    def __getitem__(self, key):
+        first, rest = (key[0], key[1:]) if isinstance(key, tuple) and len(key) > 0 else (key, ())
+        if isinstance(first, (int, np.integer)):
+            i_row = first + self.shape[0] if first < 0 else first
+            if not 0 <= i_row < self.shape[0]:
+                raise IndexError('Row %d out of %d rows' % (first, self.shape[0]))
+            return self.rows(i_row, i_row + 1)[(0,) + rest]
+        if isinstance(first, slice):
+            start, stop, step = first.indices(self.shape[0])
+            i_rows = range(start, stop, step)
+            if len(i_rows) == 0:
+                return self.rows(0, 0)[(slice(None),) + rest]
+            low, high = min(i_rows[0], i_rows[-1]), max(i_rows[0], i_rows[-1]) + 1
+            return self.rows(low, high)[(np.asarray(i_rows) - low,) + rest]
+        return self.read()[key]
+
+
+class runArchive(object):
+    def __init__(self, path):
+        self.path = path
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        index_offset, index_size, magic = Trailer.unpack(self.buffer[-Trailer.size:].tobytes())
+        if magic != Magic or self.buffer[:len(Magic)].tobytes() != Magic:
+            raise ValueError('%s is not a run archive' % path)
+        index = json.loads(self.buffer[index_offset:index_offset+index_size].tobytes().decode('utf8'))
+        self.metadata = index['metadata']
+        self.entries = index['arrays']
+
+    def names(self):
+        return list(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    # Raw arrays as views of the memory map, compressed ones read lazily
+    def __getitem__(self, name):
+        array = archivedArray(self.buffer, self.entries[name])
+        if len(array.chunks) == 1 and not array.chunks[0][2]:
+            return np.ndarray(array.shape, dtype=array.dtype, buffer=self.buffer, offset=array.chunks[0][0])
+        if len(array.chunks) == 0:
+            return np.zeros(array.shape, dtype=array.dtype)
+        return array
+
+    def load(self, name):
+        return np.asarray(self[name])
+
+
+# Subject, operator and start of the run, and the cycle changes, from the lines of LogFile.log
+def parseLog(text):
+    metadata = {}
+    changes = []
+    for line in text.splitlines():
+        message = line.split('\t')[-1].strip()
+        match = re.match(r'-+ (.+?) -+$', message)
+        if match and 'start' not in metadata:
+            metadata['start'] = match.group(1)
+        elif message.startswith('Saving in folder: '):
+            metadata['folder'] = message[len('Saving in folder: '):]
+        elif message.startswith('Operator: '):
+            metadata['operator'] = message[len('Operator: '):]
+        elif message.startswith('Subject. Code: '):
+            fields = message[len('Subject. Code: '):].split(' - ')
+            metadata['subject_code'] = fields[0]
+            for field in fields[1:]:
+                key, _, value = field.partition(': ')
+                metadata['subject_' + key.lower()] = value
+        elif re.match(r'Overall, [0-9]+ frames were dropped', message):
+            metadata['dropped_frames'] = int(message.split()[1])
+        else:
+            match = re.match(r'(First|Change) (cycle|orientation)(.*)\. Number ([0-9]+)/[0-9]+ at ([-+0-9.eE]+)',
+                             message)
+            if match:
+                changes.append((float(match.group(5)), int(match.group(4)) - 1,
+                                'polar' in match.group(3).lower()))
+    return metadata, np.array(changes, dtype=Cycle_change_dtype)
+
+
+def archiveRun(path, out=None, paradigm=None, params=None, raw=()):
+    paradigm = runParadigm(path) if paradigm is None else paradigm
+    params = loadParameters(paradigm) if params is None else params
+    out = os.path.join(path, Run_archive_name) if out is None else out
+
+    metadata = {'paradigm': paradigm, 'parameters': params}
+    arrays = {}
+    if os.path.exists(os.path.join(path, Log_name)):
+        with open(os.path.join(path, Log_name), 'rb') as f:
+            log = f.read()
+        log_metadata, arrays['cycle_changes'] = parseLog(log.decode('utf8', 'replace'))
+        metadata.update(log_metadata)
+        arrays['log'] = np.frombuffer(log, dtype=np.uint8)
+    for constant in Run_files:
+        file_name = params.get(constant)
+        if file_name is None or not os.path.exists(os.path.join(path, file_name)):
+            continue
+        if constant == 'Frame_journal_name':
+            array = np.asarray(loadJournal(os.path.join(path, file_name)))       # also a journal left open by a crash
+        else:
+            array = np.load(os.path.join(path, file_name))
+        arrays[os.path.splitext(file_name)[0]] = array
+
+    # Dropped frames from the recorded intervals, at the rate of the run's schedule
+    intervals = None
+    if 'frames_journal' in arrays:
+        intervals = arrays['frames_journal']['interval'][1:]
+    elif 'frames_durations' in arrays:
+        intervals = arrays['frames_durations']
+    if intervals is not None:
+        metadata['frame_rate'] = runFrameRate(path, params['Refresh_rate'])
+        metadata['dropped_frames'] = droppedFrames(intervals, metadata['frame_rate'])
+    size = writeArchive(out, arrays, metadata, raw)
+    return out, sorted(arrays), size
+
+
+def logText(archive):
+    return archive.load('log').tobytes().decode('utf8', 'replace')
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Pack run folders in one chunked, compressed and indexed file each.')
+    parser.add_argument('path', nargs='?', default=loadParameters('eccentricity')['Dir_save'],
+                        help='run folder, or directory of sessions searched for run folders (default Dir_save)')
+    parser.add_argument('--raw', nargs='*', default=[], metavar='NAME',
+                        help='arrays stored uncompressed, memory-mapped as they are (e.g. frames_state)')
+    args = parser.parse_args()
+
+    n_runs = 0
+    for root, dirs, files in os.walk(args.path):
+        dirs.sort()
+        if Log_name not in files:
+            continue
+        try:
+            runParadigm(root)
+        except ValueError:
+            continue
+        out, names, size = archiveRun(root, raw=args.raw)
+        n_runs += 1
+        print('%s: %s in %s (%.1f kB)' % (root, ', '.join(names), out, size / 1024.))
+    if n_runs == 0:
+        parser.error('No run folder with %s under %s' % (Log_name, args.path))
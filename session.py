@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: session
+
+Runs several paradigms back-to-back in one process: psychopy is imported, the window opened
+and the participant dialog shown once, and the stimuli of every queued paradigm are built
+before the first run. Each run still gets its own out folder, log file, frames_durations.npy
+and button events, so the outputs are the same as running the scripts one by one.
+
+    python session.py polar_angle eccentricity moving_bars
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+from psychopy import visual, core, logging, gui
+from psychopy import prefs as pyschopy_prefs
+
+import importlib
+import os
+import sys
+import numpy as np
+from datetime import datetime as dt
+from time import gmtime, strftime
+
+from paradigms import Paradigms
+from frame_journal import loadJournal
+from async_log import asyncLogFile
+from run_archive import archiveRun
+from startup_profile import startupProfile
+
+
+################################################################################################################
+## Paths and Constants
+
+Session = ['polar_angle', 'eccentricity', 'moving_bars']            # default order of the runs
+Folder_suffixes = {'eccentricity': '_ecc', 'polar_angle': '_polAng', 'moving_bars': '_bars',
+                   'eccentricity_polar': '_ecc_pol'}
+
+Fullscreen = True
+DEBUG_MODE = False                          # Debug mode
+BUTTON_BOX = True                           # Button box monitoring
+Dir_save = 'D:/Mucklis_lab/Retinotopic_mapping/out/'
+Session_log_name = '_session.log'
+Log_name = 'LogFile.log'
+Frames_durations_name = 'frames_durations.npy'
+Button_events_name = 'button_events.npy'
+Run_archive_name = 'run_archive.rma'
+
+# Button box
+Button_coding = [-1,-2,-3,-4,-5]            #red,yellow,green,blue,white(i.e. trigger)
+IsMRI = 0                                   #MRI inverses the bit polarities
+Poll_interval = 0.001                       # sec between two reads of the DIN log
+Poll_interval_idle = 0.004                  # sec, longest interval once the log is idle
+Poll_measure = False                        # Log poll rate, CPU time and detection latency
+Button_service = False                      # Poll in a separate process, state in shared memory (button_service)
+Sync_interval = 1.                          # sec between two device clock samples (clock_sync), None: no sync
+Run_archive = True                          # Pack every run folder in one indexed file after the last run (run_archive)
+
+
+################################################################################################################
+## Function
+
+
+# Import a paradigm script and give it the variables its __main__ would define
+def loadParadigm(paradigm, win, **variables):
+    module = importlib.import_module(paradigm)
+    module.resX, module.resY = win.size
+    for name, value in variables.items():
+        setattr(module, name, value)
+    return module
+
+
+def runParadigm(module, win, globalClock, stimuli, path_out, header, wait_ready=True, button_thread=None):
+    module.path_out = path_out
+
+    # Own log file for the run
+    if module.Async_log:
+        run_log = asyncLogFile(path_out+Log_name,level=logging.DATA,filemode='w',encoding='utf8')
+    else:
+        run_log = logging.LogFile(path_out+Log_name,level=logging.DATA,filemode='w',encoding='utf8')
+    module.lastLog = run_log
+    logging.data("------------- " + strftime("%Y-%m-%d %H:%M:%S", gmtime()) + " -------------")
+    logging.data("Saving in folder: " + path_out)
+    for line in header:
+        logging.data(line)
+    logging.data('***** Starting *****')
+
+    # Frame intervals of this run only
+    win.frameIntervals = []
+    win.nDroppedFrames = 0
+    if button_thread is not None:
+        run_events = button_thread.events.reader(from_start=False)
+
+    # Main stimulation
+    try:
+        module.main(win, globalClock, stimuli=stimuli, wait_ready=wait_ready)
+    except Exception as e:
+        logging.log(e,level=logging.ERROR)
+
+    if button_thread is not None:
+        events = run_events.drain()
+        np.save(path_out+Button_events_name, events)
+        logging.data('%d button events saved in %s (%d overwritten)' % (len(events),path_out+Button_events_name,run_events.lost))
+
+    logging.data('Overall, %i frames were dropped.' % win.nDroppedFrames)
+    if module.Frame_journal and os.path.exists(path_out+module.Frame_journal_name):
+        np.save(path_out+Frames_durations_name,loadJournal(path_out+module.Frame_journal_name)['interval'][1:])
+    else:
+        np.save(path_out+Frames_durations_name,win.frameIntervals[1:])
+    logging.data(pyschopy_prefs)                        # after the run, off the path to the first frame
+    logging.data('***** End *****')
+
+    if module.Async_log:
+        run_log.close()
+    else:
+        logging.flush()
+        logging.root.removeTarget(run_log)
+
+
+
+
+def runSession(session, profile=None):
+    if profile is None:
+        profile = startupProfile()
+
+    # Open a dialog window and promt for participant info
+    myDlg = gui.Dlg(title=" ")
+    myDlg.addText('Participant info')
+    myDlg.addField('Subject code:')
+    myDlg.addField('Operator')
+    participant_info = myDlg.show()
+    if not myDlg.OK:
+        return
+
+    # Experiment variables
+    today_date = dt.today().strftime('%Y-%m-%d')        # Date (mm/dd/yy)
+    operator = participant_info[1]                      # Operator
+    subject_code = participant_info[0]                  # Subject-code
+
+    if not os.path.exists(Dir_save):
+        os.makedirs(Dir_save)
+    globalClock = core.Clock()
+
+    # Set the log module to report warnings to the standard output window
+    logging.setDefaultClock(globalClock)
+    logging.console.setLevel(logging.WARNING)
+    session_log = logging.LogFile(Dir_save + today_date + '_' + subject_code + Session_log_name,
+                                  level=logging.DATA,filemode='a',encoding='utf8')
+    logging.data("------------- Session " + strftime("%Y-%m-%d %H:%M:%S", gmtime()) + " -------------")
+    logging.data("Runs: " + ', '.join(session))
+    header = ["Operator: " + operator + "\n", "Subject. Code: " + subject_code]
+
+    # Create and start buttonBox thread
+    button_thread = None
+    if BUTTON_BOX:
+        if Button_service:
+            buttonBoxThread = profile.importModule('button_service').buttonBoxService
+        else:
+            button_box = profile.importModule('button_box')
+            with profile.phase('button box (pypixxlib)'):
+                button_box.loadDpx()
+            buttonBoxThread = button_box.buttonBoxThread
+        button_thread = buttonBoxThread(1, "button box check", is_mri=IsMRI, button_coding=Button_coding,
+                                        poll_interval=Poll_interval, poll_interval_idle=Poll_interval_idle,
+                                        measure=Poll_measure, sync_interval=Sync_interval)
+        with profile.phase('button box start'):
+            button_thread.start()
+
+    # Start window
+    with profile.phase('window creation'):
+        win = visual.Window([500,500], monitor="mon", screen=1, units="norm", fullscr=Fullscreen,
+                            allowStencil=True) # norm
+    win.recordFrameIntervals = True
+
+    # Stimuli of every run, built before the first one, at the display rate measured once
+    with profile.phase('display rate'):
+        measured_rate = win.getActualFrameRate()
+    modules, stimuli = [], []
+    for paradigm in session:
+        profile.importModule(paradigm)
+        with profile.phase('stimuli of ' + paradigm):
+            module = loadParadigm(paradigm, win, DEBUG_MODE=DEBUG_MODE, BUTTON_BOX=BUTTON_BOX,
+                                  button_thread=button_thread)
+            modules.append(module)
+            stimuli.append(module.prepareStimuli(win, measured_rate))
+    with profile.phase('first flip'):
+        win.flip()
+    profile.mark('ready')
+    for line in profile.report():
+        logging.data(line)
+
+    # Runs, back-to-back: only the first one waits for the operator before the scanner trigger
+    paths_out = []
+    for i_run, (paradigm, module, run_stimuli) in enumerate(zip(session, modules, stimuli)):
+        path_out = module.createOutFolder(Dir_save + today_date + '_' + subject_code + Folder_suffixes[paradigm])
+        logging.data('Run %d/%d: %s in %s' % (i_run+1, len(session), paradigm, path_out))
+        logging.flush()
+        logging.root.removeTarget(session_log)
+        runParadigm(module, win, globalClock, run_stimuli, path_out, header, wait_ready=(i_run == 0),
+                    button_thread=button_thread)
+        logging.root.addTarget(session_log)
+        paths_out.append(path_out)
+
+    # Stop buttonBox thread
+    if BUTTON_BOX:
+        button_thread.stop()
+        button_thread.join()
+
+    # Archives once the scanner is done, so the only wait between runs is the trigger
+    if Run_archive:
+        for paradigm, path_out in zip(session, paths_out):
+            out, names, size = archiveRun(path_out, path_out+Run_archive_name, paradigm=paradigm)
+            logging.data('%s archived in %s (%.1f kB)' % (path_out, out, size / 1024.))
+
+    logging.data('***** End of the session *****')
+    win.close()
+
+
+
+
+if __name__ == "__main__":
+
+    session = sys.argv[1:] or Session
+    for paradigm in session:
+        if paradigm not in Paradigms:
+            sys.exit('Unknown paradigm "%s", choose among: %s' % (paradigm, ', '.join(Paradigms)))
+
+    runSession(session)
+    core.quit()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: headless software renderer
+
+Pure NumPy reproduction of what the four scripts draw (checkerboard RadialStim ring and wedge,
+bar GratingStim, external aperture, spider web and fixation cross), rendered from the frame
+schedule in blocks of frames at any resolution, with no OpenGL or display.
+
+The output covers a window of `size` pixels centred on the screen of a `display_size`
+projector, with the scale set by the heights (pixels stay square). Angles follow psychopy:
+RadialStim angles run clockwise from 12 o'clock and `ori` rotates clockwise.
+
+    python soft_render.py eccentricity --size 200 200 --frames 0 600 --out ecc_frames.npy
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import argparse
+import numpy as np
+
+from paradigms import Paradigms, loadParameters
+from frame_schedule import compileSchedule, scheduleLength
+from mask_bank import crownMaskLimits
+
+
+################################################################################################################
+## Constants
+
+Display_size = (1920, 1080)                     # projector resolution the scripts run at (resX, resY)
+Block_frames = 64                               # frames rendered at once
+
+Checker_size = 16                               # grating_texture = np.tile([[1,-1],[-1,1]], (8,8))
+Ecc_angular_cycles = 2
+Polar_angular_cycles = 4
+Polar_size = 1.3                                # x resY
+Bar_checks = (2, 24)                            # grating_texture = np.tile([[1,-1],[-1,1]], (1,12))
+Web_line_length = 1.4                           # norm
+Fixation_size = 20                              # pix
+Fixation_line_width = 4                         # pix
+Fixation_rgb = np.array([[1., -1., -1.], [-1., 1., -1.]])      # red, green
+
+
+################################################################################################################
+## Functions
+
+
+def toUint8(values):
+    return np.clip(np.round((np.asarray(values) + 1.) * 127.5), 0, 255).astype(np.uint8)
+
+
+class softRenderer(object):
+    def __init__(self, paradigm, params=None, size=(200,200), display_size=Display_size, web=True,
+                 fixation=True, supersampling=1):
+        self.paradigm = paradigm
+        self.params = loadParameters(paradigm) if params is None else params
+        self.size = (int(size[0]), int(size[1]))
+        self.display_size = display_size
+        self.web = web and self.params.get('Spyder_grid', True)
+        self.fixation = fixation
+
+        # Pixel centres in display pixels, y up, origin at the centre of the screen
+        resX, resY = display_size
+        width, height = self.size
+        self.scale = resY / float(height)
+        self.pixel_half = max(self.scale / supersampling, 1.) / 2.         # half width of a 1 display-pixel line
+        offsets = (np.arange(supersampling) + 0.5) / supersampling - 0.5
+        x = (np.arange(width)[:,None] + 0.5 + offsets[None,:] - width/2.).reshape(-1) * self.scale
+        y = (height/2. - np.arange(height)[:,None] - 0.5 - offsets[None,:]).reshape(-1) * self.scale
+        self.supersampling = supersampling
+        self.x, self.y = [grid.astype(np.float32) for grid in np.meshgrid(x, y)]
+        self.r = np.hypot(self.x, self.y)
+        self.theta = np.mod(np.degrees(np.arctan2(self.x, self.y)), 360.).astype(np.float32)
+
+        # External aperture (circle, External_ring_size in norm along y)
+        self.aperture = self.r <= self.params['External_ring_size'] / 2. * resY / 2.
+
+        if paradigm in ('eccentricity', 'eccentricity_polar'):
+            self._prepareRing(resY)
+        if paradigm in ('polar_angle', 'eccentricity_polar'):
+            self._prepareWedge(resY)
+        if paradigm == 'moving_bars':
+            self.bar_size = (self.params['Bar_length'][0]*resX, self.params['Bar_length'][1]*resY)
+        self.background = self._background(resX, resY)
+
+    def _prepareRing(self, resY):
+        params = self.params
+        size_ecc_pxl = resY * params['Eccentricity_size']
+        radius = size_ecc_pxl / 2.
+        self.ring_inside = self.r < radius
+        radial_index = np.floor(self.r / radius * Checker_size).astype(np.int32)
+        angular_index = np.floor(self.theta / 360. * Checker_size * Ecc_angular_cycles).astype(np.int32)
+        self.ring_checker = np.where((radial_index + angular_index) % 2 == 0, 1, -1).astype(np.int8)
+
+        # Mask texel under every pixel, and the (mask_begin, mask_end) of every crown position
+        mask_length = int(size_ecc_pxl/2)
+        self.ring_texel = np.floor(self.r / radius * mask_length).astype(np.int32)
+        self.mask_begin, self.mask_end = crownMaskLimits(size_ecc_pxl, params['Mask_positions_number'],
+                                                         params['Thickness_circular_crown'],
+                                                         params['Thickness_multiplication_factor'])
+
+    def _prepareWedge(self, resY):
+        radius = resY * Polar_size / 2.
+        self.wedge_inside = self.r < radius
+        self.wedge_radial = np.floor(self.r / radius * Checker_size).astype(np.int32)
+        self.wedge_start = self.params['Initial_wedge_pos']
+        self.wedge_width = self.params['Wedge_width']
+
+    # Static layer: grey background and spider web, as float rgb values in [-1,1]
+    def _background(self, resX, resY):
+        background = np.zeros(self.x.shape, dtype=np.float32)
+        if self.web:
+            rings = self.params['Spyder_rings']
+            web_size = self.params['Web_size'][1]
+            web = np.zeros(self.x.shape, dtype=bool)
+            for i_dim in range(rings):
+                web |= np.abs(self.r - web_size * (i_dim+1) / rings * resY/2.) <= self.pixel_half
+            web |= (np.abs(self.y) <= self.pixel_half) & (np.abs(self.x) <= Web_line_length * resX/2.)
+            web |= (np.abs(self.x) <= self.pixel_half) & (np.abs(self.y) <= Web_line_length * resY/2.)
+            background[web] = 1.
+        return background
+
+    # Checkerboard value {-1,0,1} of the stimuli for a block of schedule rows (0 where nothing is drawn)
+    def stimulus(self, rows):
+        n_frames = len(rows)
+        values = np.zeros((n_frames,) + self.x.shape, dtype=np.int8)
+        sign = np.where(rows['polarity'] == 0, 1, -1).astype(np.int8)[:,None,None]
+
+        if self.paradigm in ('eccentricity', 'eccentricity_polar'):
+            mask_index = rows['mask_index']
+            mask_begin = self.mask_begin[mask_index][:,None,None]
+            mask_end = self.mask_end[mask_index][:,None,None]
+            visible = (self.ring_texel >= mask_begin) & (self.ring_texel < mask_end) & self.ring_inside
+            checker = self.ring_checker[None] * sign
+            values[visible] = checker[visible]
+
+        if self.paradigm in ('polar_angle', 'eccentricity_polar'):
+            # Angles in the frame of the rotated wedge, in [0,360) (orientation is already in [0,360))
+            stim_angle = self.theta[None] - np.asarray(rows['orientation'], dtype=np.float32)[:,None,None]
+            stim_angle += 360. * (stim_angle < 0)
+            wedge_angle = stim_angle - np.float32(self.wedge_start)
+            wedge_angle += 360. * (wedge_angle < 0)
+            visible = (wedge_angle < self.wedge_width) & self.wedge_inside
+            angular_index = np.floor(stim_angle / 360. * Checker_size * Polar_angular_cycles).astype(np.int32)
+            checker = np.where((angular_index + self.wedge_radial) % 2 == 0, 1, -1).astype(np.int8) * sign
+            values[visible] = checker[visible]
+
+        if self.paradigm == 'moving_bars':
+            half_height = self.display_size[1] / 2.
+            ori = np.radians(rows['orientation']).astype(np.float32)[:,None,None]
+            dx = self.x[None] - (rows['bar_pos'][:,0] * half_height)[:,None,None]
+            dy = self.y[None] - (rows['bar_pos'][:,1] * half_height)[:,None,None]
+            u = dx * np.cos(ori) - dy * np.sin(ori)
+            v = dx * np.sin(ori) + dy * np.cos(ori)
+            width, height = self.bar_size
+            visible = (np.abs(u) < width/2.) & (np.abs(v) < height/2.)
+            column = np.floor((u + width/2.) / width * Bar_checks[1]).astype(np.int32)
+            row = np.floor((height/2. - v) / height * Bar_checks[0]).astype(np.int32)
+            checker = np.where((row + column) % 2 == 0, 1, -1).astype(np.int8) * sign
+            values[visible] = checker[visible]
+
+        values[:, ~self.aperture] = 0
+        return values
+
+    # Where the stimulus is drawn (inside the external aperture), for a block of schedule rows
+    def coverage(self, rows):
+        covered = self.stimulus(rows) != 0
+        return self._downsample(covered.astype(np.float32))
+
+    # Full frames as rgb uint8 (n_frames, height, width, 3)
+    def render(self, rows):
+        values = self.stimulus(rows)
+        if self.supersampling > 1:
+            frames = np.where(values != 0, values, self.background[None]).astype(np.float32)
+            frames = np.repeat(frames[..., None], 3, axis=-1)
+            if self.fixation:
+                self._drawFixation(frames, rows, Fixation_rgb)
+            return toUint8(self._downsample(frames))
+
+        # Straight to uint8 through a lookup table of the three checkerboard levels
+        levels = toUint8([-1., 0., 1.])
+        frames = np.where(values != 0, levels[values + 1], toUint8(self.background)[None])
+        frames = np.repeat(frames[..., None], 3, axis=-1)
+        if self.fixation:
+            self._drawFixation(frames, rows, toUint8(Fixation_rgb))
+        return frames
+
+    def _drawFixation(self, frames, rows, colors):
+        half_width = max(Fixation_line_width / 2., self.pixel_half)
+        for fixation_ori in np.unique(rows['fixation_ori']):
+            ori = np.radians(fixation_ori)
+            u = self.x * np.cos(ori) - self.y * np.sin(ori)
+            v = self.x * np.sin(ori) + self.y * np.cos(ori)
+            cross = ((np.abs(u) <= half_width) & (np.abs(v) <= Fixation_size)) | \
+                ((np.abs(v) <= half_width) & (np.abs(u) <= Fixation_size))
+            same_ori = rows['fixation_ori'] == fixation_ori
+            for color_index in (0, 1):
+                i_frames = np.nonzero(same_ori & (rows['fixation_color'] == color_index))[0]
+                if len(i_frames) > 0:
+                    block = frames[i_frames]
+                    block[:, cross] = colors[color_index]
+                    frames[i_frames] = block
+
+    # Average supersampled pixels back to the output grid (area sampling)
+    def _downsample(self, images):
+        n = self.supersampling
+        if n == 1:
+            return images
+        height, width = self.size[1], self.size[0]
+        shape = (images.shape[0], height, n, width, n) + images.shape[3:]
+        return images.reshape(shape).mean(axis=(2, 4))
+
+
+# Blocks of rendered frames for a whole run (or frames [start, stop) of it)
+def renderRun(paradigm, size=(200,200), refresh_rate=60., start=0, stop=None, step=1,
+              block_frames=Block_frames, params=None, **kwargs):
+    params = loadParameters(paradigm) if params is None else params
+    schedule = compileSchedule(paradigm, params, refresh_rate)
+    renderer = softRenderer(paradigm, params, size=size, **kwargs)
+    rows = schedule[start:stop:step]
+    for i_block in range(0, len(rows), block_frames):
+        yield renderer.render(rows[i_block:i_block+block_frames])
+
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Render frames of a paradigm without OpenGL.')
+    parser.add_argument('paradigm', choices=Paradigms)
+    parser.add_argument('--size', type=int, nargs=2, default=(200,200), metavar=('WIDTH','HEIGHT'))
+    parser.add_argument('--rate', type=float, default=60., help='refresh rate (Hz)')
+    parser.add_argument('--frames', type=int, nargs=2, default=(0,600), metavar=('START','STOP'))
+    parser.add_argument('--step', type=int, default=1)
+    parser.add_argument('--out', required=True, help='.npy file for the (frames, height, width, 3) array')
+    args = parser.parse_args()
+
+    params = loadParameters(args.paradigm)
+    n_frames = len(range(*slice(args.frames[0], args.frames[1], args.step).indices(scheduleLength(params, args.rate))))
+    frames = np.lib.format.open_memmap(args.out, mode='w+', dtype=np.uint8,
+                                       shape=(n_frames, args.size[1], args.size[0], 3))
+    i_frame = 0
+    for block in renderRun(args.paradigm, args.size, args.rate, args.frames[0], args.frames[1], args.step, params=params):
+        frames[i_frame:i_frame+len(block)] = block
+        i_frame += len(block)
+    frames.flush()
+    print('%d frames of %s saved in %s' % (n_frames, args.paradigm, args.out))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: startup profile
+
+Wall time of every import and startup phase (imports, window creation, stimulus
+construction, first flip), so the time between launching a script and being ready for the
+scanner can be followed after every change.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import contextlib
+import importlib
+import sys
+import time
+
+
+################################################################################################################
+## Functions
+
+
+_now = getattr(time, 'perf_counter', time.time)
+
+
+class startupProfile(object):
+    def __init__(self):
+        self.start = _now()
+        self.imports = []                       # (module, sec.)
+        self.phases = []                        # (phase, sec.)
+        self.marks = []                         # (event, sec. since start)
+
+    def importModule(self, name):
+        already = name in sys.modules
+        start = _now()
+        module = importlib.import_module(name)
+        if not already:
+            self.imports.append((name, _now() - start))
+        return module
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = _now()
+        try:
+            yield
+        finally:
+            self.phases.append((name, _now() - start))
+
+    def mark(self, name):
+        self.marks.append((name, _now() - self.start))
+
+    def report(self):
+        lines = ['Startup profile (wall time):']
+        lines += ['  import %-28s %8.1f ms' % (name, duration*1000.) for name, duration in self.imports]
+        lines += ['  %-35s %8.1f ms' % (name, duration*1000.) for name, duration in self.phases]
+        lines += ['  %-35s %8.1f ms from start' % (name, elapsed*1000.) for name, elapsed in self.marks]
+        return lines
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: per-flip stimulus state log
+
+What was on screen at every flip of the run: flip time, checkerboard polarity, ring limits
+(mask_begin/mask_end), wedge orientation (polar.ori), bar position and orientation
+(stim.pos/stim.ori), cycle and fixation colour. The stimuli of a frame are fully set from
+one row of the frame schedule, so the render loop only stores the flip time, the run time
+and the schedule row in preallocated arrays (three stores per flip); the state columns are
+gathered from the schedule when the log is saved, as .npy, at the end of the run.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import numpy as np
+
+
+################################################################################################################
+## Constants
+
+State_dtype = np.dtype([
+    ('flip_time', np.float64),                  # run time of the flip: win.flip() timestamp since the reset flip (sec.)
+    ('t', np.float64),                          # run time the frame was drawn for (sec.)
+    ('i_frame', np.int32),                      # schedule row
+    ('polarity', np.int8),                      # 0: first checkerboard, 1: reversed one
+    ('mask_begin', np.int32),                   # ring limits, pixels from the centre (-1: no ring)
+    ('mask_end', np.int32),
+    ('polar_ori', np.float32),                  # wedge orientation, degrees (nan: no wedge)
+    ('stim_pos', np.float32, (2,)),             # bar centre, pixels (nan: no bar)
+    ('stim_ori', np.float32),                   # bar orientation, degrees (nan: no bar)
+    ('cycle', np.int16),                        # cycle (or bar orientation) number
+    ('cycle_polar', np.int16),                  # wedge cycle in eccentricity_polar (-1 elsewhere)
+    ('fixation_color', np.int8),                # 0: red, 1: green
+    ('fixation_ori', np.float32),               # fixation cross rotation, degrees
+])
+
+
+################################################################################################################
+## Functions
+
+
+class frameStateLog(object):
+    def __init__(self, schedule, capacity=None, mask_limits=None, wedge=False, bar_scale=None):
+        self.schedule = schedule
+        self.mask_limits = mask_limits          # (mask_begin, mask_end) per crown position (mask_bank.crownMaskLimits)
+        self.wedge = wedge                      # the orientation column is polar.ori
+        self.bar_scale = bar_scale              # pixels per bar_pos unit (resY/2), None: no bar
+        self.capacity = 2 * len(schedule) if capacity is None else int(capacity)
+        self.flip_time = np.zeros((self.capacity,), dtype=np.float64)
+        self.t = np.zeros((self.capacity,), dtype=np.float64)
+        self.i_frame = np.zeros((self.capacity,), dtype=np.int32)
+        self.n_rows = 0
+        self.overflow = 0                       # flips not recorded, beyond capacity
+
+    # Render thread: one call per flip
+    def record(self, flip_time, t, i_frame):
+        n_rows = self.n_rows
+        if n_rows < self.capacity:
+            self.flip_time[n_rows] = flip_time
+            self.t[n_rows] = t
+            self.i_frame[n_rows] = i_frame
+            self.n_rows = n_rows + 1
+        else:
+            self.overflow += 1
+
+    def rows(self):
+        n_rows = self.n_rows
+        i_frame = self.i_frame[:n_rows]
+        shown = self.schedule[i_frame]
+        rows = np.zeros((n_rows,), dtype=State_dtype)
+        rows['flip_time'] = self.flip_time[:n_rows]
+        rows['t'] = self.t[:n_rows]
+        rows['i_frame'] = i_frame
+        for name in ('polarity', 'cycle', 'cycle_polar', 'fixation_color', 'fixation_ori'):
+            rows[name] = shown[name]
+
+        rows['mask_begin'] = rows['mask_end'] = -1
+        if self.mask_limits is not None:
+            with_ring = shown['mask_index'] >= 0
+            mask_index = shown['mask_index'][with_ring]
+            rows['mask_begin'][with_ring] = self.mask_limits[0][mask_index]
+            rows['mask_end'][with_ring] = self.mask_limits[1][mask_index]
+        rows['polar_ori'] = shown['orientation'] if self.wedge else np.nan
+        if self.bar_scale is not None:
+            rows['stim_pos'] = shown['bar_pos'] * self.bar_scale
+            rows['stim_ori'] = shown['orientation']
+        else:
+            rows['stim_pos'] = rows['stim_ori'] = np.nan
+        return rows
+
+    def save(self, path):
+        np.save(path, self.rows())
+        return self.n_rows
+
+    def summary(self):
+        text = 'Stimulus state of %d flips recorded' % self.n_rows
+        if self.overflow > 0:
+            text += ', %d flips beyond the capacity of %d not recorded' % (self.overflow, self.capacity)
+        return text
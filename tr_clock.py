@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: TR-locked clock
+
+Wraps the run clock of the render loop (globalClock or frameLockedClock) and keeps the
+stimulus time on the scanner's TR grid: every scanner trigger (button box pulse or '5'/'t'
+key) is placed on the grid, and the difference between the stimulus time when it arrived
+and its place on the grid is corrected a little at every flip, never more than
+max_correction per frame, so cycles stay phase-locked to the volumes without visible jumps.
+Missed or extra pulses are recognised from the grid. The measured TR, the drift against the
+nominal TR and the corrections applied are summarised at the end of the run.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+import numpy as np
+
+from button_box import Trigger_button, Trigger_state
+from event_ring import monotonicNs
+
+
+################################################################################################################
+## Constants
+
+Max_correction = 0.001                          # sec of stimulus time corrected per frame (6% of a 60 Hz frame)
+
+
+################################################################################################################
+## Functions
+
+
+class trLockedClock(object):
+    def __init__(self, base, tr, first_trigger=0., max_correction=Max_correction):
+        self.base = base                        # run clock with getTime() (and flipped(), if frame-locked)
+        self.tr = float(tr)
+        self.first_trigger = first_trigger      # stimulus time of trigger number 0
+        self.max_correction = max_correction
+        self.correction = 0.                    # added to the base time
+        self.pending = 0.                       # still to apply
+        self.shown = 0.                         # stimulus time of the frame on screen
+        self.last_flip = None
+        self._queue = []                        # run times of triggers not placed yet
+
+        # Statistics
+        self.triggers = []                      # (grid index, run time, error in sec.)
+        self.corrected_frames = 0
+        self.total_correction = 0.              # sum of |steps|
+
+    def getTime(self):
+        self.shown = self.base.getTime() + self.correction
+        return self.shown
+
+    # Run time (globalClock) of a scanner trigger
+    def trigger(self, run_time):
+        self._queue.append(run_time)
+
+    # Call with the run time of the flip (win.flip() timestamp on the clock of the triggers, globalClock):
+    # places the new triggers, then corrects one step
+    def flipped(self, flip_time):
+        if hasattr(self.base, 'flipped'):
+            self.base.flipped(flip_time)
+        self.last_flip = flip_time
+        for run_time in self._queue:
+            self._place(run_time, flip_time)
+        del self._queue[:]
+
+        if self.pending != 0.:
+            step = min(max(self.pending, -self.max_correction), self.max_correction)
+            self.correction += step
+            self.pending -= step
+            self.corrected_frames += 1
+            self.total_correction += abs(step)
+
+    def _place(self, run_time, flip_time):
+        stimulus_time = self.shown + (run_time - flip_time)
+        i_grid = int(round((stimulus_time - self.first_trigger) / self.tr))
+        error = stimulus_time - (self.first_trigger + i_grid * self.tr)
+        self.pending = -error                   # the error already includes the corrections applied
+        self.triggers.append((i_grid, run_time, error))
+
+    def measuredTr(self):
+        if len(self.triggers) < 2:
+            return np.nan
+        triggers = np.asarray(self.triggers)
+        return np.polyfit(triggers[:, 0], triggers[:, 1], 1)[0]
+
+    def summary(self):
+        if len(self.triggers) == 0:
+            return 'TR-locked timing: no trigger during the run'
+        triggers = np.asarray(self.triggers)
+        i_grid = triggers[:, 0].astype(int)
+        missed = int(np.sum(np.maximum(np.diff(i_grid) - 1, 0)))
+        extra = int(np.sum(np.diff(i_grid) == 0))
+        errors = triggers[:, 2] * 1000.
+        measured = self.measuredTr()
+        return ('TR-locked timing: %d triggers (%d missed, %d extra), measured TR %.6f sec (drift %+.1f ppm against '
+                '%.3f), error at trigger mean %+.3f ms / max |%.3f| ms, %.3f ms corrected over %d frames '
+                '(net %+.3f ms, %+.3f ms pending)') % \
+            (len(triggers), missed, extra, measured, (measured / self.tr - 1.) * 1e6, self.tr, errors.mean(),
+             np.abs(errors).max(), self.total_correction * 1000., self.corrected_frames, self.correction * 1000.,
+             self.pending * 1000.)
+
+
+# Run time of the scanner triggers among button events (event_ring rows): from the DIN log
+# timestamps with a clock sync, else from when the poll decoded them
+def triggerTimes(events, now, clock_sync=None):
+    triggers = events[(events['button'] == Trigger_button) & (events['state'] == Trigger_state)]
+    if len(triggers) == 0:
+        return []
+    if clock_sync is not None:
+        return list(clock_sync.deviceToRun(triggers['hw_time']))
+    return list(now - (monotonicNs() - triggers['mono_ns']) * 1e-9)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Retinotopic mapping: cached background layer
+
+The spider web (and optionally the fixation cross) never changes during a run, so it is
+drawn once into a BufferImageStim and blitted every frame, instead of rebuilding the
+vertices of every web circle and line on every frame. The cache is rebuilt only when
+Web_size, Spyder_rings or the window size change.
+"""
+
+################################################################################################################
+## Imports
+
+from __future__ import division
+
+
+################################################################################################################
+## Functions
+
+
+class webBackground(object):
+    def __init__(self, win, web_circle, web_line, web_dimension, rings, fixation=None):
+        self.win = win
+        self.web_circle = web_circle
+        self.web_line = web_line
+        self.fixation = fixation                # baked in the layer, i.e. drawn *under* the stimuli
+        self.builds = 0
+        self.update(web_dimension, rings)
+
+    # Change the web; the layer is rebuilt at the next draw only if something changed
+    def update(self, web_dimension, rings):
+        key = (tuple(web_dimension), rings)
+        if getattr(self, '_key', None) != key:
+            self._key = key
+            self.invalidate()
+
+    def invalidate(self):
+        self._layer = None
+        self._layer_size = None
+
+    # Same drawing as the "Spyder network" block of main()
+    def drawWeb(self):
+        web_dimension, rings = self._key
+        for i_dim in range(rings):
+            self.web_circle.setSize(tuple([x*(i_dim+1) * 1./rings for x in web_dimension]), log=False)
+            self.web_circle.draw()
+        for i_dim in range(2):
+            self.web_line.setOri(i_dim * 90, log=False)
+            self.web_line.draw()
+        if self.fixation is not None:
+            self.fixation.draw()
+
+    def build(self):
+        from psychopy import visual
+
+        # Capture the web alone from the back buffer, then leave it clean
+        self.win.clearBuffer()
+        self.drawWeb()
+        self._layer = visual.BufferImageStim(self.win, buffer='back', interpolate=False)
+        self._layer.autoLog = False
+        self._layer_size = tuple(self.win.size)
+        self.win.clearBuffer()
+        self.builds += 1
+
+    def draw(self):
+        if self._layer is None or self.win.size[0] != self._layer_size[0] or self.win.size[1] != self._layer_size[1]:
+            self.build()
+        self._layer.draw()